@@ -1,16 +1,22 @@
 import gradio as gr
 import os
-from traccc.draw import run_draw
+from traccc.draw import accumulating_effects, run_draw
+from traccc.effects import Effect
 from traccc.track import run_track
 from traccc.detect import run_detect
+from traccc.stream import run_stream
+from traccc.detection_store import find_detections
+from traccc.track_store import find_tracks
 
 def sanitize_run_detect(project_name: str, model_select: str, input_file: str, prompts: str = None,
+                        batch_size: int = 4, scale: float = 1.0, tile_size: int = 0, cache_gb: float = 0,
                         progress=gr.Progress(track_tqdm=True)):
     """
     Sanitizes the input for running detection. Runs detection if input is valid.
     Args:
         project_name: name of the project, the slug for internal files.
         model_select: string for
+        batch_size: number of frames passed through the model at once.
     """
     if not os.path.exists("io/" + input_file):
         raise gr.Error(f"Input file '{input_file}' does not exist. Is the file" + \
@@ -19,87 +25,175 @@ def sanitize_run_detect(project_name: str, model_select: str, input_file: str, p
     if model_select == "OWLVIT" and prompts is None:
         raise gr.Error(f"In order to use a zero-shot detector, you must specify what you want detected via a prompt")
 
+    if 0 < tile_size <= 64:
+        raise gr.Error(f"Tiles must be bigger than the 64 pixels they overlap by.")
+
     prompts = prompts.split(",") if prompts is not None else None
-    return run_detect(project_name, model_select, "io/" + input_file, prompts)
+    return run_detect(project_name, model_select, "io/" + input_file, prompts, int(batch_size),
+                      cache_gb=cache_gb, scale=scale,
+                      tile_size=int(tile_size) if tile_size > 0 else None)
 
 def sanitize_run_track(name: str, track_type: str, death_time: int, iou_threshold: float, conf_threshold: float, max_cost: float):
-    if not os.path.exists(f"internal/{name}.npz"):
+    if find_detections(name) is None:
         raise gr.Error(f"Couldn't find detections for this project. Is the project name" + \
                        " correct?")
 
     return run_track(name, track_type, death_time, iou_threshold, conf_threshold, max_cost)
 
 def sanitize_run_draw(name: str, input_video: str, output: str, effect_name: str,
-             colour: str, size: float, length: int, min_age: int, progress=gr.Progress(track_tqdm=True)):
+             colour: str, size: float, length: int, min_age: int, workers: int = 1,
+             accumulate: bool = False, preset: str = "veryfast", crf: int = 23, cache_gb: float = 0,
+             progress=gr.Progress(track_tqdm=True)):
 
-    if not os.path.exists(f"internal/{name}.yaml"):
+    if find_tracks(name) is None:
         raise gr.Error(f"Couldn't find tracks for this project. Is the project name" + \
                        " correct?")
 
     if not os.path.exists("io/" + input_video):
         raise gr.Error(f"Couldn't find input video '{input_video}'. Is the input video path correct?")
 
-    return run_draw(name, "io/" + input_video, "io/" + output, effect_name, colour, size, length, min_age)
-
-with gr.Blocks() as demo:
-    gr.Markdown("Create cool ball tracking videos with this one simple trick!")
-    project_name_input = gr.Textbox(placeholder="fireball", label="Project Name",
-                            info="The name of the clip being processed. Remember \
-                            this name and make it unique, because it's used in the \
-                            next two steps as well. Using the same name will \
-                            overwrite previous data!")
-    # video_upload = gr.inputs.Video(label="Video File")
-    input_file = gr.Textbox(
-        placeholder="fireball.mp4", label="Input File",
-        info="The name of the file in the io directory.")
-    with gr.Tab("Detect"):
-        model_select = gr.components.Radio(["DETR", "RN50", "OWLVIT"], label="Model")
-        prompts = gr.Textbox(placeholder="juggling ball, dog", label="Prompts (comma separated)")
-
-        detect_button = gr.Button("Detect", variant="primary")
-        debug_textbox = gr.Textbox(label="Output")
-        detect_button.click(sanitize_run_detect, inputs=[
-                            project_name_input, model_select, input_file, prompts], outputs=[debug_textbox])
-
-    with gr.Tab("Track"):
-        track_type_input = gr.components.Radio(
-            ["Constant Acceleration", "Constant Velocity"], label="Track Type", value="Constant Acceleration")
-        death_time = gr.Slider(label="Death Time", minimum=1,
-                               maximum=20, value=5, interactive=True, step=1)
-        iou_threshold = gr.Slider(
-            label="IoU Threshold", minimum=0.01, maximum=1, value=0.20, interactive=True)
-        confidence_treshold = gr.Slider(
-            label="Confidence Threshold", minimum=0, maximum=1, value=0.05, interactive=True)
-        max_cost = gr.Slider(label="Maximum Matching Cost",
-                             minimum=0, maximum=1000, value=200, interactive=True)
-        track_button = gr.Button("Track", variant="primary")
-        track_debug_textbox = gr.Textbox(label="Output")
-        track_button.click(sanitize_run_track, inputs=[project_name_input, track_type_input, death_time,
-                           iou_threshold, confidence_treshold, max_cost], outputs=[track_debug_textbox])
-
-    with gr.Tab("Draw"):
-        output_file = gr.Textbox(placeholder="fireball_with_effect.mp4", label="Output File",
-                                 info="The video file to be created")
-        # TODO these need to be in a constants file.
-        effect_name = gr.components.Radio(["dot", "lagging_dot",
-                                           "line", "highlight_line", "neon_line",
-                                           "contrail", "fully_connected",
-                                           "fully_connected_neon", "debug", "tricolor"], label="Effect")
-        colour = gr.ColorPicker(label="Colour", value="#ff0000")
-        size = gr.Slider(label="size", info="size of the effect, proportional to \
-                               the width of the object being tracked.",
-                               minimum=0, maximum=20, value=1, interactive=True)
-        length = gr.Slider(label="length", info="length of the effect in frames",
-                           minimum=1, maximum=50, value=7, interactive=True, step=1)
-        min_age = gr.Slider(label="minimum age", info="minimum age requirement (in frames) for \
-                            a track to be visualized. Increasing this value will remove tracks that \
-                            are short-lived, possibly false-positives.",
-                            minimum=1, maximum=50, value=7, interactive=True, step=1)
-
-        draw_button = gr.Button("Draw Effect", variant="primary")
-
-        draw_debug_textbox = gr.Textbox(label="Output")
-        draw_button.click(sanitize_run_draw, inputs=[project_name_input, input_file, output_file, effect_name, colour, size, length, min_age],
-                          outputs=draw_debug_textbox)
-
-demo.queue().launch(server_name="0.0.0.0")
+    if accumulate and effect_name not in accumulating_effects(int(length)):
+        raise gr.Error(f"The {effect_name} effect can't use fading trails of {int(length)} frames. Only " +
+                       ", ".join(accumulating_effects(int(length)) or ["none"]) + " can.")
+
+    return run_draw(name, "io/" + input_video, "io/" + output, effect_name, colour, size, length, min_age,
+                    workers=int(workers), accumulate=accumulate, preset=preset, crf=int(crf),
+                    cache_gb=cache_gb)
+
+def sanitize_run_stream(input_file: str, output: str, model_select: str, prompts: str, batch_size: int,
+                        track_type: str, death_time: int, iou_threshold: float, conf_threshold: float,
+                        max_cost: float, effect_name: str, colour: str, size: float, length: int,
+                        min_age: int, scale: float = 1.0, tile_size: int = 0, preset: str = "veryfast",
+                        crf: int = 23, progress=gr.Progress(track_tqdm=True)):
+    if not os.path.exists("io/" + input_file):
+        raise gr.Error(f"Input file '{input_file}' does not exist. Is the file" + \
+                       " in the specificed io folder? Is the folder mounted correctly?")
+
+    if model_select == "OWLVIT" and not prompts:
+        raise gr.Error(f"In order to use a zero-shot detector, you must specify what you want detected via a prompt")
+
+    if 0 < tile_size <= 64:
+        raise gr.Error(f"Tiles must be bigger than the 64 pixels they overlap by.")
+
+    prompts = prompts.split(",") if prompts else None
+    return run_stream("io/" + input_file, "io/" + output, model_select, effect_name, prompts=prompts,
+                      batch_size=int(batch_size), track_type=track_type, death_time=int(death_time),
+                      iou_threshold=iou_threshold, conf_threshold=conf_threshold, max_cost=max_cost,
+                      colour=colour, size=size, length=int(length), min_age=int(min_age),
+                      scale=scale, tile_size=int(tile_size) if tile_size > 0 else None,
+                      preset=preset, crf=int(crf))
+
+def build_demo() -> gr.Blocks:
+    """
+    Builds the UI. Kept out of module level, because the draw worker processes are spawned and
+    import this module again, and must not build and launch another server.
+    """
+    with gr.Blocks() as demo:
+        gr.Markdown("Create cool ball tracking videos with this one simple trick!")
+        project_name_input = gr.Textbox(placeholder="fireball", label="Project Name",
+                                info="The name of the clip being processed. Remember \
+                                this name and make it unique, because it's used in the \
+                                next two steps as well. Using the same name will \
+                                overwrite previous data!")
+        # video_upload = gr.inputs.Video(label="Video File")
+        input_file = gr.Textbox(
+            placeholder="fireball.mp4", label="Input File",
+            info="The name of the file in the io directory.")
+        cache_gb = gr.Slider(label="Frame Cache (GB)", info="keep the decoded frames of the input in \
+                             internal/frame_cache, so detecting and drawing it again don't decode it \
+                             again. Raw frames are big, about 6 MB per frame at 1080p and 25 MB at 4K, \
+                             so only clips that fit in this limit are cached. 0 turns the cache off.",
+                             minimum=0, maximum=100, value=0, interactive=True, step=1)
+        with gr.Tab("Detect"):
+            model_select = gr.components.Radio(["DETR", "RN50", "OWLVIT"], label="Model")
+            prompts = gr.Textbox(placeholder="juggling ball, dog", label="Prompts (comma separated)")
+            batch_size = gr.Slider(label="Batch Size", info="number of frames passed through the \
+                                   model at once. Lower this if you run out of memory.",
+                                   minimum=1, maximum=32, value=4, interactive=True, step=1)
+            scale = gr.Slider(label="Scale", info="frames are downscaled by this factor before \
+                              detection. Faster, but small balls can be missed.",
+                              minimum=0.1, maximum=1, value=1, interactive=True)
+            tile_size = gr.Slider(label="Tile Size", info="split frames into overlapping tiles of this \
+                                  many pixels, and detect in each one. Finds small balls in high \
+                                  resolution video, but is slower. 0 to detect whole frames.",
+                                  minimum=0, maximum=1920, value=0, interactive=True, step=32)
+
+            detect_button = gr.Button("Detect", variant="primary")
+            debug_textbox = gr.Textbox(label="Output")
+            detect_button.click(sanitize_run_detect, inputs=[
+                                project_name_input, model_select, input_file, prompts, batch_size, scale, tile_size, cache_gb],
+                                outputs=[debug_textbox])
+
+        with gr.Tab("Track"):
+            track_type_input = gr.components.Radio(
+                ["Constant Acceleration", "Constant Velocity"], label="Track Type", value="Constant Acceleration")
+            death_time = gr.Slider(label="Death Time", minimum=1,
+                                   maximum=20, value=5, interactive=True, step=1)
+            iou_threshold = gr.Slider(
+                label="IoU Threshold", minimum=0.01, maximum=1, value=0.20, interactive=True)
+            confidence_treshold = gr.Slider(
+                label="Confidence Threshold", minimum=0, maximum=1, value=0.05, interactive=True)
+            max_cost = gr.Slider(label="Maximum Matching Cost",
+                                 minimum=0, maximum=1000, value=200, interactive=True)
+            track_button = gr.Button("Track", variant="primary")
+            track_debug_textbox = gr.Textbox(label="Output")
+            track_button.click(sanitize_run_track, inputs=[project_name_input, track_type_input, death_time,
+                               iou_threshold, confidence_treshold, max_cost], outputs=[track_debug_textbox])
+
+        with gr.Tab("Draw"):
+            output_file = gr.Textbox(placeholder="fireball_with_effect.mp4", label="Output File",
+                                     info="The video file to be created")
+            # TODO these need to be in a constants file.
+            effect_name = gr.components.Radio(["dot", "lagging_dot",
+                                               "line", "highlight_line", "neon_line",
+                                               "contrail", "fully_connected",
+                                               "fully_connected_neon", "debug", "tricolor"], label="Effect")
+            colour = gr.ColorPicker(label="Colour", value="#ff0000")
+            size = gr.Slider(label="size", info="size of the effect, proportional to \
+                                   the width of the object being tracked.",
+                                   minimum=0, maximum=20, value=1, interactive=True)
+            length = gr.Slider(label="length", info="length of the effect in frames",
+                               minimum=1, maximum=50, value=7, interactive=True, step=1)
+            min_age = gr.Slider(label="minimum age", info="minimum age requirement (in frames) for \
+                                a track to be visualized. Increasing this value will remove tracks that \
+                                are short-lived, possibly false-positives.",
+                                minimum=1, maximum=50, value=7, interactive=True, step=1)
+            draw_workers = gr.Slider(label="processes", info="number of processes the video is split \
+                                     between. Each one draws a chunk of the video on its own core.",
+                                     minimum=1, maximum=os.cpu_count(), value=1, interactive=True, step=1)
+            accumulate = gr.Checkbox(label="fading trails", info="keep trails from frame to frame and let \
+                                     them fade out smoothly, instead of redrawing them. Only for " +
+                                     " and ".join(accumulating_effects(Effect.min_accumulated_length)) +
+                                     f" with trails of {Effect.min_accumulated_length} frames or more, \
+                                     where it's faster: about 1.5-2x at 50 frames, and 4x or more at 150.")
+            preset = gr.Dropdown(["ultrafast", "veryfast", "fast", "medium", "slow"], value="veryfast",
+                                 label="encoder preset", info="slower presets make smaller files at the \
+                                 same quality, but take longer to encode.")
+            crf = gr.Slider(label="quality (CRF)", info="lower is better quality and bigger files. \
+                            18 looks about the same as the input.",
+                            minimum=0, maximum=51, value=23, interactive=True, step=1)
+
+            draw_button = gr.Button("Draw Effect", variant="primary")
+
+            draw_debug_textbox = gr.Textbox(label="Output")
+            draw_button.click(sanitize_run_draw, inputs=[project_name_input, input_file, output_file, effect_name, colour, size, length, min_age, draw_workers, accumulate, preset, crf, cache_gb],
+                              outputs=draw_debug_textbox)
+
+        with gr.Tab("Stream"):
+            gr.Markdown("Runs all three stages in a single pass, with the settings of the Detect, Track \
+                        and Draw tabs. Nothing is saved in between, so it's faster, but changing the \
+                        effect means running everything again.")
+            stream_output_file = gr.Textbox(placeholder="fireball_with_effect.mp4", label="Output File",
+                                            info="The video file to be created")
+            stream_button = gr.Button("Detect, Track and Draw", variant="primary")
+            stream_debug_textbox = gr.Textbox(label="Output")
+            stream_button.click(sanitize_run_stream, inputs=[input_file, stream_output_file, model_select, prompts,
+                                batch_size, track_type_input, death_time, iou_threshold, confidence_treshold,
+                                max_cost, effect_name, colour, size, length, min_age, scale, tile_size,
+                                preset, crf],
+                                outputs=stream_debug_textbox)
+    return demo
+
+
+if __name__ == "__main__":
+    build_demo().queue().launch(server_name="0.0.0.0")
@@ -1,7 +1,9 @@
+import numpy as np
 import pytest
 import skvideo.io
 
-from traccc.detectors import HuggingFaceDETR, PretrainedRN50Detector, OWLVITZeroShot
+from traccc.detectors import (HuggingFaceDETR, PretrainedRN50Detector, OWLVITZeroShot, ScaledDetector,
+                              batch_frames, tile_origins)
 
 
 @pytest.mark.parametrize("DetectorClass", [HuggingFaceDETR, PretrainedRN50Detector])
@@ -37,3 +39,63 @@ def test_zeroshot_detector(DetectorClass):
     for frame_detections in result:
         # there must be a ball detected. there could be multiple boxes because no NMS
         assert len(frame_detections) >= 1
+
+@pytest.mark.parametrize("batch_size", [1, 7, 120, 200])
+def test_batch_frames(batch_size):
+    """
+    Test that batching keeps every frame in order, including the last partial batch.
+    """
+    frames = list(range(120))
+    batches = list(batch_frames(iter(frames), batch_size))
+    assert all(len(batch) == batch_size for batch in batches[:-1])
+    assert 0 < len(batches[-1]) <= batch_size
+    assert [frame for batch in batches for frame in batch] == frames
+
+
+class BrightSpotDetector:
+    """
+    Stands in for a model, detecting the bright pixels of a frame as one box.
+    """
+    batch_size = 3
+
+    def detect_batch(self, frames, bbox_format="xyxy"):
+        batch_detections = []
+        for frame in frames:
+            ys, xs = np.nonzero(frame[:, :, 0] > 128)
+            if len(xs) == 0:
+                batch_detections.append(np.zeros((0, 5)))
+            else:
+                batch_detections.append(np.array([[len(xs) / frame[:, :, 0].size,
+                                                   xs.min(), ys.min(), xs.max() + 1, ys.max() + 1]]))
+        return batch_detections
+
+
+@pytest.mark.parametrize("length, tile_size, overlap", [(3840, 640, 64), (1080, 640, 100), (500, 640, 64)])
+def test_tile_origins(length, tile_size, overlap):
+    """
+    Test that the tiles cover the whole edge, overlapping by at least overlap pixels.
+    """
+    origins = tile_origins(length, tile_size, overlap)
+    assert origins[0] == 0
+    assert origins[-1] + tile_size >= length
+    for start, next_start in zip(origins[:-1], origins[1:]):
+        assert start + tile_size - next_start >= overlap
+
+
+@pytest.mark.parametrize("scale, tile_size", [(1.0, 640), (0.5, None), (0.5, 320)])
+@pytest.mark.parametrize("ball", [(1000, 600, 1040, 640),  # in the overlap of several tiles
+                                  (1050, 300, 1090, 340)])  # cut by the right edge of a tile
+def test_scaled_detector_maps_boxes_back(scale, tile_size, ball):
+    """
+    Test that boxes found on downscaled frames or on tiles are mapped back to the original frame,
+    and that a ball in more than one tile, or cut by the edge of one, is detected once and whole.
+    """
+    frames = [np.zeros((1080, 1920, 3), dtype=np.uint8) for _ in range(4)]
+    x1, y1, x2, y2 = ball
+    frames[0][y1:y2, x1:x2] = 255
+    frames[2][10:30, 10:30] = 255  # near the corner of the frame, in a single tile
+    detector = ScaledDetector(BrightSpotDetector(), scale=scale, tile_size=tile_size, tile_overlap=64)
+    detections = detector.detect_batch(frames, bbox_format="xyxy")
+    assert [len(frame_detections) for frame_detections in detections] == [1, 0, 1, 0]
+    assert np.allclose(detections[0][0, 1:], ball)
+    assert np.allclose(detections[2][0, 1:], [10, 10, 30, 30])
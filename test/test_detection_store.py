@@ -0,0 +1,102 @@
+import os
+
+import numpy as np
+
+from traccc.detection_store import (DetectionFile, DetectionWriter, convert_npz, index_path,
+                                    load_detections, read_manifest)
+
+
+def random_detections(frame_count: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    return [rng.random((rng.integers(0, 4), 5)).astype(np.float32) for _ in range(frame_count)]
+
+
+def test_round_trip(tmp_path):
+    """
+    Tests that detections come back frame by frame, including frames without any detections.
+    """
+    path = str(tmp_path / "project.detections")
+    detections = random_detections(50)
+    with DetectionWriter(path, chunk_size=8) as store:
+        for frame_detections in detections:
+            store.write(frame_detections)
+
+    assert read_manifest(path)["complete"]
+    loaded = load_detections(path)
+    assert len(loaded) == len(detections)
+    for frame_detections, loaded_detections in zip(detections, loaded):
+        assert np.array_equal(frame_detections, loaded_detections)
+
+
+def test_resume_after_crash(tmp_path):
+    """
+    Tests that a run that dies part way through keeps its committed chunks, and that
+    resuming picks up at the first frame that wasn't committed.
+    """
+    path = str(tmp_path / "project.detections")
+    detections = random_detections(50)
+    store = DetectionWriter(path, chunk_size=8)
+    for frame_detections in detections[:21]:
+        store.write(frame_detections)
+    store.file.close()  # the process dies without closing the store
+
+    manifest = read_manifest(path)
+    assert manifest["frames"] == 16 and not manifest["complete"]
+
+    with DetectionWriter(path, chunk_size=8, resume=True) as store:
+        assert store.frames_committed == 16
+        for frame_detections in detections[16:]:
+            store.write(frame_detections)
+
+    loaded = load_detections(path)
+    assert len(loaded) == len(detections)
+    for frame_detections, loaded_detections in zip(detections, loaded):
+        assert np.array_equal(frame_detections, loaded_detections)
+
+
+def test_load_npz(tmp_path):
+    """
+    Tests that detections saved by older versions, one array per frame in an .npz, still load.
+    """
+    path = str(tmp_path / "project.npz")
+    detections = random_detections(12)
+    np.savez(path, *detections)
+    loaded = load_detections(path)
+    assert len(loaded) == len(detections)
+    for frame_detections, loaded_detections in zip(detections, loaded):
+        assert np.array_equal(frame_detections, loaded_detections)
+
+
+def test_frame_lookup(tmp_path):
+    """
+    Tests that a complete store is indexed, and that frames can be looked up in any order
+    as views into the memory-mapped rows.
+    """
+    path = str(tmp_path / "project.detections")
+    detections = random_detections(30)
+    with DetectionWriter(path, chunk_size=4) as store:
+        for frame_detections in detections:
+            store.write(frame_detections)
+
+    loaded = DetectionFile(path)
+    assert os.path.exists(index_path(path))
+    assert len(loaded) == len(detections)
+    for frame_number in [29, 0, 17, -1]:
+        assert np.array_equal(loaded[frame_number], detections[frame_number])
+    non_empty = next(i for i, frame_detections in enumerate(detections) if len(frame_detections) > 0)
+    assert np.shares_memory(loaded[non_empty], loaded.rows)
+
+
+def test_convert_npz(tmp_path):
+    """
+    Tests that converting an .npz from older versions keeps every frame.
+    """
+    npz_path = str(tmp_path / "project.npz")
+    path = str(tmp_path / "project.detections")
+    detections = random_detections(20)
+    np.savez(npz_path, *detections)
+    convert_npz(npz_path, path)
+    loaded = load_detections(path)
+    assert len(loaded) == len(detections)
+    for frame_detections, loaded_detections in zip(detections, loaded):
+        assert np.array_equal(frame_detections, loaded_detections)
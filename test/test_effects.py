@@ -1,9 +1,13 @@
 from traccc.effects import *
+from traccc.detection_store import find_detections
+from traccc.draw import TrackIndex, accumulating_effects, run_draw
+import cv2
+import numpy as np
 import os
 import pytest
 
 def get_stormy():
-    if not os.path.exists("internal/stormy.npz"):
+    if find_detections("stormy") is None:
         os.system("python3 detect.py stormy --input test_assets/stormy.mp4")
         os.system("python3 track.py stormy")
 
@@ -24,3 +28,207 @@ def test_fully_connected():
 def test_effect(effect_class):
     pass
 
+
+
+@pytest.mark.parametrize("effect", [Dot((255, 0, 0), 5), LaggingDot((255, 0, 0), 5)])
+@pytest.mark.parametrize("start", [0, 37])
+def test_track_index_matches_scan(effect, start):
+    """
+    Tests that the track index finds the same relevant tracks, in the same order,
+    as checking every track on every frame.
+    """
+    rng = np.random.default_rng(0)
+    tracks = [{"id": i, "start_frame": int(rng.integers(0, 100)), "age": int(rng.integers(0, 20))}
+              for i in range(60)]
+    index = TrackIndex(tracks, effect)
+    for frame_number, relevant_tracks in zip(range(start, 130), index.frames(start, 130)):
+        assert relevant_tracks == [track for track in tracks if effect.relevant(track, frame_number)]
+
+
+@pytest.mark.parametrize("offset", [(0, 0), (-40, 30), (250, 180)])
+def test_glow_matches_full_frame(offset):
+    """
+    Tests that drawing and blurring a glow on a small region gives the same frame as doing it
+    on a full-frame canvas, including near and past the edges of the frame.
+    """
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 200, (240, 320, 3)).astype(np.uint8)
+    points = [tuple(map(int, p)) for p in np.cumsum(rng.normal(0, 10, (8, 2)), axis=0) + 100 + offset]
+
+    blank = np.zeros_like(frame)
+    glow = Glow(frame, points, 7, 9 // 2 + 5 // 2)
+    for point_1, point_2 in zip(points[:-1], points[1:]):
+        blank = cv2.line(blank, point_1, point_2, color=(255, 0, 0), thickness=7)
+        glow.line(point_1, point_2, (255, 0, 0), 7)
+    for kernel_size in [9, 5]:
+        blank = cv2.GaussianBlur(blank, (kernel_size, kernel_size), 2)
+        glow.blur(kernel_size, 2)
+
+    expected = cv2.addWeighted(frame, 1, blank, 1, 0)
+    assert np.array_equal(glow.add_to(frame.copy()), expected)
+
+
+def contrail_track():
+    rng = np.random.default_rng(0)
+    states = np.zeros((40, 6))
+    states[:, :2] = np.cumsum(rng.normal(0, 10, (40, 2)), axis=0) + 150
+    states[:, 4] = rng.uniform(3, 6, 40)
+    return {"id": 0, "start_frame": 0, "age": 40, "states": states}
+
+
+def test_contrail_blurs_are_bounded(monkeypatch):
+    """
+    Tests that Contrail blurs at most max_blurs times per track, however long the trail is.
+    """
+    blurs = []
+    original_blur = Glow.blur
+    monkeypatch.setattr(Glow, "blur", lambda glow, *args: blurs.append(args) or original_blur(glow, *args))
+    Contrail((255, 0, 0), 30, 3, max_blurs=3).draw(np.zeros((300, 300, 3), dtype=np.uint8), contrail_track(), 35)
+    assert len(blurs) == 3
+
+
+def test_contrail_one_blur_per_segment():
+    """
+    Tests that with a blur for every segment, Contrail draws the same as blurring the whole
+    frame after each segment.
+    """
+    track = contrail_track()
+    frame = np.zeros((300, 300, 3), dtype=np.uint8)
+    blank = np.zeros_like(frame)
+    for i in range(20, 35):
+        (x, y), (x2, y2) = track["states"][i][:2], track["states"][i-1][:2]
+        kernel_size = int(3 * track["states"][i][4])
+        kernel_size += 1 - kernel_size % 2
+        blank = cv2.line(blank, (int(x), int(y)), (int(x2), int(y2)), color=(255, 0, 0), thickness=kernel_size)
+        blank = cv2.GaussianBlur(blank, (kernel_size, kernel_size), kernel_size//2)
+    expected = cv2.addWeighted(frame, 1, blank, 1, 0)
+    drawn = Contrail((255, 0, 0), 15, 3, max_blurs=15).draw(frame.copy(), track, 35)
+    assert np.array_equal(drawn, expected)
+
+
+def trail_tracks():
+    rng = np.random.default_rng(0)
+    tracks = []
+    for track_id in range(3):
+        states = np.zeros((80, 6))
+        states[:, :2] = np.cumsum(rng.normal(0, 4, (80, 2)), axis=0) + rng.uniform(60, 180, 2)
+        states[:, 4] = 5
+        measurements = np.concatenate((np.full((80, 1), 0.9), states[:, :2], states[:, 4:6]), axis=1)
+        measurements[::7] = np.nan
+        tracks.append({"id": track_id, "start_frame": 10 * track_id, "age": 80,
+                       "states": states, "measurements": measurements})
+    return tracks
+
+
+def short_trails(effect: Effect) -> Effect:
+    # short trails fade out within the test tracks, though they'd be faster to redraw
+    effect.min_accumulated_length = 0
+    return effect
+
+
+@pytest.mark.parametrize("effect", [HighlightLine((255, 0, 0), 10, 2.0), NeonLine((0, 255, 0), 10, 1.0)])
+def test_accumulated_trails_warm_up(effect):
+    """
+    Tests that an accumulating effect that starts partway through the video, after warming up
+    on the frames before, draws the same as one that drew every frame, up to rounding.
+    """
+    tracks = trail_tracks()
+    background = np.random.default_rng(1).integers(0, 200, (240, 240, 3)).astype(np.uint8)
+    short_trails(effect).accumulate_trails()
+    everything = [effect.draw_tracks(background.copy(), [t for t in tracks if effect.relevant(t, i)], i)
+                  for i in range(100)]
+
+    effect.accumulate_trails()
+    for i in range(60 - effect.trail.lifetime, 60):
+        effect.draw_tracks(background.copy(), [t for t in tracks if effect.relevant(t, i)], i)
+    for i in range(60, 100):
+        drawn = effect.draw_tracks(background.copy(), [t for t in tracks if effect.relevant(t, i)], i)
+        assert np.abs(drawn.astype(int) - everything[i]).max() <= 1
+
+
+def test_accumulated_neon_draws_newest_segment():
+    """
+    Tests that the white core of the newest segment of an accumulated neon line is drawn whole,
+    and that segments fade out completely.
+    """
+    track = trail_tracks()[0]
+    effect = short_trails(NeonLine((0, 255, 0), 5, 1.0))
+    effect.accumulate_trails()
+    background = np.full((240, 240, 3), 50, dtype=np.uint8)
+    for i in range(40):
+        drawn = effect.draw_tracks(background.copy(), [track], i)
+    (x, y), (x2, y2) = track["states"][38][:2], track["states"][37][:2]
+    newest = cv2.line(np.zeros((240, 240), dtype=np.uint8), (int(x), int(y)), (int(x2), int(y2)),
+                      color=1, thickness=int(track["states"][0][4] / 2)) > 0
+    assert np.all(drawn[newest] == (255, 255, 255))
+
+    for i in range(40, 40 + effect.trail.lifetime + 1):
+        drawn = effect.draw_tracks(background.copy(), [], i)
+    assert np.array_equal(drawn, background)
+
+
+def test_accumulating_effects():
+    """
+    Tests that only the glowing effects can accumulate their trails, and only long ones, and that
+    drawing anything else with accumulate fails before reading the video.
+    """
+    assert accumulating_effects(Effect.min_accumulated_length - 1) == []
+    assert accumulating_effects(Effect.min_accumulated_length) == ["highlight_line", "neon_line"]
+    with pytest.raises(ValueError):
+        Line((255, 0, 0), 50, 1.0).accumulate_trails()
+    with pytest.raises(ValueError):
+        run_draw("no_such_project", "no_such_video.mp4", "out.mp4", "line", "#ff0000", 1.0, 50, 0,
+                 accumulate=True)
+
+
+def test_draw_segments_matches_lines():
+    """
+    Tests that drawing a batch of segments gives the same pixels as drawing each one with cv2.line,
+    and that segments thinner than a pixel are skipped.
+    """
+    rng = np.random.default_rng(0)
+    starts = rng.uniform(-20, 260, (50, 2))
+    ends = starts + rng.normal(0, 30, (50, 2))
+    thicknesses = rng.uniform(0, 12, 50)
+
+    expected = np.zeros((240, 240, 3), dtype=np.uint8)
+    for (x, y), (x2, y2), thickness in zip(starts, ends, thicknesses):
+        if int(thickness) > 0:
+            cv2.line(expected, (int(x), int(y)), (int(x2), int(y2)), color=(0, 255, 0), thickness=int(thickness))
+    drawn = draw_segments(np.zeros_like(expected), starts, ends, thicknesses, (0, 255, 0))
+    assert np.array_equal(drawn, expected)
+
+
+def test_fully_connected_matches_pairwise_lines():
+    """
+    Tests that FullyConnected draws a line between every pair of tracks, as nested loops would.
+    """
+    tracks = trail_tracks()
+    effect = FullyConnected((255, 0, 255), 5, 0.5)
+    frame_number = 20
+    tracks = [track for track in tracks if effect.relevant(track, frame_number)]
+    states = [track["states"][max(0, frame_number - track["start_frame"] - 1)] for track in tracks]
+
+    expected = np.zeros((240, 240, 3), dtype=np.uint8)
+    for i, (x1, y1, _, _, w1, _) in enumerate(states):
+        for (x2, y2, _, _, w2, _) in states[i + 1:]:
+            cv2.line(expected, (int(x1), int(y1)), (int(x2), int(y2)), color=(255, 0, 255),
+                     thickness=int(w2 * 0.5))
+    assert len(states) >= 3
+    assert np.array_equal(effect.draw_tracks(np.zeros_like(expected), tracks, frame_number), expected)
+
+
+@pytest.mark.parametrize("effect", [Line((255, 0, 0), 10, 1.0), TriColor(None, 10, 1.0),
+                                    Debug(None, 10, 1.0), HighlightLine((255, 0, 0), 10, 2.0),
+                                    NeonLine((0, 255, 0), 10, 1.0), Contrail((255, 0, 0), 10, 3),
+                                    FullyConnected((255, 0, 255), 10, 0.5),
+                                    FullyConnectedNeon((255, 0, 255), 10, 0.5)])
+def test_line_effects_at_start_frame(effect):
+    """
+    Tests that line effects draw nothing, instead of failing, on the first frame of a track,
+    before it has any segments.
+    """
+    track = trail_tracks()[1]
+    background = np.full((240, 240, 3), 50, dtype=np.uint8)
+    drawn = effect.draw_tracks(background.copy(), [track], track["start_frame"])
+    assert np.array_equal(drawn, background)
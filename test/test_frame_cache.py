@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+
+from traccc import frame_cache
+from traccc.frame_cache import FrameCache
+
+
+def fake_video(seed, frames=6):
+    return np.random.default_rng(seed).integers(0, 256, (frames, 4, 5, 3)).astype(np.uint8)
+
+
+@pytest.fixture
+def videos(tmp_path, monkeypatch):
+    """
+    Three small videos that are "decoded" by looking them up, counting how often that happens.
+    """
+    contents = {}
+    for seed in range(3):
+        path = str(tmp_path / f"video{seed}.mp4")
+        with open(path, 'wb') as f:
+            f.write(bytes([seed]) * 100)
+        contents[path] = fake_video(seed)
+    decodes = []
+
+    def read_video(input_file, start_frame=0, num_frames=None, reuse_buffer=False):
+        decodes.append(input_file)
+        end = None if num_frames is None else start_frame + num_frames
+        return (frame.copy() for frame in contents[input_file][start_frame:end])
+
+    monkeypatch.setattr(frame_cache, "read_video", read_video)
+    monkeypatch.setattr(frame_cache, "probe_frames",
+                        lambda input_file: (len(contents[input_file]), 4 * 5 * 3))
+    return contents, decodes
+
+
+def test_cached_frames_match(videos, tmp_path):
+    """
+    Tests that a video is decoded once, and then read back from the cache, whole or in part.
+    """
+    contents, decodes = videos
+    path = next(iter(contents))
+    cache = FrameCache(str(tmp_path / "cache"))
+    assert np.array_equal(np.stack(list(cache.read_video(path))), contents[path])
+    assert np.array_equal(np.stack(list(cache.read_video(path))), contents[path])
+    assert np.array_equal(np.stack([frame.copy() for frame in cache.read_video(path, 2, 3, reuse_buffer=True)]),
+                          contents[path][2:5])
+    assert decodes == [path]
+
+
+def test_partial_reads_dont_fill(videos, tmp_path):
+    """
+    Tests that only reading the whole video fills the cache, and that stopping early leaves nothing behind.
+    """
+    contents, decodes = videos
+    path = next(iter(contents))
+    cache = FrameCache(str(tmp_path / "cache"))
+    list(cache.read_video(path, 1))
+    next(cache.read_video(path))
+    assert cache.entries() == []
+    list(cache.read_video(path, 0, len(contents[path])))
+    assert len(cache.entries()) == 1
+
+
+def test_least_recently_used_is_evicted(videos, tmp_path):
+    """
+    Tests that the cache stays under its size limit by evicting the least recently used video.
+    """
+    contents, decodes = videos
+    first, second, third = contents
+    cache = FrameCache(str(tmp_path / "cache"), max_bytes=2 * contents[first].nbytes)
+    list(cache.read_video(first))
+    list(cache.read_video(second))
+    list(cache.read_video(first))  # first is now more recently used than second
+    list(cache.read_video(third))
+    assert len(cache.entries()) == 2
+    decodes.clear()
+    list(cache.read_video(first))
+    list(cache.read_video(second))
+    assert decodes == [second]
+
+
+def test_too_big_to_cache(videos, tmp_path, monkeypatch):
+    """
+    Tests that a video bigger than the cache is decoded without being hashed or cached.
+    """
+    contents, decodes = videos
+    path = next(iter(contents))
+
+    def file_hash(path):
+        raise AssertionError("hashed a video that can't be cached")
+
+    monkeypatch.setattr(frame_cache, "file_hash", file_hash)
+    cache = FrameCache(str(tmp_path / "cache"), max_bytes=contents[path].nbytes - 1)
+    assert np.array_equal(np.stack(list(cache.read_video(path))), contents[path])
+    assert cache.entries() == []
+
+
+def test_given_key_isnt_hashed_again(videos, tmp_path, monkeypatch):
+    """
+    Tests that a video read with the key worked out by cache_key, like the worker processes do,
+    is cached under that key without being hashed again.
+    """
+    contents, decodes = videos
+    path = next(iter(contents))
+    assert frame_cache.cache_key(path, 0) is None
+    assert frame_cache.cache_key(path, (contents[path].nbytes - 1) / 10**9) is None
+    key = frame_cache.cache_key(path, 1)
+
+    def file_hash(path):
+        raise AssertionError("hashed a video whose key was given")
+
+    monkeypatch.setattr(frame_cache, "file_hash", file_hash)
+    cache = FrameCache(str(tmp_path / "cache"))
+    for _ in range(2):
+        assert np.array_equal(np.stack(list(cache.read_video(path, key=key))), contents[path])
+    assert cache.entries() == [key]
+    assert decodes == [path]
@@ -2,8 +2,12 @@ from math import sqrt
 import pytest
 
 import numpy as np
+import torch
+from scipy.optimize import linear_sum_assignment
+from torchvision.ops import box_convert, nms
 
-from traccc.track import hungarian_matching, track
+from traccc.track import (OnlineTracker, euclidean_cost_matrix, euclidean_distance, filter_detections,
+                          hungarian_matching, track, track_states)
 from traccc.trackers import Track, AccelTrack
 
 
@@ -45,6 +49,28 @@ def test_reject_large_cost():
     assert cost == 10 + sqrt(2)
 
 
+def test_max_cost_pairs_are_never_considered():
+    """
+    Tests that pairs over max_cost don't affect the matching. Matching every pair and then
+    dropping the costly ones would give detection 0 to the farther track 1, since matching
+    track 0 to detection 1 (100) and track 1 to detection 0 (20) costs less than the other way
+    around (10 + 130), and then drop the pair of track 0.
+    """
+    tracks = [Track(0, np.array([0.9, 0, 0, 0, 0]), 0),
+              Track(1, np.array([0.9, 30, 0, 0, 0]), 0)]
+    detections = np.array([[0.9, 10, 0, 2, 2],
+                           [0.9, -100, 0, 2, 2]])
+    cost_matrix = euclidean_cost_matrix(track_states(tracks), detections)
+    dense_row_ind, dense_col_ind = linear_sum_assignment(cost_matrix)
+    reasonable = cost_matrix[dense_row_ind, dense_col_ind] <= 50
+    assert np.all(dense_row_ind[reasonable] == [1]) and np.all(dense_col_ind[reasonable] == [0])
+
+    cost, row_ind, col_ind = hungarian_matching(tracks, detections, max_cost=50)
+    assert np.all(row_ind == [0])
+    assert np.all(col_ind == [0])
+    assert cost == 10
+
+
 def test_more_detections_than_tracks():
     """
     This function tests that the correct matching is made when there are more
@@ -129,3 +155,116 @@ def test_no_track_switch(tracker):
     elif np.all(tracks[0].prev_states[0] == np.array([100, 0, 20, 20])):
         assert np.allclose(tracks[0].prev_states[-1],
                       np.array([0, 100, -20, 20]), atol=1e-2, rtol=0)
+
+
+def test_vectorized_matches_pairwise():
+    """
+    Tests that the vectorized cost matrix gives the same matching as calling the
+    cost function on every pair of track and detection.
+    """
+    def pairwise_distance(track, detection):  # not the default, so it's called on every pair
+        return euclidean_distance(track, detection)
+
+    rng = np.random.default_rng(0)
+    tracks = [Track(i, np.array([0.9, *rng.uniform(0, 500, 2), 5, 5]), 0) for i in range(20)]
+    detections = np.concatenate((rng.random((25, 1)), rng.uniform(0, 500, (25, 2)),
+                                 np.full((25, 2), 5)), axis=1)
+    for max_cost in [np.infty, 50]:
+        cost, row_ind, col_ind = hungarian_matching(tracks, detections, max_cost=max_cost)
+        pairwise_cost, pairwise_row_ind, pairwise_col_ind = hungarian_matching(
+            tracks, detections, cost_function=pairwise_distance, max_cost=max_cost)
+        assert np.all(row_ind == pairwise_row_ind)
+        assert np.all(col_ind == pairwise_col_ind)
+        assert np.isclose(cost, pairwise_cost)
+
+
+@pytest.mark.parametrize("tracker", [Track, AccelTrack])
+def test_batched_matches_filterpy(tracker):
+    """
+    Tests that running all the Kalman Filters at once in a TrackBank gives the same tracks
+    as running each track's own filterpy Kalman Filter.
+    """
+    rng = np.random.default_rng(0)
+    # a few objects moving in straight lines, with noise, missed detections and clutter
+    starts, velocities = rng.uniform(0, 500, (6, 2)), rng.uniform(-10, 10, (6, 2))
+    detections = []
+    for frame in range(40):
+        positions = starts + frame * velocities + rng.normal(0, 1, (6, 2))
+        seen = rng.random(6) > 0.2
+        clutter = rng.uniform(0, 500, (rng.integers(0, 3), 2))
+        centers = np.concatenate((positions[seen], clutter))
+        detections.append(np.concatenate((rng.random((len(centers), 1)), centers,
+                                          np.full((len(centers), 2), 5)), axis=1))
+
+    # tracks that die in the last frame may come out in a different order
+    batched = sorted(track(detections, tracker, max_cost=30), key=lambda t: t.id)
+    unbatched = sorted(track(detections, tracker, max_cost=30, batched=False), key=lambda t: t.id)
+    assert [t.id for t in batched] == [t.id for t in unbatched]
+    for b, u in zip(batched, unbatched):
+        assert b.start_frame == u.start_frame and b.age == u.age
+        assert np.allclose(b.prev_states, u.prev_states)
+        assert np.allclose(b.kf.x, u.kf.x) and np.allclose(b.kf.P, u.kf.P)
+        assert np.array_equal(b.prev_measurements, u.prev_measurements, equal_nan=True)
+
+
+def test_filter_detections_per_frame():
+    """
+    Tests that filtering the whole video at once keeps the same detections as running
+    NMS on every frame on its own, even when frames are split into many NMS calls.
+    """
+    rng = np.random.default_rng(0)
+    detections = []
+    for _ in range(50):
+        n = rng.integers(0, 12)
+        detections.append(np.concatenate((rng.random((n, 1)), rng.uniform(0, 100, (n, 2)),
+                                          rng.uniform(5, 30, (n, 2))), axis=1).astype(np.float32))
+
+    for boxes_per_call in [1, 7, 4096]:
+        filtered = filter_detections(detections, conf_threshold=0.2, iou_threshold=0.3,
+                                     boxes_per_call=boxes_per_call)
+        assert len(filtered) == len(detections)
+        for frame_detections, frame_filtered in zip(detections, filtered):
+            frame_detections = torch.from_numpy(frame_detections[frame_detections[:, 0] > 0.2])
+            xyxy = box_convert(frame_detections[:, 1:], in_fmt="cxcywh", out_fmt="xyxy")
+            expected = frame_detections[nms(xyxy, frame_detections[:, 0], iou_threshold=0.3)]
+            assert np.allclose(frame_filtered, expected.numpy())
+
+
+def test_gated_matches_dense():
+    """
+    Tests that matching only the pairs within max_cost, one connected component at a time,
+    gives the same matching as one dense assignment where the other pairs are too costly to pick.
+    """
+    rng = np.random.default_rng(1)
+    for _ in range(20):
+        states = np.concatenate((rng.uniform(0, 300, (30, 2)), np.zeros((30, 4))), axis=1)
+        detections = np.concatenate((rng.random((35, 1)), rng.uniform(0, 300, (35, 2)),
+                                     np.full((35, 2), 5)), axis=1)
+        cost, row_ind, col_ind = hungarian_matching(states, detections, max_cost=40)
+
+        cost_matrix = euclidean_cost_matrix(states, detections)
+        cost_matrix[cost_matrix > 40] = 1e6
+        dense_row_ind, dense_col_ind = linear_sum_assignment(cost_matrix)
+        reasonable = cost_matrix[dense_row_ind, dense_col_ind] <= 40
+        assert np.all(row_ind == dense_row_ind[reasonable])
+        assert np.all(col_ind == dense_col_ind[reasonable])
+        assert np.isclose(cost, cost_matrix[dense_row_ind, dense_col_ind][reasonable].sum())
+
+
+def test_online_tracker_finishes_tracks_when_they_die():
+    """
+    Tests that the online tracker hands back each track in the frame it dies, and keeps
+    only the active ones.
+    """
+    detections = [np.array([[0.99, 10 * i, 10 * i, 5, 5]]) for i in range(4)] + \
+                 [np.zeros((0, 5))] * 4
+    tracker = OnlineTracker(Track, death_time=2)
+    finished_at = {}
+    for frame_number, frame_detections in enumerate(detections):
+        active, finished = tracker.step(frame_detections)
+        for finished_track in finished:
+            finished_at[finished_track.id] = frame_number
+        assert all(active_track.active for active_track in active)
+    # last seen in frame 3, missing in frames 4, 5 and 6, which is more than the death time
+    assert finished_at == {0: 6}
+    assert tracker.finish() == []
@@ -1,5 +1,7 @@
-
 import os
+import pytest
+
+from traccc.pipeline import BackgroundWriter, prefetch
 
 def test_pipeline():
     """
@@ -10,3 +12,29 @@ def test_pipeline():
     os.system("python3 detect.py stormy --input test_assets/stormy.mp4")
     os.system("python3 track.py stormy")
     os.system("python3 draw.py stormy --input test/assets/stormy.mp4 --effect line --length 8 --colour blue --output test_stormy.mp4")
+
+
+def test_prefetch_keeps_order():
+    """
+    Tests that prefetching on a background thread yields every item, in order,
+    and passes exceptions on to the consumer.
+    """
+    assert list(prefetch(iter(range(100)), 4)) == list(range(100))
+
+    def broken_reader():
+        yield 0
+        raise ValueError("decoding failed")
+
+    with pytest.raises(ValueError):
+        list(prefetch(broken_reader(), 4))
+
+
+def test_background_writer():
+    """
+    Tests that all the items are written in order by the time the writer is closed.
+    """
+    written = []
+    with BackgroundWriter(written.append, 2) as writer:
+        for i in range(50):
+            writer.put(i)
+    assert written == list(range(50))
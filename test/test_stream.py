@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from traccc.draw import DelayedDrawer
+from traccc.effects import Dot, LaggingDot, Line
+from traccc.filters import standard_filter
+from traccc.track import OnlineTracker, track
+from traccc.trackers import Track
+
+
+def bouncing_detections():
+    # two balls, one of which is missed for a while, plus a short lived false positive
+    detections = []
+    for i in range(40):
+        frame_detections = [[0.99, 10 + 5 * i, 100 - abs(20 - i) * 4, 6, 6]]
+        if not 15 <= i < 18:
+            frame_detections.append([0.99, 200 - 4 * i, 50 + 2 * i, 8, 8])
+        if 25 <= i < 28:
+            frame_detections.append([0.9, 20, 200, 5, 5])
+        detections.append(np.array(frame_detections, dtype=float))
+    return detections
+
+
+@pytest.mark.parametrize("effect", [Dot((255, 0, 0), 5, 1.0),
+                                    LaggingDot((255, 0, 0), 5, 1.0),
+                                    Line((255, 0, 0), 5, 1.0)])
+@pytest.mark.parametrize("min_age", [0, 4, 10])
+def test_delayed_drawing_matches_offline(effect, min_age):
+    """
+    Tests that drawing frames while tracking is still running gives the same frames as
+    drawing the finished tracks afterwards.
+    """
+    detections = bouncing_detections()
+    frames = [np.zeros((240, 240, 3), dtype=np.uint8) for _ in detections]
+
+    tracks = [t.encode_in_dictionary() for t in track(detections, Track, max_cost=50)]
+    tracks = [t for t in tracks if standard_filter(t, min_age=min_age)]
+    offline = [effect.draw_tracks(frame.copy(), [t for t in tracks if effect.relevant(t, i)], i)
+               for i, frame in enumerate(frames)]
+
+    tracker = OnlineTracker(Track, max_cost=50)
+    drawer = DelayedDrawer(effect, min_age)
+    streamed = []
+    for frame, frame_detections in zip(frames, detections):
+        active, finished = tracker.step(frame_detections)
+        streamed.extend(drawer.push(frame.copy(), active, finished))
+    streamed.extend(drawer.flush(tracker.finish()))
+
+    assert len(streamed) == len(offline)
+    for streamed_frame, offline_frame in zip(streamed, offline):
+        assert np.array_equal(streamed_frame, offline_frame)
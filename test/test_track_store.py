@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from traccc.effects import Debug
+from traccc.track import track
+from traccc.track_store import export_yaml, load_tracks, save_tracks
+from traccc.trackers import Track, AccelTrack
+
+
+def crossing_detections():
+    detections = [np.array([[0.99, 10 * i, 10 * i, 5, 5], [0.99, 200 - 10 * i, 10 * i, 5, 5]])
+                  for i in range(12)]
+    detections[5] = np.zeros((0, 5))  # both balls are missed for a frame
+    return detections
+
+
+@pytest.mark.parametrize("tracker", [Track, AccelTrack])
+def test_binary_matches_yaml(tracker, tmp_path):
+    """
+    Tests that tracks loaded from the binary format hold the same data as the YAML export.
+    """
+    tracks = track(crossing_detections(), tracker)
+    save_tracks(str(tmp_path / "project.tracks"), tracks)
+    export_yaml(str(tmp_path / "project.tracks"), str(tmp_path / "project.yaml"))
+
+    binary_tracks = load_tracks(str(tmp_path / "project.tracks"))
+    yaml_tracks = load_tracks(str(tmp_path / "project.yaml"))
+    assert len(binary_tracks) == len(yaml_tracks) == len(tracks)
+    for original, binary, from_yaml in zip(tracks, binary_tracks, yaml_tracks):
+        assert binary["id"] == from_yaml["id"] == original.id
+        assert binary["start_frame"] == from_yaml["start_frame"] == original.start_frame
+        assert binary["age"] == from_yaml["age"] == original.age == len(binary["states"])
+        assert np.allclose(binary["states"], np.array(original.prev_states), atol=1e-3)
+        assert np.allclose(binary["measurements"], original.prev_measurements, equal_nan=True)
+        for measurement, from_yaml_measurement in zip(binary["measurements"], from_yaml["measurements"]):
+            assert np.isnan(measurement[0]) == (from_yaml_measurement is None)
+
+
+def test_debug_effect_with_binary_tracks(tmp_path):
+    """
+    Tests that the debug effect, which draws missed measurements, works on binary tracks.
+    """
+    tracks = track(crossing_detections(), Track)
+    save_tracks(str(tmp_path / "project.tracks"), tracks)
+    effect = Debug((255, 0, 0), 15, 0.5)
+    frame = np.zeros((240, 240, 3), dtype=np.uint8)
+    for track_dict in load_tracks(str(tmp_path / "project.tracks")):
+        frame = effect.draw(frame, track_dict, track_dict["start_frame"] + track_dict["age"] - 1)
+    assert frame.any()
@@ -0,0 +1,80 @@
+import shutil
+
+import numpy as np
+import pytest
+
+from traccc.video import VideoWriter, display_size, encoder_settings, read_video, split_frames
+
+
+@pytest.mark.parametrize("frame_count, num_shards", [(120, 1), (120, 7), (5, 8), (1001, 64)])
+def test_split_frames(frame_count, num_shards):
+    """
+    Test that the shards cover every frame exactly once, in order, with nearly equal lengths.
+    """
+    shards = split_frames(frame_count, num_shards)
+    assert len(shards) == min(frame_count, num_shards)
+    next_frame = 0
+    for start_frame, num_frames in shards:
+        assert start_frame == next_frame
+        next_frame += num_frames
+    assert next_frame == frame_count
+    lengths = [num_frames for _, num_frames in shards]
+    assert max(lengths) - min(lengths) <= 1
+
+
+@pytest.mark.parametrize("tag, size", [(None, (640, 360)),
+                                       ({"@key": "rotate", "@value": "180"}, (640, 360)),
+                                       ([{"@key": "language", "@value": "und"},
+                                         {"@key": "rotate", "@value": "90"}], (360, 640))])
+def test_display_size(tag, size):
+    """
+    Test that videos stored sideways have their width and height swapped.
+    """
+    metadata = {"video": {"@width": "640", "@height": "360"}}
+    if tag is not None:
+        metadata["video"]["tag"] = tag
+    assert display_size(metadata) == size
+
+
+@pytest.mark.parametrize("side_data, size", [
+    (None, (640, 360)),
+    ({"side_data": {"@side_data_type": "Display Matrix", "@rotation": "-90"}}, (360, 640)),
+    ({"side_data": [{"@side_data_type": "Stereo 3D"},
+                    {"@side_data_type": "Display Matrix", "@rotation": "180"}]}, (640, 360))])
+def test_display_size_side_data(side_data, size):
+    """
+    Test that the rotation in the display matrix side data, where newer versions of ffprobe
+    report it, swaps the width and height too.
+    """
+    metadata = {"video": {"@width": "640", "@height": "360", "side_data_list": side_data}}
+    assert display_size(metadata) == size
+
+
+@pytest.mark.parametrize("codec, expected", [("libx264", ("veryfast", 23)), ("libx265", ("veryfast", 23)),
+                                             ("mpeg4", (None, None))])
+def test_encoder_settings(codec, expected):
+    """
+    Test that only the encoders with presets and a crf get them by default, and that given
+    settings are kept.
+    """
+    assert encoder_settings(codec) == expected
+    assert encoder_settings(codec, "slow", 30) == ("slow", 30)
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+@pytest.mark.parametrize("reuse_buffer", [False, True])
+def test_video_writer_round_trip(tmp_path, reuse_buffer):
+    """
+    Test that frames piped to ffmpeg come back out in order, close to what went in,
+    whether or not they are decoded into a shared buffer.
+    """
+    frames = [np.full((64, 96, 3), (10 * i, 255 - 10 * i, 128), dtype=np.uint8) for i in range(20)]
+    output = str(tmp_path / "out.mp4")
+    with VideoWriter(output, 96, 64, 30, crf=0) as writer:
+        for frame in frames:
+            writer.write(frame)
+
+    decoded = [frame.copy() for frame in read_video(output, reuse_buffer=reuse_buffer)]
+    assert len(decoded) == len(frames)
+    for frame, decoded_frame in zip(frames, decoded):
+        assert np.abs(frame.astype(int) - decoded_frame).max() <= 8
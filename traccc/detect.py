@@ -2,13 +2,20 @@
 Used for detecting objects in a video, and saving to an output.
 """
 import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Optional
 import os
 import gradio as gr
 
 import skvideo.io
+import torch
 
-from traccc.detectors import HuggingFaceDETR, PretrainedRN50Detector, OWLVITZeroShot
+from traccc.detection_store import (DetectionWriter, detections_path, index_path, load_detections,
+                                    manifest_path, read_manifest)
+from traccc.detectors import Detector, HuggingFaceDETR, PretrainedRN50Detector, OWLVITZeroShot, ScaledDetector
+from traccc.frame_cache import cache_key, open_video
+from traccc.video import split_frames
 
 model_selector = {
     "DETR": HuggingFaceDETR,
@@ -16,8 +23,93 @@ model_selector = {
     "OWLVIT": OWLVITZeroShot
 }
 
+def load_detector(model: str, batch_size: int = 4, scale: float = 1.0,
+                  tile_size: Optional[int] = None) -> Detector:
+    """
+    Loads a detector, which runs on downscaled frames if scale is below 1, and on overlapping
+    tiles of the (downscaled) frames if tile_size is set.
+    """
+    detector = model_selector[model](batch_size=batch_size)
+    if scale == 1 and tile_size is None:
+        return detector
+    return ScaledDetector(detector, scale=scale, tile_size=tile_size)
+
+
+def detect_shard(model: str, input_file: str, start_frame: int, num_frames: int, filename: str,
+                 prompts: Optional[List[str]], batch_size: int, prefetch_depth: int,
+                 num_threads: int, resume: bool, cache_gb: float = 0, scale: float = 1.0,
+                 tile_size: Optional[int] = None, video_key: Optional[str] = None) -> int:
+    """
+    Runs a detector over a contiguous range of frames, in a worker process. video_key is the
+    video's key in the frame cache, worked out once for all the workers.
+    Returns:
+        The number of frames that were detected.
+    """
+    torch.set_num_threads(num_threads)
+    committed = read_manifest(filename)["frames"] if resume else 0
+    if committed < num_frames:
+        detector = load_detector(model, batch_size, scale, tile_size)
+        vid_generator = open_video(input_file, start_frame + committed, num_frames - committed,
+                                   cache_gb=cache_gb, key=video_key)
+        detector.detect(vid_generator, filename=filename, frame_count=num_frames - committed,
+                        prompts=prompts, prefetch_depth=prefetch_depth, resume=resume)
+    return read_manifest(filename)["frames"]
+
+
+def merge_detections(shard_files: List[str], filename: str) -> None:
+    """
+    Concatenates the detections of several detection stores, in order, into one detection store.
+    """
+    with DetectionWriter(filename) as store:
+        for shard_file in shard_files:
+            for frame_detections in load_detections(shard_file):
+                store.write(frame_detections)
+
+
+def run_detect_sharded(name: str, model: str, input_file: str, frame_count: int,
+                       prompts: Optional[List[str]], batch_size: int, prefetch_depth: int,
+                       workers: int, threads_per_worker: int, resume: bool, cache_gb: float = 0,
+                       scale: float = 1.0, tile_size: Optional[int] = None) -> None:
+    """
+    Splits the video into contiguous frame ranges and detects each of them in its own process,
+    with its own detector. Each worker seeks to the start of its range, and writes to its own
+    detection store, so each range can be resumed on its own.
+    """
+    shards = split_frames(frame_count, workers)
+    shard_files = [f"{detections_path(name)}.shard{i}" for i in range(len(shards))]
+    video_key = cache_key(input_file, cache_gb)
+    # spawn, so the workers don't inherit torch's threads or CUDA state
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=len(shards), mp_context=context) as pool:
+        futures = [pool.submit(detect_shard, model, input_file, start_frame, num_frames, shard_file,
+                               prompts, batch_size, prefetch_depth, threads_per_worker, resume,
+                               cache_gb, scale, tile_size, video_key)
+                   for (start_frame, num_frames), shard_file in zip(shards, shard_files)]
+        frames_detected = [future.result() for future in futures]
+
+    # the frame count from ffprobe can be off by a bit, but only the last shard can come up short.
+    # This only catches a truncated shard, a seek that lands on the wrong frame still decodes
+    # num_frames frames
+    for (start_frame, num_frames), detected in zip(shards[:-1], frames_detected[:-1]):
+        if detected != num_frames:
+            raise RuntimeError(f"Expected {num_frames} frames starting at frame {start_frame}, " +
+                               f"but the video ended after {detected}. {input_file} has fewer " +
+                               "frames than ffprobe reports, run detection with a single worker instead.")
+
+    merge_detections(shard_files, detections_path(name))
+    for shard_file in shard_files:
+        os.remove(shard_file)
+        os.remove(manifest_path(shard_file))
+        if os.path.exists(index_path(shard_file)):
+            os.remove(index_path(shard_file))
+
+
 def run_detect(name: str, model: str, input_file: str, 
-               prompts: Optional[List[str]] = None, progress=gr.Progress(track_tqdm=True)):
+               prompts: Optional[List[str]] = None, batch_size: int = 4,
+               prefetch_depth: int = 8, workers: int = 1,
+               threads_per_worker: Optional[int] = None, resume: bool = False,
+               cache_gb: float = 0, scale: float = 1.0, tile_size: Optional[int] = None,
+               progress=gr.Progress(track_tqdm=True)):
     """
     Sets up the video reading and runs the detector.
     Args:
@@ -25,19 +117,52 @@ def run_detect(name: str, model: str, input_file: str,
         model: Model name to use for detection.
         input_file: Path to the input video file.
         prompts: List of prompts for detection.
+        batch_size: Number of frames passed through the model at once.
+        prefetch_depth: Number of frames decoded ahead of the model, on a separate thread.
+        workers: Number of processes to split the video between, each with its own detector.
+        threads_per_worker: Number of threads each worker process gives to PyTorch. Defaults
+            to splitting the CPU cores evenly between the workers.
+        resume: Continue an interrupted run from its last committed frame, instead of
+            starting over.
+        cache_gb: Size limit of the decoded-frame cache in gigabytes, 0 to decode without it.
+            Decoding the whole video puts it in the cache, for the next stage to read back.
+        scale: Factor the frames are downscaled by before detection, for speed. Boxes are
+            mapped back to the full resolution frames.
+        tile_size: Side of the overlapping square tiles the (downscaled) frames are split
+            into, each detected on its own, to find small objects. None to detect whole frames.
         progress: Gradio progress tracker.
     """
-    vid_generator = skvideo.io.vreader(input_file)
     metadata = skvideo.io.ffprobe(input_file)
     frame_count = int(metadata['video']['@nb_frames'])
 
     print(f"frame_count: {frame_count}")
-    detector = model_selector[model]()
-
     if not os.path.exists(f"internal"):
         os.system("mkdir internal")  # make internal if it doesn't exist
+
+    filename = detections_path(name)
+    manifest = read_manifest(filename) if resume else {"frames": 0, "complete": False}
+    if manifest["complete"]:
+        return f"Detection for project {name} was already complete."
+
+    if workers > 1:
+        if threads_per_worker is None:
+            threads_per_worker = max(1, os.cpu_count() // workers)
+        run_detect_sharded(name, model, input_file, frame_count, prompts, batch_size,
+                           prefetch_depth, workers, threads_per_worker, resume, cache_gb,
+                           scale, tile_size)
+        return f"Completed detection for project {name} using {model} with {workers} workers."
+
+    if threads_per_worker is not None:
+        torch.set_num_threads(threads_per_worker)
+    start_frame = manifest["frames"]
+    if start_frame > 0:
+        print(f"resuming from frame {start_frame}")
+
+    vid_generator = open_video(input_file, start_frame, cache_gb=cache_gb)
+    detector = load_detector(model, batch_size, scale, tile_size)
     detector.detect(
-        vid_generator, filename=f"internal/{name}.npz", frame_count=frame_count, prompts=prompts)
+        vid_generator, filename=filename, frame_count=frame_count - start_frame, prompts=prompts,
+        prefetch_depth=prefetch_depth, resume=resume)
     return f"Completed detection for project {name} using {model}."
 
 if __name__ == "__main__":
@@ -46,6 +171,23 @@ if __name__ == "__main__":
     parser.add_argument("name", help="name of the project to be tracked.")
     parser.add_argument("--model", help="choice of model", default="DETR")
     parser.add_argument("--input", help="video file to be used", default=None)
+    parser.add_argument(
+        "--batch_size", help="number of frames passed through the model at once", default=4)
+    parser.add_argument(
+        "--prefetch", help="number of frames decoded ahead of the model, 0 to disable", default=8)
+    parser.add_argument(
+        "--workers", help="number of processes to split the video between", default=1)
+    parser.add_argument(
+        "--threads_per_worker", help="number of threads each process uses, defaults to an even split of the cores",
+        default=None)
+    parser.add_argument(
+        "--resume", help="continue an interrupted run from its last committed frame", action="store_true")
+    parser.add_argument(
+        "--cache_gb", help="size limit of the decoded-frame cache in gigabytes, 0 to disable", default=0)
+    parser.add_argument(
+        "--scale", help="factor the frames are downscaled by before detection", default=1.0)
+    parser.add_argument(
+        "--tile_size", help="detect on overlapping square tiles of this size, for small objects", default=None)
 
 
     # input sanitization
@@ -59,4 +201,9 @@ if __name__ == "__main__":
     assert os.path.exists(input_file), f"Input file {input_file} does not exist."
     assert args.model in model_selector, f"Model {args.model} isn't supported"
 
-    run_detect(name, args.model, input_file)
+    threads_per_worker = None if args.threads_per_worker is None else int(args.threads_per_worker)
+    run_detect(name, args.model, input_file, batch_size=int(args.batch_size),
+               prefetch_depth=int(args.prefetch), workers=int(args.workers),
+               threads_per_worker=threads_per_worker, resume=args.resume,
+               cache_gb=float(args.cache_gb), scale=float(args.scale),
+               tile_size=None if args.tile_size is None else int(args.tile_size))
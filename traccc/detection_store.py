@@ -0,0 +1,230 @@
+"""
+Append-only storage for detections, written in chunks while detection is still running.
+The detections are stored as one flat array of float32 (frame, c, x, y, w, h) rows, sorted by
+frame, with a small JSON manifest next to them recording how much of the file has been committed.
+Once a store is complete, an index of where each frame's rows start is written alongside it,
+so the store can be memory-mapped and sliced frame by frame.
+"""
+import argparse
+import json
+import os
+from collections.abc import Sequence
+from typing import Optional
+
+import numpy as np
+
+COLUMNS = ("frame", "c", "x", "y", "w", "h")
+ROW_BYTES = len(COLUMNS) * np.dtype(np.float32).itemsize
+
+
+def detections_path(name: str) -> str:
+    """
+    Where the detections of a project are stored.
+    """
+    return f"internal/{name}.detections"
+
+
+def find_detections(name: str) -> Optional[str]:
+    """
+    Finds the detections of a project, falling back to the .npz files of older versions.
+    Returns:
+        The path of the detections, or None if the project has no detections.
+    """
+    path = detections_path(name)
+    if os.path.exists(manifest_path(path)):
+        return path
+    if os.path.exists(f"internal/{name}.npz"):
+        return f"internal/{name}.npz"
+    return None
+
+
+def manifest_path(path: str) -> str:
+    return path + ".json"
+
+
+def index_path(path: str) -> str:
+    return path + ".index"
+
+
+def read_manifest(path: str) -> dict:
+    """
+    Reads the manifest of a detection store. A store that was never started has nothing committed.
+    """
+    if not os.path.exists(manifest_path(path)):
+        return {"frames": 0, "rows": 0, "complete": False}
+    with open(manifest_path(path), 'r') as f:
+        return json.load(f)
+
+
+class DetectionWriter:
+    """
+    Appends the detections of each frame to a detection store, in order.
+    Rows are buffered and committed every chunk_size frames: they are flushed to disk first,
+    and only then is the manifest updated, so a crash loses at most one chunk.
+    """
+
+    def __init__(self, path: str, chunk_size: int = 256, resume: bool = False):
+        """
+        Args:
+            path: Path of the detection store.
+            chunk_size: Number of frames buffered in memory between commits.
+            resume: If True, keep the committed frames of an interrupted run and append
+                after them. Otherwise, start from scratch.
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+        manifest = read_manifest(path) if resume else {"frames": 0, "rows": 0}
+        self.frames = manifest["frames"]  # committed frames
+        self.rows = manifest["rows"]  # committed rows
+
+        self.file = open(path, 'ab' if resume and os.path.exists(path) else 'wb')
+        if os.path.exists(index_path(path)):
+            os.remove(index_path(path))  # the index is rewritten when the store is complete
+        # anything past the last commit is from a chunk that didn't finish
+        self.file.truncate(self.rows * ROW_BYTES)
+        self.file.seek(self.rows * ROW_BYTES)
+        self.buffer = []
+        self.buffered_frames = 0
+        self._write_manifest(complete=False)
+
+    @property
+    def frames_committed(self) -> int:
+        return self.frames
+
+    def write(self, frame_detections: np.ndarray) -> None:
+        """
+        Appends the detections of the next frame.
+        Args:
+            frame_detections: [N, 5] array of detections in (c, x, y, w, h) format.
+        """
+        rows = np.empty((len(frame_detections), len(COLUMNS)), dtype=np.float32)
+        # float32 holds frame numbers exactly up to 2**24, about 77 hours at 60 fps
+        rows[:, 0] = self.frames + self.buffered_frames
+        rows[:, 1:] = frame_detections
+        self.buffer.append(rows)
+        self.buffered_frames += 1
+        if self.buffered_frames >= self.chunk_size:
+            self.commit()
+
+    def commit(self) -> None:
+        """
+        Writes the buffered frames to disk and records them in the manifest.
+        """
+        if self.buffered_frames == 0:
+            return
+        rows = np.concatenate(self.buffer)
+        self.file.write(rows.tobytes())
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.frames += self.buffered_frames
+        self.rows += len(rows)
+        self.buffer = []
+        self.buffered_frames = 0
+        self._write_manifest(complete=False)
+
+    def close(self, complete: bool = True) -> None:
+        """
+        Commits what's left, and marks the store as complete.
+        """
+        self.commit()
+        self.file.close()
+        if complete:
+            frame_offsets(load_rows(self.path), self.frames).tofile(index_path(self.path))
+        self._write_manifest(complete=complete)
+
+    def _write_manifest(self, complete: bool) -> None:
+        manifest = {
+            "columns": COLUMNS,
+            "frames": self.frames,
+            "rows": self.rows,
+            "complete": complete
+        }
+        temp_path = manifest_path(self.path) + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, manifest_path(self.path))  # atomic, never half written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # an interrupted run keeps its committed frames, and can be resumed
+        self.close(complete=exc_type is None)
+
+
+def load_rows(path: str) -> np.ndarray:
+    """
+    Memory-maps the committed rows of a detection store, as an [N, 6] array of (frame, c, x, y, w, h).
+    """
+    rows = read_manifest(path)["rows"]
+    if rows == 0:
+        return np.empty((0, len(COLUMNS)), dtype=np.float32)  # can't memory-map an empty file
+    return np.memmap(path, dtype=np.float32, mode='r', shape=(rows, len(COLUMNS)))
+
+
+def frame_offsets(rows: np.ndarray, frames: int) -> np.ndarray:
+    """
+    Finds where each frame's rows start in rows, which are sorted by frame.
+    Returns:
+        An array of frames + 1 offsets; the rows of frame i are rows[offsets[i]:offsets[i + 1]].
+    """
+    return np.searchsorted(rows[:, 0], np.arange(frames + 1), side="left").astype(np.int64)
+
+
+class DetectionFile(Sequence):
+    """
+    The detections of a video, memory-mapped from a detection store.
+    Indexing with a frame number gives an [N, 5] view of that frame's detections in
+    (c, x, y, w, h) format, without reading the rest of the file.
+    """
+
+    def __init__(self, path: str):
+        manifest = read_manifest(path)
+        self.rows = load_rows(path)
+        self.frames = manifest["frames"]
+        if manifest["complete"] and os.path.exists(index_path(path)):
+            self.offsets = np.fromfile(index_path(path), dtype=np.int64)
+        else:  # still being written, find the frames ourselves
+            self.offsets = frame_offsets(self.rows, self.frames)
+
+    def __len__(self) -> int:
+        return self.frames
+
+    def __getitem__(self, frame_number: int) -> np.ndarray:
+        if not -self.frames <= frame_number < self.frames:
+            raise IndexError(f"frame {frame_number} is out of range for {self.frames} frames")
+        frame_number %= self.frames
+        return self.rows[self.offsets[frame_number]:self.offsets[frame_number + 1], 1:]
+
+
+def load_detections(path: str) -> Sequence[np.ndarray]:
+    """
+    Loads detections, either from a detection store or from an .npz file of older versions.
+    Returns:
+        A sequence of ndarray, where each ndarray is a [N, 5] array of the detections in a frame,
+        in (c, x, y, w, h) format.
+    """
+    if path.endswith(".npz"):
+        with np.load(path) as detections:
+            return [detections[f"arr_{i}"] for i in range(len(detections.files))]
+    return DetectionFile(path)
+
+
+def convert_npz(npz_path: str, path: str) -> None:
+    """
+    Converts an .npz of detections from older versions, one array per frame, into a detection store.
+    """
+    with DetectionWriter(path) as store:
+        for frame_detections in load_detections(npz_path):
+            store.write(frame_detections)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Converts the detections of a project from the old .npz format.")
+    parser.add_argument("name", help="name of the project to be converted.")
+    args = parser.parse_args()
+
+    assert os.path.exists(f"internal/{args.name}.npz"), f"Could not find internal/{args.name}.npz"
+    convert_npz(f"internal/{args.name}.npz", detections_path(args.name))
+    print(f"Converted internal/{args.name}.npz to {detections_path(args.name)}")
@@ -1,19 +1,23 @@
 """Implements various detectors for object detection in videos."""
 from abc import ABC
+from math import ceil
 
+import cv2
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
 import torch.functional as F
-from torchvision.io import write_video
 from torchvision.models.detection import fasterrcnn_resnet50_fpn
 from torchvision.ops import box_convert
-from torchvision.transforms import Normalize
 from torchvision.utils import draw_bounding_boxes
 from tqdm import tqdm
-from transformers import DetrFeatureExtractor, DetrForObjectDetection, pipeline
-from typing import List
-from PIL import Image
+from transformers import DetrFeatureExtractor, DetrForObjectDetection, OwlViTForObjectDetection, OwlViTProcessor
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
+
+from traccc.detection_store import DetectionWriter
+from traccc.pipeline import BackgroundWriter, prefetch
+from traccc.track import frame_nms
+from traccc.video import VideoWriter
 
 SPORTS_BALL_COCO_CLASS_IDX = 37
 
@@ -31,127 +35,274 @@ def show(imgs):
         axs[0, i].set(xticklabels=[], yticklabels=[], xticks=[], yticks=[])
 
 
+def batch_frames(video, batch_size: int) -> Iterator[List[np.ndarray]]:
+    """
+    Groups the frames coming out of a video generator into lists of batch_size frames.
+    The last batch holds whatever frames are left over, so it may be smaller.
+    """
+    batch = []
+    for frame in video:
+        batch.append(frame)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+class FramePreprocessor:
+    """
+    Turns batches of uint8 HWC frames into normalized NCHW float tensors on the device,
+    doing the work of the HuggingFace feature extractors without per-image numpy passes.
+    The normalization constants are built once and reused for every batch.
+    """
+
+    def __init__(self, mean: Sequence[float], std: Sequence[float], device: str,
+                 resize: Optional[Callable[[int, int], Tuple[int, int]]] = None):
+        """
+        Args:
+            mean: Per-channel mean, for pixel values in the range [0, 1].
+            std: Per-channel standard deviation, for pixel values in the range [0, 1].
+            device: Device that the tensors are produced on.
+            resize: Maps the (height, width) of a frame to the (height, width) fed to the
+                model. Frames are not resized if this is None.
+        """
+        # fold the division by 255 into the constants
+        self.mean = torch.tensor(mean, device=device).view(1, 3, 1, 1) * 255
+        self.std = torch.tensor(std, device=device).view(1, 3, 1, 1) * 255
+        self.device = device
+        self.resize = resize
+
+    def __call__(self, frames: List[np.ndarray]) -> torch.Tensor:
+        # move the frames over as uint8, it's a quarter of the bytes of float32
+        batch = torch.from_numpy(np.stack(frames)).to(self.device)
+        batch = torch.moveaxis(batch, 3, 1).float()  # move channels to position 1
+        if self.resize is not None:
+            size = self.resize(*batch.shape[2:])
+            if size != tuple(batch.shape[2:]):
+                batch = torch.nn.functional.interpolate(
+                    batch, size=size, mode="bilinear", align_corners=False, antialias=True)
+        return (batch - self.mean) / self.std
+
+
 class Detector(ABC):
     def __init__(self):
         raise NotImplementedError
 
-    def detect_video(self, video, bbox_format="cxcywh", frame_count: int = None, prompts: List[str] = None):
+    def embed_prompts(self, prompts: List[str]) -> None:
+        """
+        Prepares the text prompts for a run. Detectors with a fixed set of classes ignore them.
+        """
+
+    def detect_batch(self, frames: List[np.ndarray], bbox_format="cxcywh") -> List[np.ndarray]:
         raise NotImplementedError
 
-    def detect(self, video, filename="internal/detections.npz",
+    def iter_detections(self, video, bbox_format="cxcywh", frame_count: int = None) -> Iterator[np.ndarray]:
+        """
+        Runs the model on the video a batch at a time, yielding the detections of each frame in order.
+        """
+        batches = batch_frames(video, self.batch_size)
+        if frame_count is not None:
+            num_batches = ceil(frame_count / self.batch_size)  # last batch may be partial
+            batches = (frames for frames, _ in zip(batches, tqdm(range(num_batches))))
+        for frames in batches:
+            yield from self.detect_batch(frames, bbox_format=bbox_format)
+
+    @torch.no_grad()
+    def detect_video(self, video, bbox_format="cxcywh", frame_count: int = None, prompts: List[str] = None):
+        """
+        video is a generator
+        output is a list of numpy arrays denoting bounding boxes for each frame
+        """
+        if prompts is not None:
+            self.embed_prompts(prompts)
+        print("detecting balls in the video")
+        return list(self.iter_detections(video, bbox_format=bbox_format, frame_count=frame_count))
+
+    @torch.no_grad()
+    def detect(self, video, filename="internal/detections",
                frame_count: int = None,
                prompts: List[str] = None,
+               prefetch_depth: int = 0,
+               resume: bool = False,
                progress=None):
-        if prompts is None:
-            detections = self.detect_video(video, frame_count=frame_count)
-        else:
-            detections = self.detect_video(video, frame_count=frame_count, prompts=prompts)
-        np.savez(filename, *detections)
+        """
+        Detects objects in the video and appends them to a detection store as frames finish.
+        Decoding, inference and writing each run on their own thread, connected by bounded queues.
+        Args:
+            video: a generator that goes through frames of the video.
+            filename: the detection store the detections are written to.
+            frame_count: number of frames in the video.
+            prompts: list of strings describing objects, for zero-shot detectors.
+            prefetch_depth: number of frames decoded ahead of the model. 0 decodes on the
+                inference thread.
+            resume: if True, append to the frames already committed to filename by an
+                interrupted run. video must then start at the first frame that wasn't committed.
+        """
+        if prompts is not None:
+            self.embed_prompts(prompts)
+        if prefetch_depth > 0:
+            video = prefetch(video, prefetch_depth)
+
+        print("detecting balls in the video")
+        with DetectionWriter(filename, resume=resume) as store, \
+                BackgroundWriter(store.write, self.batch_size * 2) as writer:
+            for frame_detections in self.iter_detections(video, frame_count=frame_count):
+                writer.put(frame_detections)
         return f"Successfully saved detections in {filename}"
 
-    def display_detections_in_video(self, video: torch.Tensor, outfile: str) -> None:
+    def display_detections_in_video(self, video: torch.Tensor, outfile: str, fps: float = 60.0) -> None:
         detections = self.detect_video(video, bbox_format="xyxy")
         print("drawing bounding boxes")
-        for i, frame in tqdm(enumerate(video)):
-            # draw boxes on single frame
-            # write frame to mp4
-            CHW = torch.permute(frame, (2, 0, 1))  # move channels to front
-            video[i] = torch.permute(draw_bounding_boxes(CHW, torch.Tensor(
-                detections[i]), colors="red", width=5), (1, 2, 0))  # move C back to end, save in tensor
-        print("writing the video")
-        write_video(outfile, video, video_codec="h264", fps=60.0)
+        height, width = video.shape[1:3]
+        # each frame goes to the encoder as soon as it's drawn, instead of collecting them all first
+        with VideoWriter(outfile, width, height, fps) as writer:
+            for i, frame in tqdm(enumerate(video)):
+                # draw boxes on single frame
+                CHW = torch.permute(frame, (2, 0, 1))  # move channels to front
+                boxed = draw_bounding_boxes(CHW, torch.Tensor(detections[i]), colors="red", width=5)
+                writer.write(torch.permute(boxed, (1, 2, 0)).numpy())  # move C back to end
 
 
 class PretrainedRN50Detector(Detector):
-    def __init__(self):
+    def __init__(self, batch_size: int = 4):
+        """
+        Args:
+            batch_size: Number of frames passed through the model at once.
+        """
         self.model = fasterrcnn_resnet50_fpn(pretrained=True, num_classes=91,
                                              pretrained_backbone=True)
+        self.batch_size = batch_size
 
         self.device = "cuda:0" if torch.cuda.is_available() else "cpu"
         self.model.eval().to(self.device)
+        self.preprocessor = FramePreprocessor((0, 0, 0), (1, 1, 1), self.device)  # 0 to 1
 
     @torch.no_grad()
-    def detect_video(self, video, bbox_format="cxcywh", frame_count: int = None, prompts: str = None):
+    def detect_batch(self, frames: List[np.ndarray], bbox_format="cxcywh") -> List[np.ndarray]:
         """
-        video is a generator
-        output is a list of numpy arrays denoting bounding boxes for each frame
+        Runs the model on a batch of frames at once.
+        Args:
+            frames: List of HWC uint8 RGB frames, all of the same size.
+            bbox_format: format of the bounding boxes, either "cxcywh" or "xyxy".
+        Returns:
+            List of [N, 5] arrays of detections, one for each frame, in order.
         """
-        # TODO batch these calls
-        video_detections = []  # list of list of detections
-        ZeroOne = Normalize((0, 0, 0), (255, 255, 255))  # divide to 0 to 1
-        # num_batches = len(video) // batch_size  # last frames may be cut
+        batch = self.preprocessor(frames)
+        batched_result = self.model(list(batch))
 
-        print("detecting balls in the video")
-        # for frame in tqdm(video, total=frame_count):
-        for frame, _ in zip(video, tqdm(range(frame_count))):
-            batch = torch.Tensor(frame).unsqueeze(0)
-            batch = torch.moveaxis(batch, 3, 1)  # move channels to position 1
-            batch = ZeroOne(batch.float())
-            batched_result = self.model(batch.to(self.device))
-            for res in batched_result:
-                xyxy = res["boxes"][res["labels"] == SPORTS_BALL_COCO_CLASS_IDX]
-                conf = res["scores"][res["labels"] == SPORTS_BALL_COCO_CLASS_IDX]
-                xywh = box_convert(xyxy, in_fmt="xyxy", out_fmt=bbox_format)
-                cxywh = torch.cat((conf.unsqueeze(1), xywh),
-                                  dim=1)  # add confidences
-                video_detections.append(cxywh.cpu().numpy())
-        return video_detections
+        batch_detections = []
+        for res in batched_result:
+            xyxy = res["boxes"][res["labels"] == SPORTS_BALL_COCO_CLASS_IDX]
+            conf = res["scores"][res["labels"] == SPORTS_BALL_COCO_CLASS_IDX]
+            xywh = box_convert(xyxy, in_fmt="xyxy", out_fmt=bbox_format)
+            cxywh = torch.cat((conf.unsqueeze(1), xywh),
+                              dim=1)  # add confidences
+            batch_detections.append(cxywh.cpu().numpy())
+        return batch_detections
 
 
 class HuggingFaceDETR(Detector):
-    def __init__(self):
+    def __init__(self, batch_size: int = 4):
+        """
+        Args:
+            batch_size: Number of frames passed through the model at once.
+        """
         self.feature_extractor = DetrFeatureExtractor.from_pretrained(
             'facebook/detr-resnet-101-dc5')
         self.model = DetrForObjectDetection.from_pretrained(
             'facebook/detr-resnet-101-dc5')
+        self.batch_size = batch_size
 
         self.device = "cuda:0" if torch.cuda.is_available() else "cpu"
         self.model.eval().to(self.device)
+        self.preprocessor = FramePreprocessor(self.feature_extractor.image_mean,
+                                              self.feature_extractor.image_std,
+                                              self.device, resize=self.resized_shape)
+
+    def resized_shape(self, height: int, width: int) -> Tuple[int, int]:
+        """
+        The (height, width) the feature extractor would resize a frame to; the shortest
+        edge is scaled to the extractor's size, unless that pushes the longest edge past max_size.
+        """
+        size = self.feature_extractor.size
+        if isinstance(size, dict):
+            size, max_size = size["shortest_edge"], size["longest_edge"]
+        else:
+            max_size = self.feature_extractor.max_size
+        shortest, longest = min(height, width), max(height, width)
+        if max_size is not None and longest / shortest * size > max_size:
+            size = int(round(max_size * shortest / longest))
+        if shortest == size:
+            return height, width
+        if width < height:
+            return int(size * height / width), size
+        return size, int(size * width / height)
 
     @torch.no_grad()
-    def detect_video(self, video, bbox_format="cxcywh", frame_count=None, prompts: str = None):
+    def detect_batch(self, frames: List[np.ndarray], bbox_format="cxcywh") -> List[np.ndarray]:
         """
-        video is a generator
-        output is a list of numpy arrays denoting bounding boxes for each frame
+        Runs the model on a batch of frames at once.
+        Args:
+            frames: List of HWC uint8 RGB frames, all of the same size.
+            bbox_format: format of the bounding boxes, either "cxcywh" or "xyxy".
+        Returns:
+            List of [N, 5] arrays of detections, one for each frame, in order.
         """
-        video_detections = []  # list of list of detections
-        # num_batches = len(video) // batch_size  # last frames may be cut
+        pixel_values = self.preprocessor(frames)
+        # frames are all the same size, so there's no padding to mask out
+        pixel_mask = torch.ones((len(frames), *pixel_values.shape[2:]),
+                                dtype=torch.long, device=self.device)
+        outputs = self.model(pixel_values=pixel_values, pixel_mask=pixel_mask)
 
-        print("detecting balls in the video")
-        # for frame in tqdm(video, total=frame_count):
-        for frame, _ in zip(video, tqdm(range(frame_count))):
-            width, height, _ = frame.shape
-            inputs = self.feature_extractor(images=frame, return_tensors="pt")
-            inputs["pixel_values"] = inputs["pixel_values"].to(self.device)
-            inputs["pixel_mask"] = inputs["pixel_mask"].to(self.device)
-
-            outputs = self.model(**inputs)
-            outputs["logits"] = outputs["logits"].squeeze(
-                0)  # remove singleton batch dim
-            outputs["pred_boxes"] = outputs["pred_boxes"].squeeze(0)
-            confs = torch.nn.functional.softmax(outputs["logits"], dim=1)
-            conf_scores, indices = torch.max(confs, dim=1)
-            xywh = outputs["pred_boxes"][indices == SPORTS_BALL_COCO_CLASS_IDX]
-            conf_scores = conf_scores[indices == SPORTS_BALL_COCO_CLASS_IDX]
-
-            xywh[:, 0] *= height
-            xywh[:, 2] *= height
-            xywh[:, 1] *= width
-            xywh[:, 3] *= width
-            cxywh = torch.cat((conf_scores.unsqueeze(1), xywh),
-                              dim=1)  # add confidences
-            video_detections.append(cxywh.cpu().numpy())
-        return video_detections
+        confs = torch.nn.functional.softmax(outputs["logits"], dim=-1)  # [B, Q, C+1]
+        conf_scores, indices = torch.max(confs, dim=-1)
+        is_ball = indices == SPORTS_BALL_COCO_CLASS_IDX
+
+        height, width, _ = frames[0].shape
+        scale = torch.tensor([width, height, width, height], device=self.device)
+        boxes = box_convert(outputs["pred_boxes"] * scale, in_fmt="cxcywh", out_fmt=bbox_format)
+        cxywh = torch.cat((conf_scores.unsqueeze(-1), boxes),
+                          dim=-1)  # add confidences
+        # one trip to the CPU for the whole batch, then split into frames
+        balls = cxywh[is_ball].cpu().numpy()
+        balls_per_frame = is_ball.sum(dim=1).cpu().numpy()
+        return np.split(balls, np.cumsum(balls_per_frame)[:-1])
 
 
 class OWLVITZeroShot(Detector):
-    def __init__(self):
+    def __init__(self, batch_size: int = 4, threshold: float = 0.1):
+        """
+        Args:
+            batch_size: Number of frames passed through the image encoder at once.
+            threshold: Minimum score for a box to count as a detection of a prompt.
+        """
         self.device = "cuda:0" if torch.cuda.is_available() else "cpu"
-        self.feature_extractor = pipeline(model="google/owlvit-base-patch32",
-                                          task="zero-shot-object-detection", device=self.device)
+        self.processor = OwlViTProcessor.from_pretrained("google/owlvit-base-patch32")
+        self.model = OwlViTForObjectDetection.from_pretrained("google/owlvit-base-patch32")
+        self.model.eval().to(self.device)
+        self.batch_size = batch_size
+        self.threshold = threshold
 
+        image_processor = self.processor.image_processor
+        size = image_processor.size
+        if isinstance(size, dict):
+            size = (size["height"], size["width"])
+        else:
+            size = (size, size)
+        # OWL-ViT squashes every frame to a fixed square, so boxes are relative to the whole frame
+        self.preprocessor = FramePreprocessor(image_processor.image_mean, image_processor.image_std,
+                                              self.device, resize=lambda height, width: size)
+        self.query_embeds = None
 
     @torch.no_grad()
+    def embed_prompts(self, prompts: List[str]) -> None:
+        """
+        Encodes the text prompts once, so they can be reused for every frame of the video.
+        """
+        text_inputs = self.processor(text=prompts, return_tensors="pt").to(self.device)
+        self.query_embeds = self.model.owlvit.get_text_features(**text_inputs)  # [Q, D]
+
     def detect_video(self, video, prompts: List[str], bbox_format="cxcywh", frame_count=None):
         """
         Args:
@@ -159,27 +310,151 @@ class OWLVITZeroShot(Detector):
             prompts: list of strings describing objects.
             bbox_format: format of the bounding boxes, either "cxcywh" or "xyxy".
         """
-        video_detections = []  # list of list of detections
-        # num_batches = len(video) // batch_size  # last frames may be cut
+        return super().detect_video(video, bbox_format=bbox_format, frame_count=frame_count,
+                                    prompts=prompts)
 
-        print("detecting balls in the video")
-        print(self.device)
-        for frame in tqdm(video, total=frame_count):
-
-            pipeline_output = self.feature_extractor(image=Image.fromarray(frame), candidate_labels=prompts)
-            scores = []
-            xs = []
-            ys = []
-            widths = []
-            heights = []
-            for detection in pipeline_output:
-                scores.append(detection["score"])
-                w = detection["box"]["xmax"] - detection["box"]["xmin"]
-                h = detection["box"]["ymax"] - detection["box"]["ymin"]
-                xs.append(detection["box"]["xmin"] + w / 2)
-                ys.append(detection["box"]["ymin"] + h / 2)
-                widths.append(w)
-                heights.append(h)
-            cxywh = np.stack((scores, xs, ys, widths, heights), axis=1)
-            video_detections.append(cxywh)
-        return video_detections
+    @torch.no_grad()
+    def detect_batch(self, frames: List[np.ndarray], bbox_format="cxcywh") -> List[np.ndarray]:
+        """
+        Runs the image encoder on a batch of frames at once, and scores every box
+        against the prompts from the last call to embed_prompts.
+        Args:
+            frames: List of HWC uint8 RGB frames, all of the same size.
+            bbox_format: format of the bounding boxes, either "cxcywh" or "xyxy".
+        Returns:
+            List of [N, 5] arrays of detections, one for each frame, in order.
+            A box that matches several prompts is detected once per prompt.
+        """
+        pixel_values = self.preprocessor(frames)
+        feature_map, _ = self.model.image_embedder(pixel_values=pixel_values)
+        batch_size, patches_height, patches_width, hidden_dim = feature_map.shape
+        image_feats = feature_map.reshape(batch_size, patches_height * patches_width, hidden_dim)
+
+        query_embeds = self.query_embeds.expand(batch_size, -1, -1)
+        query_mask = torch.ones(query_embeds.shape[:2], dtype=torch.bool, device=self.device)
+        logits, _ = self.model.class_predictor(image_feats, query_embeds, query_mask)  # [B, P, Q]
+        pred_boxes = self.model.box_predictor(image_feats, feature_map)  # [B, P, 4]
+
+        scores = torch.sigmoid(logits)
+        is_object = scores > self.threshold
+
+        height, width, _ = frames[0].shape
+        scale = torch.tensor([width, height, width, height], device=self.device)
+        boxes = box_convert(pred_boxes * scale, in_fmt="cxcywh", out_fmt=bbox_format)
+        boxes = boxes.unsqueeze(2).expand(-1, -1, scores.shape[2], -1)  # one box per prompt
+        cxywh = torch.cat((scores.unsqueeze(-1), boxes), dim=-1)  # add confidences
+        # one trip to the CPU for the whole batch, then split into frames
+        objects = cxywh[is_object].cpu().numpy()
+        objects_per_frame = is_object.sum(dim=(1, 2)).cpu().numpy()
+        return np.split(objects, np.cumsum(objects_per_frame)[:-1])
+
+
+def tile_origins(length: int, tile_size: int, overlap: int) -> List[int]:
+    """
+    Where tiles of tile_size start along an edge of length, so that neighbouring tiles overlap
+    by at least overlap pixels, and the last tile ends at the end of the edge.
+    """
+    if length <= tile_size:
+        return [0]
+    count = ceil((length - tile_size) / (tile_size - overlap)) + 1
+    return np.linspace(0, length - tile_size, count).round().astype(int).tolist()
+
+
+class ScaledDetector(Detector):
+    """
+    Runs another detector on downscaled frames, or on overlapping tiles of the frames, and maps
+    the boxes back to the coordinates of the original frames.
+    Downscaling trades the recall of small objects for speed. Tiling does the opposite: a ball
+    that the model's own resizing of a whole 4K frame would shrink to a few pixels still covers
+    enough of a tile. A ball cut by the edge of a tile is found whole in the next one, so boxes
+    touching the edge of their tile are dropped, unless it's also the edge of the frame. The
+    remaining detections of all the tiles of a frame are merged with the NMS that
+    filter_detections uses.
+    """
+    edge_margin = 2  # boxes this close to the edge of a tile are taken to be cut by it, in pixels
+
+    def __init__(self, detector: Detector, scale: float = 1.0, tile_size: Optional[int] = None,
+                 tile_overlap: int = 64, iou_threshold: float = 0.5):
+        """
+        Args:
+            detector: The detector that is run on the downscaled frames or on the tiles.
+            scale: Factor the frames are resized by before detection, or before tiling.
+            tile_size: Side of the square tiles, in pixels of the resized frame, or None to
+                run on whole frames.
+            tile_overlap: Minimum overlap between neighbouring tiles, in pixels. Should be
+                bigger than the objects being detected.
+            iou_threshold: IoU threshold used to merge the detections of overlapping tiles.
+        """
+        if tile_size is not None and tile_overlap >= tile_size:
+            raise ValueError(f"Tiles of {tile_size} pixels can't overlap by {tile_overlap} pixels")
+        self.detector = detector
+        self.batch_size = detector.batch_size
+        self.scale = scale
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.iou_threshold = iou_threshold
+
+    def embed_prompts(self, prompts: List[str]) -> None:
+        self.detector.embed_prompts(prompts)
+
+    @torch.no_grad()
+    def detect_batch(self, frames: List[np.ndarray], bbox_format="cxcywh") -> List[np.ndarray]:
+        """
+        Runs the detector on a batch of frames, downscaled or tiled.
+        Args:
+            frames: List of HWC uint8 RGB frames, all of the same size.
+            bbox_format: format of the bounding boxes, either "cxcywh" or "xyxy".
+        Returns:
+            List of [N, 5] arrays of detections, one for each frame, in order.
+        """
+        height, width, _ = frames[0].shape
+        if self.scale != 1:
+            frames = [cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+                      for frame in frames]
+        if self.tile_size is None:
+            batch_detections = self.detector.detect_batch(frames, bbox_format="xyxy")
+        else:
+            batch_detections = self.detect_tiles(frames)
+
+        resized_height, resized_width, _ = frames[0].shape
+        # the exact factors, the resized size is rounded
+        to_frame = np.array([width / resized_width, height / resized_height] * 2)
+        return [np.concatenate((detections[:, :1],
+                                box_convert(torch.from_numpy(detections[:, 1:] * to_frame),
+                                            in_fmt="xyxy", out_fmt=bbox_format).numpy()),
+                               axis=1).astype(np.float32)
+                for detections in batch_detections]
+
+    def detect_tiles(self, frames: List[np.ndarray]) -> List[np.ndarray]:
+        """
+        Runs the detector on overlapping tiles of the frames, and merges the detections of each frame.
+        Returns:
+            List of [N, 5] arrays of detections in (c, x1, y1, x2, y2) format, one for each frame.
+        """
+        height, width, _ = frames[0].shape
+        origins = [(x, y) for y in tile_origins(height, self.tile_size, self.tile_overlap)
+                   for x in tile_origins(width, self.tile_size, self.tile_overlap)]
+        tiles = [frame[y:y + self.tile_size, x:x + self.tile_size] for frame in frames for x, y in origins]
+
+        tile_detections = []
+        for batch in batch_frames(tiles, self.batch_size):
+            tile_detections.extend(self.detector.detect_batch(batch, bbox_format="xyxy"))
+        rows = np.concatenate([np.asarray(detections, dtype=np.float64).reshape(-1, 5) + (0, x, y, x, y)
+                               for detections, (x, y) in zip(tile_detections, origins * len(frames))])
+        tiles_per_frame = len(origins)
+        counts = [len(detections) for detections in tile_detections]
+        frame_numbers = np.repeat(np.arange(len(tile_detections)) // tiles_per_frame, counts)
+
+        # the objects cut by an edge between tiles are whole in the neighbouring tile, which overlaps
+        # by more than their size, so their partial boxes are dropped instead of merged
+        tile_boxes = np.repeat([(x, y, min(x + self.tile_size, width), min(y + self.tile_size, height))
+                                for x, y in origins] * len(frames), counts, axis=0).reshape(-1, 4)
+        inner_edges = tile_boxes != (0, 0, width, height)
+        cut = (inner_edges[:, :2] & (rows[:, 1:3] <= tile_boxes[:, :2] + self.edge_margin)).any(axis=1) | \
+            (inner_edges[:, 2:] & (rows[:, 3:5] >= tile_boxes[:, 2:] - self.edge_margin)).any(axis=1)
+        rows, frame_numbers = rows[~cut], frame_numbers[~cut]
+
+        keep = frame_nms(frame_numbers, torch.from_numpy(rows[:, 1:]), torch.from_numpy(rows[:, 0]),
+                         self.iou_threshold)
+        offsets = np.searchsorted(frame_numbers[keep], np.arange(len(frames) + 1), side="left")
+        return [rows[keep[offsets[i]:offsets[i + 1]]] for i in range(len(frames))]
@@ -1,24 +1,225 @@
 """
 Module for drawing effects on videos.
 """
-import yaml
 import argparse
+import multiprocessing
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import skvideo.io
 from traccc import effects
 from tqdm import tqdm
 from traccc import filters
-import cv2
-from typing import Tuple
+from traccc.track_store import find_tracks, load_tracks
+from traccc.trackers import Track
+from traccc.frame_cache import cache_key, open_video
+from traccc.video import VideoWriter, concat_videos, display_size, encoder_settings, frame_rate, split_frames
+import numpy as np
+from typing import Iterator, List, Optional, Tuple
 import gradio as gr
 
-def hex_to_bgr(rgb_hex: str) -> Tuple[int, int, int]:
-    """Converts a hex code to BGR."""
+def hex_to_rgb(rgb_hex: str) -> Tuple[int, int, int]:
+    """Converts a hex code to an RGB colour, the colour order frames are drawn in."""
     rgb_hex = rgb_hex.lstrip('#')
-    rgb = [int(rgb_hex[i:i+2], 16) for i in (0, 2, 4)]
-    return rgb
+    return tuple(int(rgb_hex[i:i+2], 16) for i in (0, 2, 4))
+
+effect_selector = {
+    "dot": effects.Dot,
+    "lagging_dot": effects.LaggingDot,
+    "line": effects.Line,
+    "highlight_line": effects.HighlightLine,
+    "neon_line": effects.NeonLine,
+    "contrail": effects.Contrail,
+    "fully_connected": effects.FullyConnected,
+    "fully_connected_neon": effects.FullyConnectedNeon,
+    "debug": effects.Debug,
+    "tricolor": effects.TriColor
+}
+
+def accumulating_effects(length: int) -> List[str]:
+    """
+    Returns:
+        The names of the effects that can be drawn with accumulate, with trails of this length.
+    """
+    return [effect_name for effect_name, effect in effect_selector.items()
+            if effect((0, 0, 0), length).can_accumulate_trails()]  # the colour doesn't matter
+
+class TrackIndex:
+    """
+    Finds the tracks an effect draws on each frame, without checking every track on every frame.
+    Each track's relevant interval is worked out once, and frames are then swept in order,
+    adding tracks as their interval starts and dropping them as it ends.
+    """
+
+    def __init__(self, tracks: List[dict], effect: effects.Effect):
+        self.tracks = tracks
+        intervals = np.array([effect.relevant_interval(track) for track in tracks],
+                             dtype=np.int64).reshape(-1, 2)
+        self.firsts, self.ends = intervals[:, 0], intervals[:, 1]
+        self.by_first = np.argsort(self.firsts, kind="stable")
+        self.by_end = np.argsort(self.ends, kind="stable")
+
+    def frames(self, start: int, stop: int) -> Iterator[List[dict]]:
+        """
+        Yields the relevant tracks of each frame from start up to stop, in the same order as
+        the tracks were given.
+        """
+        active = set(np.flatnonzero((self.firsts <= start) & (start < self.ends)).tolist())
+        next_first = np.searchsorted(self.firsts[self.by_first], start, side="right")
+        next_end = np.searchsorted(self.ends[self.by_end], start, side="right")
+        for frame_number in range(start, stop):
+            while next_first < len(self.by_first) and self.firsts[self.by_first[next_first]] <= frame_number:
+                if self.ends[self.by_first[next_first]] > frame_number:
+                    active.add(int(self.by_first[next_first]))
+                next_first += 1
+            while next_end < len(self.by_end) and self.ends[self.by_end[next_end]] <= frame_number:
+                active.discard(int(self.by_end[next_end]))
+                next_end += 1
+            yield [self.tracks[i] for i in sorted(active)]
+
+
+def track_view(track: Track) -> dict:
+    """
+    The track dictionary that effects draw, as views of the track's history so far.
+    """
+    return {
+        "id": track.id,
+        "start_frame": track.start_frame,
+        "age": track.age,
+        "states": track.prev_states,
+        "measurements": track.prev_measurements
+    }
+
+
+def draw_delay(effect: effects.Effect, min_age: int) -> int:
+    """
+    How many frames the tracker has to be ahead of a frame before it can be drawn. By then,
+    every track the frame is drawn with has either finished, or has lived long enough to pass
+    the min_age filter and the effect's own minimum age, including tracks the effect draws
+    before they start. A track's state for frame i is only recorded when frame i + 1 is
+    tracked, so it's always at least one frame.
+    """
+    return max(1, max(min_age, effect.min_track_age) + effect.lookahead)
+
+
+class DelayedDrawer:
+    """
+    Draws an effect on frames while tracking is still running. Frames are held back until
+    the tracker is far enough ahead that the tracks drawn on them are settled, so the output
+    is the same as drawing the finished tracks afterwards.
+    """
+
+    def __init__(self, effect: effects.Effect, min_age: int):
+        """
+        Args:
+            effect: The effect to draw.
+            min_age: Minimum age (in frames) for tracks to be drawn.
+        """
+        self.effect = effect
+        self.min_age = min_age
+        self.delay = draw_delay(effect, min_age)
+        self.frames = deque()  # frames waiting to be drawn, with their frame numbers
+        self.next_frame = 0
+        self.active = []  # the tracker's active tracks
+        self.finished = []  # dictionaries of finished tracks that may still be drawn
+
+    def push(self, frame: np.ndarray, active: List[Track], finished: List[Track]) -> List[np.ndarray]:
+        """
+        Adds the next frame, with the tracker's output after tracking it.
+        Returns:
+            The frames that are now ready, with the effect drawn on them.
+        """
+        self.frames.append((self.next_frame, frame))
+        self.next_frame += 1
+        self.active = active
+        self._add_finished(finished)
+        return [self._draw_next() for _ in range(len(self.frames) - self.delay)]
+
+    def flush(self, finished: List[Track]) -> List[np.ndarray]:
+        """
+        Draws the remaining frames, once the tracker has handed back its last tracks.
+        """
+        self.active = []
+        self._add_finished(finished)
+        return [self._draw_next() for _ in range(len(self.frames))]
+
+    def _add_finished(self, finished: List[Track]) -> None:
+        finished = [track_view(track) for track in finished]
+        self.finished.extend(track for track in finished
+                             if filters.standard_filter(track, min_age=self.min_age))
+
+    def _draw_next(self) -> np.ndarray:
+        frame_number, frame = self.frames.popleft()
+        tracks = self.finished + [track_view(track) for track in self.active]
+        relevant_tracks = [track for track in tracks
+                           if filters.standard_filter(track, min_age=self.min_age) and
+                           self.effect.relevant(track, frame_number)]
+        # finished tracks the effect is done with won't be drawn again
+        self.finished = [track for track in self.finished
+                         if self.effect.relevant_interval(track)[1] > frame_number + 1]
+        return self.effect.draw_tracks(frame, relevant_tracks, frame_number)
+
+
+def draw_chunk(name: str, input_video: str, output: str, effect_name: str, colour: str,
+               size: float, length: int, min_age: int, start_frame: int, num_frames: int,
+               fps: float, width: int, height: int, show_progress: bool = True,
+               accumulate: bool = False, encoder: Optional[dict] = None,
+               audio_source: Optional[str] = None, cache_gb: float = 0,
+               video_key: Optional[str] = None) -> int:
+    """
+    Draws the effect on a contiguous range of frames, and writes them to their own video.
+    Used for the whole video, or in a worker process for one chunk of it.
+    encoder holds the codec, preset, crf and threads passed on to VideoWriter, and audio_source
+    is the video whose audio is copied into the output. Frames are read through the frame
+    cache if cache_gb isn't 0, and video_key is the video's key in it, worked out once for all
+    the workers.
+    Returns:
+        The number of frames that were written.
+    """
+    effect = effect_selector[effect_name](hex_to_rgb(colour), length, size)
+
+    tracks = load_tracks(find_tracks(name))
+
+    # filter out all the tracks that we deem not good enough
+    tracks = [track for track in tracks if filters.standard_filter(
+        track, min_age=min_age)]
+
+    # work out which frames each track is drawn on once, instead of checking every track every frame
+    index = TrackIndex(tracks, effect)
+
+    if accumulate:
+        effect.accumulate_trails()
+        # build up the trails still visible at the start of the chunk, on a blank frame
+        warmup_start = max(0, start_frame - effect.trail.lifetime)
+        blank = np.zeros((height, width, 3), dtype=np.uint8)
+        for i, relevant_tracks in zip(range(warmup_start, start_frame),
+                                      index.frames(warmup_start, start_frame)):
+            effect.draw_tracks(blank, relevant_tracks, i)
+
+    # each frame is drawn and written before the next one is decoded, so they can share a buffer
+    vid_generator = open_video(input_video, start_frame, num_frames, reuse_buffer=True, cache_gb=cache_gb,
+                               key=video_key)
+    frame_numbers = range(start_frame, start_frame + num_frames)
+    if show_progress:
+        # TODO workaround to issue https://github.com/gradio-app/gradio/issues/3841
+        # revert to tqdm(enumerate(vid_generator)) when bug is fixed
+        frame_numbers = tqdm(frame_numbers)
+    frames_written = 0
+    with VideoWriter(output, width, height, fps, audio_source=audio_source, **(encoder or {})) as writer:
+        for (frame, i, relevant_tracks) in zip(vid_generator, frame_numbers,
+                                               index.frames(start_frame, start_frame + num_frames)):
+            # loop through all tracks, draw each on the frame
+            writer.write(effect.draw_tracks(frame, relevant_tracks, i))
+            frames_written += 1
+    return frames_written
+
 
 def run_draw(name: str, input_video: str, output: str, effect_name: str,
-             colour: str, size: float, length: int, min_age: int, progress=gr.Progress(track_tqdm=True)):
+             colour: str, size: float, length: int, min_age: int, workers: int = 1,
+             accumulate: bool = False, codec: str = "libx264", preset: Optional[str] = "veryfast",
+             crf: Optional[int] = 23, encoder_threads: int = 0, cache_gb: float = 0,
+             progress=gr.Progress(track_tqdm=True)):
     """
     Runs the drawing portion of the pipeline.
     Inputs are already expected to be sanitized.
@@ -31,64 +232,64 @@ def run_draw(name: str, input_video: str, output: str, effect_name: str,
         size: Size of the effect, relative to the width of the object.
         length: Length of the effect in frames.
         min_age: Minimum age (in frames) for tracks to be drawn.
+        workers: Number of processes to split the video between. Each one decodes, draws and
+            encodes a chunk of frames, and the chunks are joined without re-encoding.
+        accumulate: Keep the trails drawn so far from frame to frame, and only draw the newest
+            segment of each track, letting older segments fade out. It saves blurring the whole
+            trail every frame, so only the glowing effects with long trails support it, see
+            accumulating_effects.
+        codec: ffmpeg video encoder used for the output, like libx264, libx265 or mpeg4.
+        preset: Encoder speed preset, trading encoding speed for file size. None for encoders
+            without presets.
+        crf: Constant rate factor of the encoder, lower is better quality. None for encoders
+            without it.
+        encoder_threads: Number of threads each encoder uses, 0 lets ffmpeg choose.
+        cache_gb: Size limit of the decoded-frame cache in gigabytes, 0 to decode without it.
+            Drawing with one worker puts the video in the cache, so drawing it again is faster.
     """
-    vid_generator = skvideo.io.vreader(input_video)
+    if accumulate and effect_name not in accumulating_effects(length):
+        raise ValueError(f"The {effect_name} effect can't accumulate trails of {length} frames, only " +
+                         ", ".join(accumulating_effects(length) or ["none"]) + " can.")
+
     metadata = skvideo.io.ffprobe(input_video)
     frame_count = int(metadata['video']['@nb_frames'])
-    fps = metadata['video']['@r_frame_rate']
-    numerator, denominator = map(int, fps.split('/'))
-    fps = numerator / denominator
-    width = int(metadata['video']['@width'])
-    height = int(metadata['video']['@height'])
-    # rotation = int(metadata['video']['tag'][0]['@value'])
-    # we also probably need to rotate
-    fourcc = cv2.VideoWriter_fourcc('m', 'p', '4', 'v')
-    # if rotation == 90 or rotation == 270: # TODO this is janky
-    opencv_out = cv2.VideoWriter(
-        output, fourcc, fps, (width, height))
-    # else:
-        # opencv_out = cv2.VideoWriter(
-            # output, fourcc, fps, (width, height))
-
-    with open(f"internal/{name}.yaml", 'r') as f:
-        track_dictionary = yaml.safe_load(f)
-
-    rgb_color = hex_to_bgr(colour)
-    effect = {
-        "dot": effects.Dot,
-        "lagging_dot": effects.LaggingDot,
-        "line": effects.Line,
-        "highlight_line": effects.HighlightLine,
-        "neon_line": effects.NeonLine,
-        "contrail": effects.Contrail,
-        "fully_connected": effects.FullyConnected,
-        "fully_connected_neon": effects.FullyConnectedNeon,
-        "debug": effects.Debug,
-        "tricolor": effects.TriColor
-    }[effect_name](rgb_color, length, size)
-
-    tracks = track_dictionary["tracks"]
-
-    # filter out all the tracks that we deem not good enough
-    tracks = [track for track in tracks if filters.standard_filter(
-        track, min_age=min_age)]
+    fps = frame_rate(metadata)
+    # frames are decoded upright, so the rotation is already applied to the pixels we write
+    width, height = display_size(metadata)
+    encoder = {"codec": codec, "preset": preset, "crf": crf, "threads": encoder_threads}
 
     print("adding effect")
-    # TODO workaround to issue https://github.com/gradio-app/gradio/issues/3841
-    # revert to the below line when bug is fixed
-    # for i, frame in tqdm(enumerate(vid_generator), total=frame_count):
-    for (frame, i) in zip(vid_generator, tqdm(range(frame_count))):
-        relevant_tracks = [
-            track for track in tracks if effect.relevant(track, i)]
-
-        # loop through all tracks, draw each on the frame
-        out_frame = effect.draw_tracks(frame, relevant_tracks, i)
+    if workers <= 1:
+        draw_chunk(name, input_video, output, effect_name, colour, size, length, min_age,
+                   0, frame_count, fps, width, height, accumulate=accumulate, encoder=encoder,
+                   audio_source=input_video, cache_gb=cache_gb)
+        return f"successfully wrote video {output}."
 
-        bgr_frame = cv2.cvtColor(out_frame, cv2.COLOR_RGB2BGR)
-        opencv_out.write(bgr_frame)
+    chunks = split_frames(frame_count, workers)
+    video_key = cache_key(input_video, cache_gb)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output))) as chunk_dir:
+        chunk_files = [os.path.join(chunk_dir, f"chunk{i}.mp4") for i in range(len(chunks))]
+        # spawn, so the workers don't inherit the state of the gradio server
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=len(chunks), mp_context=context) as pool:
+            futures = [pool.submit(draw_chunk, name, input_video, chunk_file, effect_name, colour,
+                                   size, length, min_age, start_frame, num_frames, fps, width,
+                                   height, show_progress=False, accumulate=accumulate,
+                                   encoder=encoder, cache_gb=cache_gb, video_key=video_key)
+                       for (start_frame, num_frames), chunk_file in zip(chunks, chunk_files)]
+            frames_written = [future.result() for future in tqdm(futures)]
 
-    opencv_out.release()
-    return f"successfully wrote video {output}."
+        # the frame count from ffprobe can be off by a bit, but only the last chunk can come up short.
+        # This only catches a truncated chunk, a seek that lands on the wrong frame still decodes
+        # num_frames frames
+        for (start_frame, num_frames), written in zip(chunks[:-1], frames_written[:-1]):
+            if written != num_frames:
+                raise RuntimeError(f"Expected {num_frames} frames starting at frame {start_frame}, " +
+                                   f"but the video ended after {written}. {input_video} has fewer " +
+                                   "frames than ffprobe reports, draw with a single worker instead.")
+        # the audio is added while joining, the chunks don't have any
+        concat_videos(chunk_files, output, audio_source=input_video)
+    return f"successfully wrote video {output} with {len(chunks)} workers."
 
 
 if __name__ == "__main__":
@@ -107,6 +308,20 @@ if __name__ == "__main__":
         "--size", help="size or width of the effect", default=1.0)
     parser.add_argument(
         "--output", help="the output file", default=None)
+    parser.add_argument(
+        "--workers", help="number of processes to split the video between", default=1)
+    parser.add_argument(
+        "--accumulate", help="keep trails between frames and let them fade out, instead of redrawing them",
+        action="store_true")
+    parser.add_argument("--codec", help="ffmpeg video encoder for the output", default="libx264")
+    parser.add_argument("--preset", help="encoder speed preset, veryfast by default for x264 and x265",
+                        default=None)
+    parser.add_argument("--crf", help="constant rate factor, lower is better quality, 23 by default for x264 and x265",
+                        default=None)
+    parser.add_argument(
+        "--encoder_threads", help="number of encoder threads, 0 lets ffmpeg choose", default=0)
+    parser.add_argument(
+        "--cache_gb", help="size limit of the decoded-frame cache in gigabytes, 0 to disable", default=0)
     args = parser.parse_args()
     name = args.name
     effect = args.effect
@@ -123,6 +338,9 @@ if __name__ == "__main__":
     else:
         input_video = args.input
 
+    preset, crf = encoder_settings(args.codec, args.preset, None if args.crf is None else int(args.crf))
     run_draw(name, input_video, output, effect, args.colour,
-             size,length, int(args.min_age))
+             size,length, int(args.min_age), workers=int(args.workers), accumulate=args.accumulate,
+             codec=args.codec, preset=preset, crf=crf,
+             encoder_threads=int(args.encoder_threads), cache_gb=float(args.cache_gb))
 
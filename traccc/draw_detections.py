@@ -1,42 +1,43 @@
 """Debugging script to draw detections on a video."""
 
 import argparse
-import numpy as np
 from torchvision.utils import draw_bounding_boxes
 from torchvision.ops import box_convert
 import skvideo.io
 import torch
 from tqdm import tqdm
 
+from traccc.detection_store import find_detections, load_detections
+from traccc.frame_cache import open_video
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Tracks objects using detections as input.")
     parser.add_argument("name", help="name of the project to be tracked.")
     parser.add_argument(
         "--conf_threshold", help="confidence threshold for removing uncertain predictions, must be in the range [0, 1].", default=0.0)
+    parser.add_argument(
+        "--cache_gb", help="size limit of the decoded-frame cache in gigabytes, 0 to disable", default=0)
     args = parser.parse_args()
     name = args.name
     print("reading video")
-    vid_generator = skvideo.io.vreader(f"io/{name}.mp4")
+    vid_generator = open_video(f"io/{name}.mp4", cache_gb=float(args.cache_gb))
     vid_writer = skvideo.io.FFmpegWriter(f"io/{name}_detections.mp4")
     metadata = skvideo.io.ffprobe(f"io/{name}.mp4")
     frame_count = int(metadata['video']['@nb_frames'])
 
-    detections = np.load(f"internal/{name}.npz")
-    detections_list = []
-    for frame_number, frame_name in enumerate(detections):
-        detections_list.append(detections[frame_name])
+    detections = load_detections(find_detections(name))
     print("drawing detections")
     for i, frame in tqdm(enumerate(vid_generator), total=frame_count):
-        if len(detections_list[i]) > 0:
+        frame_detections = detections[i]
+        if len(frame_detections) > 0:
             # move channels to front
             CHW = torch.permute(torch.tensor(
                 frame, dtype=torch.uint8), (2, 0, 1))
-            confs = detections_list[i][:, 0]
-            detections_list[i] = detections_list[i][confs >
-                                                    float(args.conf_threshold)]
+            confs = frame_detections[:, 0]
+            frame_detections = frame_detections[confs > float(args.conf_threshold)]
             boxes_xyxy = box_convert(torch.Tensor(
-                detections_list[i][:, 1:]), in_fmt="cxcywh", out_fmt="xyxy")
+                frame_detections[:, 1:]), in_fmt="cxcywh", out_fmt="xyxy")
             drawn = CHW
             for i, box in enumerate(boxes_xyxy):
                 conf = confs[i]
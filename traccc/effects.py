@@ -7,8 +7,14 @@ from typing import Tuple, List
 # pylint: disable=invalid-name, no-member
 
 class Effect(ABC):
+    lookahead = 0  # how many frames before a track starts the effect can already draw it
+    min_track_age = 0  # tracks younger than this are never drawn by the effect
+    # shorter trails are faster to redraw every frame than to keep on a TrailBuffer
+    min_accumulated_length = 30
+
     def __init__(self, colour: Tuple[int], length: int, size: float = 1.0):
-        self.colour = colour
+        # converted once here, instead of on every call into cv2
+        self.colour = tuple(map(int, colour)) if colour is not None else None
         self.size = size
         self.length = length
 
@@ -21,10 +27,44 @@ class Effect(ABC):
         else:
             return False
 
+    def relevant_interval(self, track: dict) -> Tuple[int, int]:
+        """
+        returns the first frame this effect modifies because of the track, and the frame
+        after the last one. Must agree with relevant.
+        """
+        return track["start_frame"], track["start_frame"] + track["age"]
+
+    @property
+    def trail_length(self) -> int:
+        return self.length
+
+    def can_accumulate_trails(self) -> bool:
+        """
+        Returns True if the effect can keep its trails on a TrailBuffer, see accumulate_trails.
+        Only effects that draw one segment at a time can, and only with trails long enough that
+        keeping them is faster than redrawing them.
+        """
+        return type(self).draw_segment is not Effect.draw_segment and \
+            self.trail_length >= self.min_accumulated_length
+
+    def accumulate_trails(self) -> None:
+        """
+        Switches to stateful drawing: instead of redrawing every segment of a trail on every
+        frame, the effect keeps its trails on a TrailBuffer, draws only the newest segment of
+        each track, and lets the older ones fade out. Frames must then be drawn in order.
+        """
+        if not self.can_accumulate_trails():
+            raise ValueError(f"{type(self).__name__} can't accumulate trails of {self.trail_length} frames. "
+                             f"Only effects drawn one segment at a time can, with trails of at "
+                             f"least {self.min_accumulated_length} frames.")
+        self.trail = TrailBuffer(self.trail_length)
+
     def draw_tracks(self, frame, tracks: List[dict], frame_number: int):
         """
         The default is to draw every track independently
         """
+        if getattr(self, "trail", None) is not None:
+            return self.draw_trails(frame, tracks, frame_number)
         out_frame = frame
         for track in tracks:
             # print(f"drawing track {track['id']}")
@@ -34,66 +74,287 @@ class Effect(ABC):
     def draw(self, frame, track, frame_number):
         raise NotImplementedError
 
+    def draw_trails(self, frame, tracks: List[dict], frame_number: int):
+        self.trail.start_frame(frame, frame_number)
+        for track in tracks:
+            i = frame_number - track["start_frame"] - 1  # the segment that's new in this frame
+            if i >= 1:
+                self.draw_segment(self.trail, track, i)
+        return self.trail.composite(frame)
+
+    def draw_segment(self, trail: "TrailBuffer", track: dict, i: int) -> None:
+        """
+        Draws the segment of the track from state i-1 to state i on the trail buffer.
+        """
+        raise NotImplementedError
+
+
+class TrailBuffer:
+    """
+    Trails drawn by an effect over the previous frames, kept from one frame to the next.
+    Opaque lines are kept as colour and coverage, and glows are added up in a separate layer.
+    A segment fades to a twentieth after trail_length frames.
+    Instead of fading the whole buffer every frame, things are drawn brighter the later they're
+    drawn, and the buffer is scaled down once when composited. The frame is split into tiles, and
+    only the tiles drawn on recently enough to still be visible are blended onto it.
+    """
+    tile_size = 64
+
+    def __init__(self, trail_length: int):
+        self.decay = 0.05 ** (1 / max(1, trail_length))
+        # frames until everything drawn before, even glows stacked up every frame, adds up to
+        # less than half an 8-bit step
+        self.lifetime = int(np.ceil(np.log(0.5 * (1 - self.decay) / 255) / np.log(self.decay)))
+        # layers are unfaded, and alpha and glow are only made once something is drawn on them
+        self.colour = None  # [H, W, 3] float32, colour premultiplied by coverage
+        self.alpha = None  # [H, W] float32 coverage of the opaque lines
+        self.glow = None  # [H, W, 3] float32, added onto the frame
+        self.frame_number = None
+        self.base_frame = None  # the frame whose drawings are stored at their real brightness
+        self.expiry = None  # [rows, cols] frame each tile fades out at, 0 once it's cleared
+        self.line_expiry = None  # same, but for the opaque lines in the tile
+
+    def start_frame(self, frame: np.ndarray, frame_number: int) -> None:
+        """
+        Clears the tiles that faded out. Skipping frames starts the trails over.
+        """
+        if self.colour is None or self.colour.shape != frame.shape or frame_number != self.frame_number + 1:
+            self.colour = np.zeros(frame.shape, dtype=np.float32)
+            self.alpha = self.glow = None
+            self.base_frame = frame_number
+            tiles = (-(-frame.shape[0] // self.tile_size), -(-frame.shape[1] // self.tile_size))
+            self.expiry = np.zeros(tiles, dtype=np.int64)
+            self.line_expiry = np.zeros(tiles, dtype=np.int64)
+        self.frame_number = frame_number
+
+        faded = (self.expiry > 0) & (self.expiry <= frame_number)
+        for region in self._runs(faded):
+            for layer in self._layers():
+                layer[region] = 0
+        self.expiry[faded] = 0
+        self.line_expiry[self.line_expiry <= frame_number] = 0
+
+        if frame_number - self.base_frame >= self.lifetime:
+            # keep what's stored from growing out of range, by fading it for real once in a while
+            fade = np.float32(self.decay ** (frame_number - self.base_frame))
+            for region in self._runs(self.expiry > 0):
+                for layer in self._layers():
+                    layer[region] *= fade
+            self.base_frame = frame_number
+
+    def line(self, point_1: Tuple[int, int], point_2: Tuple[int, int], colour, thickness: int) -> None:
+        brightness = self._brightness()
+        cv2.line(self.colour, point_1, point_2, color=tuple(float(c) * brightness for c in colour),
+                 thickness=thickness)
+        cv2.line(self._alpha(), point_1, point_2, color=brightness, thickness=thickness)
+        self._mark([point_1, point_2], thickness // 2 + 2, lines=True)
+
+    def add_glow(self, glow: "Glow") -> None:
+        if glow.canvas.size == 0:
+            return
+        if self.glow is None:
+            self.glow = np.zeros(self.colour.shape, dtype=np.float32)
+        self.glow[glow.y0:glow.y1, glow.x0:glow.x1] += glow.canvas * np.float32(self._brightness())
+        self._mark_region(glow.x0, glow.y0, glow.x1, glow.y1, lines=False)
+
+    def composite(self, frame: np.ndarray) -> np.ndarray:
+        """
+        Blends the trails onto the frame.
+        """
+        fade = self.decay ** (self.frame_number - self.base_frame)
+        lines = self.line_expiry > 0
+        for region in self._runs(lines):
+            blended = cv2.scaleAdd(self.colour[region], fade,
+                                   frame[region] * (1 - np.float32(fade) * self.alpha[region])[..., None])
+            if self.glow is not None:
+                blended = cv2.scaleAdd(self.glow[region], fade, blended)
+            frame[region] = cv2.convertScaleAbs(blended)  # rounds and saturates, it's never negative
+        if self.glow is not None:
+            for region in self._runs((self.expiry > 0) & ~lines):
+                # only glows here, added onto the frame
+                frame[region] = cv2.addWeighted(frame[region], 1.0, self.glow[region], fade, 0.0, dtype=cv2.CV_8U)
+        return frame
+
+    def _brightness(self) -> float:
+        return self.decay ** (self.base_frame - self.frame_number)
+
+    def _layers(self) -> List[np.ndarray]:
+        return [layer for layer in (self.colour, self.alpha, self.glow) if layer is not None]
+
+    def _alpha(self) -> np.ndarray:
+        if self.alpha is None:
+            self.alpha = np.zeros(self.colour.shape[:2], dtype=np.float32)
+        return self.alpha
+
+    def _mark(self, points: List[Tuple[int, int]], pad: int, lines: bool) -> None:
+        points = np.array(points).reshape(-1, 2)
+        x0, y0 = points.min(axis=0) - pad
+        x1, y1 = points.max(axis=0) + pad + 1
+        self._mark_region(x0, y0, x1, y1, lines)
+
+    def _mark_region(self, x0: int, y0: int, x1: int, y1: int, lines: bool) -> None:
+        """
+        Keeps the tiles under a region that was drawn on, until it fades out.
+        """
+        height, width = self.colour.shape[:2]
+        x0, x1 = max(0, int(x0)), min(width, int(x1))
+        y0, y1 = max(0, int(y0)), min(height, int(y1))
+        if x0 >= x1 or y0 >= y1:
+            return
+        tiles = (slice(y0 // self.tile_size, (y1 - 1) // self.tile_size + 1),
+                 slice(x0 // self.tile_size, (x1 - 1) // self.tile_size + 1))
+        self.expiry[tiles] = self.frame_number + self.lifetime
+        if lines:
+            self.line_expiry[tiles] = self.frame_number + self.lifetime
+
+    def _runs(self, tiles: np.ndarray):
+        """
+        Yields the slices of the frame covered by each run of selected tiles along a row.
+        """
+        size = self.tile_size
+        for row in np.flatnonzero(tiles.any(axis=1)):
+            edges = np.flatnonzero(np.diff(np.concatenate(([False], tiles[row], [False]))))
+            for start, end in zip(edges[::2], edges[1::2]):
+                yield slice(row * size, (row + 1) * size), slice(start * size, end * size)
+
+
+def draw_segments(canvas: np.ndarray, starts: np.ndarray, ends: np.ndarray,
+                  thicknesses: np.ndarray, colour) -> np.ndarray:
+    """
+    Draws a batch of line segments with one cv2.polylines call per thickness, instead of one
+    cv2.line call per segment. Gives the same pixels as drawing each segment with cv2.line.
+    Args:
+        canvas: Image to draw on, in place.
+        starts: [N, 2] array of (x, y) start points, truncated to integers like int().
+        ends: [N, 2] array of (x, y) end points.
+        thicknesses: [N] array of line thicknesses, truncated to integers. Segments thinner
+            than a pixel aren't drawn.
+        colour: Colour of every segment.
+    """
+    segments = np.stack((np.asarray(starts), np.asarray(ends)), axis=1).reshape(-1, 2, 2).astype(np.int32)
+    thicknesses = np.asarray(thicknesses).reshape(-1).astype(np.int64)
+    for thickness in np.unique(thicknesses[thicknesses > 0]):
+        cv2.polylines(canvas, segments[thicknesses == thickness], False, colour, thickness=int(thickness))
+    return canvas
+
+
+def trail_states(track: dict, start_line: int, end_line: int) -> np.ndarray:
+    """
+    The states a track's trail goes through, from state start_line - 1 to state end_line - 1.
+    Segment i of the trail goes from trail[i + 1] back to trail[i].
+    """
+    states = track["states"][max(0, start_line - 1):max(0, end_line)]
+    if len(states) == 0:
+        return np.empty((0, 6))
+    return np.asarray(states, dtype=float)
+
+
+def pair_segments(states: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Every pair (i, j) with i < j of the states, in the same order as two nested loops.
+    Returns:
+        The indices of the first and of the second state of each pair.
+    """
+    return np.triu_indices(len(states), k=1)
+
+
+class Glow:
+    """
+    A blank canvas covering only the part of the frame that a glow is drawn and blurred on,
+    instead of the whole frame. Geometry is drawn in frame coordinates. The canvas has enough
+    margin around the geometry for the blur to fade out inside it, so blurring it and adding
+    it onto the frame gives the same result as doing so with a full-frame canvas.
+    """
+
+    def __init__(self, frame: np.ndarray, points: List[Tuple[int, int]], thickness: int, blur_margin: int):
+        """
+        Args:
+            frame: The frame the glow will be added to.
+            points: Every point the geometry is drawn through, in frame coordinates.
+            thickness: Thickest line that will be drawn.
+            blur_margin: How far the blurs can spread the geometry, the sum of their kernel radii.
+        """
+        height, width = frame.shape[:2]
+        pad = thickness // 2 + 2 + blur_margin  # thick lines have round caps that stick out a bit
+        points = np.array(points, dtype=np.int64).reshape(-1, 2)
+        if len(points) == 0:
+            self.x0 = self.y0 = self.x1 = self.y1 = 0
+        else:
+            self.x0, self.y0 = np.clip(points.min(axis=0) - pad, 0, (width, height))
+            self.x1, self.y1 = np.clip(points.max(axis=0) + pad + 1, 0, (width, height))
+        self.canvas = np.zeros((max(0, self.y1 - self.y0), max(0, self.x1 - self.x0)) + frame.shape[2:],
+                               dtype=np.uint8)
+
+    def line(self, point_1: Tuple[int, int], point_2: Tuple[int, int], colour, thickness: int) -> None:
+        if self.canvas.size == 0:
+            return
+        offset = np.array([self.x0, self.y0])
+        cv2.line(self.canvas, tuple(map(int, np.subtract(point_1, offset))),
+                 tuple(map(int, np.subtract(point_2, offset))), color=colour, thickness=thickness)
+
+    def segments(self, starts: np.ndarray, ends: np.ndarray, thicknesses: np.ndarray, colour) -> None:
+        if self.canvas.size == 0:
+            return
+        offset = np.array([self.x0, self.y0])
+        # truncate like int() before moving, so the segments land on the same pixels
+        draw_segments(self.canvas, np.trunc(starts) - offset, np.trunc(ends) - offset, thicknesses, colour)
+
+    def blur(self, kernel_size: int, sigma: float) -> None:
+        if self.canvas.size == 0:
+            return
+        self.canvas = cv2.GaussianBlur(self.canvas, (kernel_size, kernel_size), sigma)
+
+    def add_to(self, frame: np.ndarray) -> np.ndarray:
+        """
+        Adds the glow onto the frame, saturating like cv2.addWeighted(frame, 1, glow, 1, 0).
+        """
+        if self.canvas.size > 0:
+            region = frame[self.y0:self.y1, self.x0:self.x1]
+            frame[self.y0:self.y1, self.x0:self.x1] = cv2.add(region, self.canvas)
+        return frame
+
 
 class FullyConnected(Effect):
     def draw_tracks(self, frame, tracks: List[dict], frame_number: int):
-        out_frame = frame
         state_indexes = [frame_number - track["start_frame"]
                          for track in tracks]
-        states = [track["states"][max(0, i-1)]  # TODO investigate why this offset looks better
-                  for track, i in zip(tracks, state_indexes)]
+        states = np.array([track["states"][max(0, i-1)]  # TODO investigate why this offset looks better
+                           for track, i in zip(tracks, state_indexes)])
+        if len(states) < 2:
+            return frame
         # draw a line between each pair of points
-        for i, state_1 in enumerate(states):
-            for _, state_2 in enumerate(states[i+1:]):
-                # white lines
-                (x1, y1) = state_1[:2]
-                (x2, y2) = state_2[:2]
-                w2 = state_2[4]
-                out_frame = cv2.line(out_frame, (int(x1), int(y1)), (int(
-                    x2), int(y2)), self.colour, thickness=int(w2*self.size))
-        return out_frame
+        first, second = pair_segments(states)
+        return draw_segments(frame, states[first, :2], states[second, :2],
+                             states[second, 4]*self.size, self.colour)
 
 
 class FullyConnectedNeon(Effect):
     def draw_tracks(self, frame, tracks: List[dict], frame_number: int):
-        blank = np.zeros_like(frame, dtype=np.uint8)
         state_indexes = [frame_number - track["start_frame"]
                          for track in tracks]
-        states = [track["states"][max(0, i-1)]  # TODO investigate why this offset looks better
-                  for track, i in zip(tracks, state_indexes)]
+        states = np.array([track["states"][max(0, i-1)]  # TODO investigate why this offset looks better
+                           for track, i in zip(tracks, state_indexes)])
         # draw a line between each pair of points
         if len(states) < 1:
             return frame
 
         width = states[0][4]
-        for i, state_1 in enumerate(states):
-            for _, state_2 in enumerate(states[i+1:]):
-                # white lines
-                (x1, y1) = state_1[:2]
-                (x2, y2) = state_2[:2]
-                w2 = state_2[4]
-                blank = cv2.line(blank, (int(x1), int(y1)), (int(
-                    x2), int(y2)), self.colour, thickness=int(self.size*w2*2))
-
         kernel_size = int(width * self.size * 3)
         if kernel_size % 2 == 0:
             kernel_size += 1
 
-        blank = cv2.GaussianBlur(
-            blank, (kernel_size, kernel_size), self.size//2)
-
-        out_frame = cv2.addWeighted(frame, 1, blank, 1, 0)
+        first, second = pair_segments(states)
+        starts, ends = states[first, :2], states[second, :2]
+        points = [(int(state[0]), int(state[1])) for state in states]
+        thickness = max(int(self.size*state[4]*2) for state in states)
+        glow = Glow(frame, points, thickness, kernel_size // 2)
+        glow.segments(starts, ends, self.size*states[second, 4]*2, self.colour)
 
-        for i, state_1 in enumerate(states):
-            for _, state_2 in enumerate(states[i+1:]):
-                # white lines
-                (x1, y1) = state_1[:2]
-                (x2, y2) = state_2[:2]
-                w2 = state_2[4]
-                out_frame = cv2.line(out_frame, (int(x1), int(y1)), (int(
-                    x2), int(y2)), (255, 255, 255), thickness=int(w2*self.size/2))
+        glow.blur(kernel_size, self.size//2)
+        out_frame = glow.add_to(frame)
 
-        return out_frame
+        # white lines
+        return draw_segments(out_frame, starts, ends, states[second, 4]*self.size/2, (255, 255, 255))
 
 
 class Dot(Effect):
@@ -106,6 +367,19 @@ class Dot(Effect):
 
 
 class LaggingDot(Effect):
+    @property
+    def lookahead(self) -> int:
+        return self.length
+
+    @property
+    def min_track_age(self) -> int:
+        return self.length
+
+    def relevant_interval(self, track: dict) -> Tuple[int, int]:
+        if track["age"] < self.length:
+            return track["start_frame"], track["start_frame"]  # never drawn
+        return track["start_frame"] - self.length, track["start_frame"] + track["age"] + self.length
+
     def relevant(self, track: dict, frame_number: int) -> bool:
         """
         returns True if the frame needs to be modified because of this effect
@@ -136,13 +410,8 @@ class Line(Effect):
                          self.length - track["start_frame"])
         end_line = frame_number - track["start_frame"]
 
-        for i in range(start_line, end_line):
-            (x, y) = track["states"][i][:2]
-            w = track["states"][i][4]
-            (x2, y2) = track["states"][i-1][:2]
-            frame = cv2.line(frame, (int(x), int(y)), (int(x2), int(y2)),
-                             color=self.colour, thickness=int(self.size*w))
-        return frame
+        trail = trail_states(track, start_line, end_line)
+        return draw_segments(frame, trail[1:, :2], trail[:-1, :2], self.size*trail[1:, 4], self.colour)
 
 
 def draw_x(frame, x, y, colour, size: float):
@@ -175,7 +444,7 @@ class Debug(Effect):
                              color=colour, thickness=int(w * self.size))
 
             meas = track["measurements"][i]
-            if meas is None:
+            if meas is None or np.isnan(meas[0]):  # binary tracks store missed measurements as NaN
                 frame = draw_x(frame, x, y, colour, self.size * w)
             else:  # a matched detection
                 mx, my = meas[1:3]
@@ -202,13 +471,8 @@ class TriColor(Effect):
         end_line = frame_number - track["start_frame"]
 
         colour = self.colours[track["id"] % len(self.colours)]
-        for i in range(start_line, end_line):
-            (x, y) = track["states"][i][:2]
-            (x2, y2, _, _, w, _) = track["states"][i-1][:6]
-            frame = cv2.line(frame, (int(x), int(y)), (int(x2), int(y2)),
-                             color=colour, thickness=int(w * self.size))
-
-        return frame
+        trail = trail_states(track, start_line, end_line)
+        return draw_segments(frame, trail[1:, :2], trail[:-1, :2], trail[:-1, 4] * self.size, colour)
 
 
 
@@ -218,21 +482,34 @@ class HighlightLine(Effect):
                          self.length - track["start_frame"])
         end_line = frame_number - track["start_frame"]
 
-        blank = np.zeros_like(frame, dtype=np.uint8)
-
         width = track["states"][0][4]
-        for i in range(start_line, end_line):
-            (x, y) = track["states"][i][:2]
-            (x2, y2) = track["states"][i-1][:2]
-            blank = cv2.line(blank, (int(x), int(y)), (int(x2), int(y2)),
-                             color=self.colour, thickness=int(self.size*width))
+        thickness = int(self.size*width)
+        kernel_size = int(min(width, 1) * self.size * 3)
+        if kernel_size % 2 == 0:
+            kernel_size += 1
+
+        trail = trail_states(track, start_line, end_line)
+        if len(trail) < 2:
+            return frame  # no segments yet, on the first frame of the track
+        glow = Glow(frame, np.trunc(trail[:, :2]), thickness, kernel_size // 2)
+        glow.segments(trail[1:, :2], trail[:-1, :2], np.full(len(trail) - 1, thickness), self.colour)
+        glow.blur(kernel_size, kernel_size//2)
 
+        return glow.add_to(frame)
+
+    def draw_segment(self, trail: TrailBuffer, track: dict, i: int) -> None:
+        width = track["states"][0][4]
+        thickness = int(self.size*width)
         kernel_size = int(min(width, 1) * self.size * 3)
         if kernel_size % 2 == 0:
             kernel_size += 1
-        blank = cv2.GaussianBlur(blank, (kernel_size, kernel_size), kernel_size//2)
 
-        return cv2.addWeighted(frame, 1, blank, 1, 0)
+        (x, y) = track["states"][i][:2]
+        (x2, y2) = track["states"][i-1][:2]
+        glow = Glow(trail.colour, [(int(x), int(y)), (int(x2), int(y2))], thickness, kernel_size // 2)
+        glow.line((int(x), int(y)), (int(x2), int(y2)), self.colour, thickness)
+        glow.blur(kernel_size, kernel_size//2)
+        trail.add_glow(glow)
 
 class NeonLine(Effect):
     def draw(self, frame: np.ndarray, track: dict, frame_number: int) -> np.ndarray:
@@ -240,54 +517,85 @@ class NeonLine(Effect):
                          self.length - track["start_frame"])
         end_line = frame_number - track["start_frame"]
 
-        blank = np.zeros_like(frame, dtype=np.uint8)
-
         width = track["states"][0][4]
-        for i in range(start_line, end_line):
-            (x, y) = track["states"][i][:2]
-            (x2, y2) = track["states"][i-1][:2]
-            blank = cv2.line(blank, (int(x), int(y)), (int(x2), int(y2)),
-                             color=self.colour, thickness=int(self.size*width*2))
-
+        thickness = int(self.size*width*2)
         kernel_size = int(min(width, 10) * self.size * 3)
         if kernel_size % 2 == 0:
             kernel_size += 1
-        blank = cv2.GaussianBlur(blank, (kernel_size, kernel_size), self.size//2)
 
-        intermediate = cv2.addWeighted(frame, 1, blank, 1, 0)
+        trail = trail_states(track, start_line, end_line)
+        if len(trail) < 2:
+            return frame  # no segments yet, on the first frame of the track
+        glow = Glow(frame, np.trunc(trail[:, :2]), thickness, kernel_size // 2)
+        glow.segments(trail[1:, :2], trail[:-1, :2], np.full(len(trail) - 1, thickness), self.colour)
+        glow.blur(kernel_size, self.size//2)
 
-        for i in range(start_line, end_line):
-            (x, y) = track["states"][i][:2]
-            (x2, y2) = track["states"][i-1][:2]
-            blank = cv2.line(intermediate, (int(x), int(y)), (int(x2), int(y2)),
-                             color=(255, 255, 255), thickness=int(self.size*width/2))
-        return intermediate
+        intermediate = glow.add_to(frame)
+
+        return draw_segments(intermediate, trail[1:, :2], trail[:-1, :2],
+                             np.full(len(trail) - 1, int(self.size*width/2)), (255, 255, 255))
+
+    def draw_segment(self, trail: TrailBuffer, track: dict, i: int) -> None:
+        width = track["states"][0][4]
+        thickness = int(self.size*width*2)
+        kernel_size = int(min(width, 10) * self.size * 3)
+        if kernel_size % 2 == 0:
+            kernel_size += 1
+
+        (x, y) = track["states"][i][:2]
+        (x2, y2) = track["states"][i-1][:2]
+        glow = Glow(trail.colour, [(int(x), int(y)), (int(x2), int(y2))], thickness, kernel_size // 2)
+        glow.line((int(x), int(y)), (int(x2), int(y2)), self.colour, thickness)
+        glow.blur(kernel_size, self.size//2)
+        trail.add_glow(glow)
+        trail.line((int(x), int(y)), (int(x2), int(y2)), (255, 255, 255), int(self.size*width/2))
 
 
 class Contrail(Effect):
-    def __init__(self, colour=(255, 0, 0), length_in_frames: int = 15, size: int = 10):
+    def __init__(self, colour=(255, 0, 0), length_in_frames: int = 15, size: int = 10, max_blurs: int = 3):
+        """
+        Args:
+            max_blurs: Most blurs per track per frame. Consecutive segments are blurred together,
+                with one Gaussian as wide as all of their blurs in a row.
+        """
         self.length_in_frames = length_in_frames
-        self.colour = colour
+        self.colour = tuple(map(int, colour))
         self.size = size if size % 2 == 1 else size + 1  # must be odd
+        self.max_blurs = max_blurs
 
     def draw(self, frame: np.ndarray, track: dict, frame_number: int) -> np.ndarray:
         start_line = max(1, frame_number -
                          self.length_in_frames - track["start_frame"])
         end_line = frame_number - track["start_frame"]
+        if end_line <= start_line:
+            return frame
 
-        blank = np.zeros_like(frame, dtype=np.uint8)
-
+        kernel_sizes = {}
         for i in range(start_line, end_line):
-            (x, y) = track["states"][i][:2]
-            (x2, y2) = track["states"][i-1][:2]
-            w = track["states"][i][4]
-            kernel_size = int(self.size*w)
+            kernel_size = int(self.size*track["states"][i][4])
             if kernel_size % 2 == 0:
                 kernel_size += 1 # make odd for gaussian blur
-
-            blank = cv2.line(blank, (int(x), int(y)), (int(x2), int(y2)),
-                             color=self.colour, thickness=kernel_size)
-            blank = cv2.GaussianBlur(
-                blank, (kernel_size, kernel_size), kernel_size//2)
-
-        return cv2.addWeighted(frame, 1, blank, 1, 0)
+            kernel_sizes[i] = kernel_size
+
+        # older segments are blurred again along with the newer ones, which fades the trail out.
+        # Blurring a group of segments at once uses the Gaussian that blurring them one after the
+        # other would add up to: variances add, and the kernel keeps the same width per sigma.
+        groups = np.array_split(np.arange(start_line, end_line), min(self.max_blurs, end_line - start_line))
+        blurs = []
+        for group in groups:
+            group_sizes = np.array([kernel_sizes[i] for i in group])
+            kernel_size = int(round(np.sqrt((group_sizes ** 2).sum())))
+            if kernel_size % 2 == 0:
+                kernel_size += 1
+            blurs.append((kernel_size, np.sqrt(((group_sizes // 2) ** 2).sum())))
+
+        trail = trail_states(track, start_line, end_line)
+        glow = Glow(frame, np.trunc(trail[:, :2]), max(kernel_sizes.values()),
+                    sum(kernel_size // 2 for kernel_size, _ in blurs))
+        for group, (kernel_size, sigma) in zip(groups, blurs):
+            segments = group - start_line
+            glow.segments(trail[segments + 1, :2], trail[segments, :2],
+                          np.array([kernel_sizes[i] for i in group]), self.colour)
+            glow.blur(kernel_size, sigma)
+
+        return glow.add_to(frame)
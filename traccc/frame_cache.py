@@ -0,0 +1,194 @@
+"""
+An on-disk cache of decoded frames, shared by the stages of the pipeline. A video that's already
+in the cache is read back from disk instead of being decoded again, like when the same clip is
+drawn over and over with different effects.
+Each entry holds the raw frames of one video, in a single file that is memory-mapped when read,
+with a small JSON file describing it. Entries are keyed by a hash of the video file, and the least
+recently used ones are evicted to keep the cache under its size limit.
+"""
+import hashlib
+import json
+import os
+from functools import lru_cache
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+import skvideo.io
+
+from traccc.video import display_size, read_video
+
+CACHE_DIR = "internal/frame_cache"
+
+
+def file_hash(path: str) -> str:
+    """
+    Hashes the contents of a file. The hash is remembered for as long as the file isn't modified.
+    """
+    stat = os.stat(path)
+    return _file_hash(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+@lru_cache(maxsize=64)
+def _file_hash(path: str, file_size: int, mtime_ns: int) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def probe_frames(input_file: str) -> Tuple[int, int]:
+    """
+    Returns:
+        The number of frames in a video, and the bytes each decoded frame takes up.
+    """
+    metadata = skvideo.io.ffprobe(input_file)
+    width, height = display_size(metadata)
+    return int(metadata['video']['@nb_frames']), width * height * 3
+
+
+class FrameCache:
+    """
+    Reads videos through the cache. Only reads of a whole video fill the cache; reads of part of
+    a video come from the cache if the video is already in it, and are decoded otherwise.
+    """
+
+    def __init__(self, path: str = CACHE_DIR, max_bytes: int = 20 * 10**9):
+        """
+        Args:
+            path: Directory the cache is kept in.
+            max_bytes: Size limit of the cache. Videos bigger than this are never cached.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def read_video(self, input_file: str, start_frame: int = 0, num_frames: Optional[int] = None,
+                   reuse_buffer: bool = False, key: Optional[str] = None) -> Iterator[np.ndarray]:
+        """
+        Returns a generator over the frames of a video, like traccc.video.read_video.
+        Args:
+            key: The video's key, from cache_key, so it isn't hashed again. None to hash it here.
+        """
+        frame_count, frame_bytes = probe_frames(input_file)
+        entry_bytes = frame_count * frame_bytes
+        if entry_bytes > self.max_bytes:
+            # can't be cached, don't spend time hashing the file
+            return read_video(input_file, start_frame, num_frames, reuse_buffer=reuse_buffer)
+
+        key = file_hash(input_file) if key is None else key
+        entry = self._load(key)
+        if entry is not None:
+            frames = entry[start_frame:] if num_frames is None else entry[start_frame:start_frame + num_frames]
+            return _copy_frames(frames, reuse_buffer)
+
+        frames = read_video(input_file, start_frame, num_frames, reuse_buffer=reuse_buffer)
+        if start_frame > 0 or (num_frames is not None and num_frames < frame_count):
+            return frames
+        self._evict(self.max_bytes - entry_bytes)
+        return self._fill(key, frames)
+
+    def entries(self) -> List[str]:
+        """
+        The keys of the complete entries, from least to most recently used.
+        """
+        if not os.path.isdir(self.path):
+            return []
+        keys = [name[:-len(".json")] for name in os.listdir(self.path) if name.endswith(".json")]
+        return sorted(keys, key=lambda key: os.stat(self._raw_path(key)).st_mtime_ns)
+
+    def _raw_path(self, key: str) -> str:
+        return os.path.join(self.path, key + ".raw")
+
+    def _meta_path(self, key: str) -> str:
+        return os.path.join(self.path, key + ".json")
+
+    def _load(self, key: str) -> Optional[np.ndarray]:
+        if not os.path.exists(self._meta_path(key)):
+            return None
+        with open(self._meta_path(key), 'r') as f:
+            meta = json.load(f)
+        os.utime(self._raw_path(key))  # mark it as recently used
+        if meta["frames"] == 0:
+            return np.empty((0, meta["height"], meta["width"], 3), dtype=np.uint8)  # can't memory-map an empty file
+        return np.memmap(self._raw_path(key), dtype=np.uint8, mode='r',
+                         shape=(meta["frames"], meta["height"], meta["width"], 3))
+
+    def _evict(self, target_bytes: int) -> None:
+        """
+        Removes the least recently used entries until the cache holds at most target_bytes.
+        """
+        keys = self.entries()
+        used = sum(os.path.getsize(self._raw_path(key)) for key in keys)
+        for key in keys:
+            if used <= target_bytes:
+                return
+            used -= os.path.getsize(self._raw_path(key))
+            os.remove(self._meta_path(key))  # the entry stops being complete before its frames go
+            os.remove(self._raw_path(key))
+
+    def _fill(self, key: str, frames: Iterator[np.ndarray]) -> Iterator[np.ndarray]:
+        """
+        Passes the decoded frames through, writing them to a new entry on the way. The entry is
+        only kept if every frame of the video went through.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        temp_path = f"{self._raw_path(key)}.{os.getpid()}.tmp"
+        num_frames = 0
+        shape = None
+        complete = False
+        try:
+            with open(temp_path, 'wb') as f:
+                for frame in frames:
+                    f.write(np.ascontiguousarray(frame).data)
+                    shape = frame.shape
+                    num_frames += 1
+                    yield frame
+            complete = True
+        finally:
+            if complete and shape is not None:
+                os.replace(temp_path, self._raw_path(key))
+                temp_meta = f"{self._meta_path(key)}.{os.getpid()}.tmp"
+                with open(temp_meta, 'w') as f:
+                    json.dump({"frames": num_frames, "height": shape[0], "width": shape[1]}, f)
+                os.replace(temp_meta, self._meta_path(key))  # atomic, the entry is complete
+            else:
+                os.remove(temp_path)
+
+
+def _copy_frames(frames: np.ndarray, reuse_buffer: bool) -> Iterator[np.ndarray]:
+    # the cached frames are read-only, and the consumer draws on the frames it gets
+    buffer = np.empty(frames.shape[1:], dtype=np.uint8)
+    for frame in frames:
+        if reuse_buffer:
+            np.copyto(buffer, frame)
+            yield buffer
+        else:
+            yield frame.copy()
+
+
+def cache_key(input_file: str, cache_gb: float) -> Optional[str]:
+    """
+    The key of a video in the frame cache, or None if it can't be cached. Worked out once and
+    passed to the worker processes, so they don't each hash the whole video, since the hashes
+    are only remembered within a process.
+    """
+    if cache_gb <= 0:
+        return None
+    frame_count, frame_bytes = probe_frames(input_file)
+    if frame_count * frame_bytes > int(cache_gb * 10**9):
+        return None
+    return file_hash(input_file)
+
+
+def open_video(input_file: str, start_frame: int = 0, num_frames: Optional[int] = None,
+               reuse_buffer: bool = False, cache_gb: float = 0, key: Optional[str] = None) -> Iterator[np.ndarray]:
+    """
+    Reads a video through the frame cache, or straight from the file if cache_gb is 0.
+    Args:
+        cache_gb: Size limit of the frame cache, in gigabytes.
+        key: The video's key in the cache, from cache_key, or None to work it out.
+    """
+    if cache_gb <= 0:
+        return read_video(input_file, start_frame, num_frames, reuse_buffer=reuse_buffer)
+    return FrameCache(max_bytes=int(cache_gb * 10**9)).read_video(
+        input_file, start_frame, num_frames, reuse_buffer=reuse_buffer, key=key)
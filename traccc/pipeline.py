@@ -0,0 +1,107 @@
+"""
+Helpers for running the stages of the pipeline concurrently, connected by bounded queues.
+Decoding happens in an ffmpeg subprocess and numpy/torch release the GIL for the heavy lifting,
+so threads are enough to overlap decoding, inference and writing.
+"""
+from queue import Full, Queue
+from threading import Event, Thread
+from typing import Any, Callable, Iterable, Iterator
+
+_DONE = object()  # marks the end of a queue
+
+
+def prefetch(iterable: Iterable, depth: int) -> Iterator:
+    """
+    Iterates over iterable on a background thread, keeping up to depth items ready
+    ahead of the consumer. Exceptions raised while producing are re-raised in the consumer.
+    Args:
+        iterable: The iterable to run ahead of the consumer, like a video reader.
+        depth: Maximum number of items waiting in the queue.
+    """
+    queue = Queue(maxsize=depth)
+    stop = Event()
+
+    def put(item) -> bool:
+        # don't block forever if the consumer has gone away
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((_DONE, None))
+        except Exception as e:  # pylint: disable=broad-except
+            put((_DONE, e))
+
+    thread = Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if item is _DONE:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class BackgroundWriter:
+    """
+    Calls write_fn on every item put into it, on a background thread. Used as a context manager,
+    leaving the block waits for every item to be written. Exceptions raised while writing are
+    re-raised in the thread that puts items.
+    """
+
+    def __init__(self, write_fn: Callable[[Any], None], depth: int):
+        """
+        Args:
+            write_fn: Function called on every item, in order.
+            depth: Maximum number of items waiting to be written.
+        """
+        self.write_fn = write_fn
+        self.queue = Queue(maxsize=max(1, depth))
+        self.error = None
+        self.thread = Thread(target=self._consume, daemon=True)
+        self.thread.start()
+
+    def _consume(self):
+        while True:
+            item = self.queue.get()
+            if item is _DONE:
+                return
+            if self.error is None:  # after a failure, just drain the queue
+                try:
+                    self.write_fn(item)
+                except Exception as e:  # pylint: disable=broad-except
+                    self.error = e
+
+    def put(self, item) -> None:
+        if self.error is not None:
+            raise self.error
+        self.queue.put(item)
+
+    def close(self) -> None:
+        """
+        Waits for all items to be written.
+        """
+        if self.thread.is_alive():
+            self.queue.put(_DONE)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
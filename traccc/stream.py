@@ -0,0 +1,153 @@
+"""
+Runs detection, tracking and drawing in a single pass over the video.
+Each frame is decoded once, and goes straight from the detector to the tracker to the drawing,
+without writing detections or tracks to internal/ in between.
+"""
+import argparse
+import os
+from typing import List, Optional
+
+import gradio as gr
+import skvideo.io
+import torch
+from tqdm import tqdm
+
+from traccc.detect import load_detector, model_selector
+from traccc.detectors import batch_frames
+from traccc.draw import DelayedDrawer, effect_selector, hex_to_rgb
+from traccc.pipeline import prefetch
+from traccc.track import OnlineTracker, filter_detections, track_type_dict
+from traccc.video import VideoWriter, display_size, encoder_settings, frame_rate, read_video
+
+
+@torch.no_grad()
+def run_stream(input_file: str, output: str, model: str, effect_name: str,
+               prompts: Optional[List[str]] = None, batch_size: int = 4, prefetch_depth: int = 8,
+               track_type: str = "Constant Velocity", death_time: int = 5,
+               iou_threshold: float = 0.2, conf_threshold: float = 0.05, max_cost: float = 200,
+               colour: str = "#ff0000", size: float = 1.0, length: int = 10, min_age: int = 0,
+               codec: str = "libx264", preset: Optional[str] = "veryfast", crf: Optional[int] = 23,
+               encoder_threads: int = 0, scale: float = 1.0, tile_size: Optional[int] = None,
+               progress=gr.Progress(track_tqdm=True)):
+    """
+    Detects, tracks and draws an effect on a video in one pass.
+    Inputs are already expected to be sanitized.
+    Args:
+        input_file: Path to the input video file.
+        output: Path to the output video file.
+        model: Model name to use for detection.
+        effect_name: Name of the effect to be used.
+        prompts: List of prompts for detection.
+        batch_size: Number of frames passed through the model at once.
+        prefetch_depth: Number of frames decoded ahead of the model, on a separate thread.
+        track_type: Type of the track to be used (Constant Velocity or Acceleration).
+        death_time: Number of frames without an observation before a track is deleted.
+        iou_threshold: IoU threshold used in Non-Max Suppression filtering.
+        conf_threshold: Confidence threshold for removing uncertain predictions.
+        max_cost: The maximum cost tolerated to match a track to a detection.
+        colour: Colour of the effect in hex format.
+        size: Size of the effect, relative to the width of the object.
+        length: Length of the effect in frames.
+        min_age: Minimum age (in frames) for tracks to be drawn.
+        codec: ffmpeg video encoder used for the output, like libx264, libx265 or mpeg4.
+        preset: Encoder speed preset. None for encoders without presets.
+        crf: Constant rate factor of the encoder, lower is better quality. None for encoders
+            without it.
+        encoder_threads: Number of encoder threads, 0 lets ffmpeg choose.
+        scale: Factor the frames are downscaled by before detection.
+        tile_size: Side of the overlapping tiles the frames are detected in, or None to detect
+            whole frames.
+        progress: Gradio progress tracker.
+    """
+    metadata = skvideo.io.ffprobe(input_file)
+    frame_count = int(metadata['video']['@nb_frames'])
+    width, height = display_size(metadata)
+
+    detector = load_detector(model, batch_size, scale, tile_size)
+    if prompts is not None:
+        detector.embed_prompts(prompts)
+    tracker = OnlineTracker(track_type_dict[track_type], death_time=death_time, max_cost=max_cost)
+    effect = effect_selector[effect_name](hex_to_rgb(colour), length, size)
+    # frames wait here until the tracks drawn on them are settled
+    drawer = DelayedDrawer(effect, min_age)
+
+    video = read_video(input_file)
+    if prefetch_depth > 0:
+        video = prefetch(video, prefetch_depth)
+    with VideoWriter(output, width, height, frame_rate(metadata), codec=codec, preset=preset, crf=crf,
+                     threads=encoder_threads, audio_source=input_file) as writer, \
+            tqdm(total=frame_count) as progress_bar:
+        for frames in batch_frames(video, batch_size):
+            batch_detections = filter_detections(
+                detector.detect_batch(frames), conf_threshold, iou_threshold)
+            for frame, frame_detections in zip(frames, batch_detections):
+                active, finished = tracker.step(frame_detections)
+                for out_frame in drawer.push(frame, active, finished):
+                    writer.write(out_frame)
+            progress_bar.update(len(frames))
+        for out_frame in drawer.flush(tracker.finish()):
+            writer.write(out_frame)
+    return f"successfully wrote video {output}."
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Detects, tracks and draws effects on a video in a single pass.")
+    parser.add_argument("name", help="name of the project")
+    parser.add_argument("--input", help="video file to be used", default=None)
+    parser.add_argument("--output", help="the output file", default=None)
+    parser.add_argument("--model", help="choice of model", default="DETR")
+    parser.add_argument("--prompts", help="comma separated prompts, for zero-shot models", default=None)
+    parser.add_argument(
+        "--batch_size", help="number of frames passed through the model at once", default=4)
+    parser.add_argument(
+        "--track_type", help="track type", default="Constant Velocity")
+    parser.add_argument(
+        "--death_time", help="number of frames without an observation before track deletion", default=5)
+    parser.add_argument(
+        "--iou_threshold", help="IoU threshold used in Non-Max Suppression filtering, must be in the range [0, 1].", default=0.2)
+    parser.add_argument(
+        "--conf_threshold", help="confidence threshold for removing uncertain predictions, must be in the range [0, 1].", default=0.05)
+    parser.add_argument(
+        "--max_cost", help="the maximum cost tolerated to match a track to a detection.", default=200)
+    parser.add_argument(
+        "--effect", help="name of effect you wish to use", default="line")
+    parser.add_argument("--colour", help="colour of the effect", default="#ff0000")
+    parser.add_argument(
+        "--length", help="length of the effect in frames", default=10)
+    parser.add_argument(
+        "--size", help="size or width of the effect", default=1.0)
+    parser.add_argument(
+        "--min_age", help="tracks below this age don't get drawn", default=0)
+    parser.add_argument("--codec", help="ffmpeg video encoder for the output", default="libx264")
+    parser.add_argument("--preset", help="encoder speed preset, veryfast by default for x264 and x265",
+                        default=None)
+    parser.add_argument("--crf", help="constant rate factor, lower is better quality, 23 by default for x264 and x265",
+                        default=None)
+    parser.add_argument(
+        "--encoder_threads", help="number of encoder threads, 0 lets ffmpeg choose", default=0)
+    parser.add_argument(
+        "--scale", help="factor the frames are downscaled by before detection", default=1.0)
+    parser.add_argument(
+        "--tile_size", help="detect on overlapping square tiles of this size, for small objects", default=None)
+    args = parser.parse_args()
+    name = args.name
+    input_file = args.input if args.input is not None else f"io/{name}.mp4"
+    output = args.output if args.output is not None else f"io/{name}_out.mp4"
+
+    assert os.path.exists(input_file), f"Input file {input_file} does not exist."
+    assert args.model in model_selector, f"Model {args.model} isn't supported"
+    assert args.track_type in track_type_dict, f"Track type {args.track_type} isn't supported"
+    assert args.effect in effect_selector, f"Effect {args.effect} isn't supported"
+
+    prompts = args.prompts.split(",") if args.prompts is not None else None
+    preset, crf = encoder_settings(args.codec, args.preset, None if args.crf is None else int(args.crf))
+    print(run_stream(input_file, output, args.model, args.effect, prompts=prompts,
+                     batch_size=int(args.batch_size), track_type=args.track_type,
+                     death_time=int(args.death_time), iou_threshold=float(args.iou_threshold),
+                     conf_threshold=float(args.conf_threshold), max_cost=float(args.max_cost),
+                     colour=args.colour, size=float(args.size), length=int(args.length),
+                     min_age=int(args.min_age), codec=args.codec, preset=preset,
+                     crf=crf, encoder_threads=int(args.encoder_threads),
+                     scale=float(args.scale),
+                     tile_size=None if args.tile_size is None else int(args.tile_size)))
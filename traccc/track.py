@@ -3,17 +3,21 @@ Module to generate tracks from a list of detections.
 """
 import argparse
 from math import sqrt
-from typing import List, Tuple
+from typing import List, Sequence, Tuple
 import os
 
 import numpy as np
 import torch
-import yaml
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 from torchvision.ops import box_convert, nms
 from tqdm import tqdm
 
-from traccc.trackers import Track, AccelTrack
+from traccc.detection_store import DetectionFile, find_detections, load_detections
+from traccc.track_store import export_yaml, save_tracks, tracks_path
+from traccc.trackers import Track, AccelTrack, TrackBank
 
 
 def euclidean_distance(track: Track, detection: np.ndarray) -> float:
@@ -27,7 +31,91 @@ def euclidean_distance(track: Track, detection: np.ndarray) -> float:
     return sqrt((track.kf.x[0] - detection[1]) ** 2 + (track.kf.x[1] - detection[2]) ** 2)
 
 
-def hungarian_matching(tracks, detections, cost_function=euclidean_distance, max_cost=np.infty):
+def track_states(tracks: List[Track]) -> np.ndarray:
+    """
+    Gathers the current Kalman Filter states of the tracks into a single [T, S] array.
+    """
+    return np.array([track.kf.x for track in tracks])
+
+
+def euclidean_cost_matrix(states: np.ndarray, detections: np.ndarray) -> np.ndarray:
+    """
+    Calculates the euclidean distance in pixel space between every track and every detection at once.
+    Args:
+        states: [T, S] array of track states, with the position in the first two columns.
+        detections: [D, 5] array of detections in (c, x, y, w, h) format.
+    Returns:
+        [T, D] array, where entry (i, j) is the distance from track i to detection j.
+    """
+    offsets = states[:, np.newaxis, :2] - detections[np.newaxis, :, 1:3]
+    return np.sqrt((offsets ** 2).sum(axis=2))
+
+
+def candidate_pairs(states: np.ndarray, detections: np.ndarray, max_cost: float):
+    """
+    Finds the pairs of tracks and detections that are within max_cost of each other in pixel
+    space, with a KD-tree over the detections, without calculating the distance of every pair.
+    Returns:
+        Three arrays of equal length: the track and detection of each pair, and their distance.
+    """
+    tree = cKDTree(detections[:, 1:3])
+    # a little slack, so the tree's rounding can't leave out a pair that's exactly max_cost apart
+    neighbours = tree.query_ball_point(states[:, :2], r=max_cost * (1 + 1e-9))
+    rows = np.repeat(np.arange(len(states)), [len(n) for n in neighbours])
+    cols = np.fromiter((j for n in neighbours for j in n), dtype=np.int64, count=len(rows))
+    offsets = states[rows, :2] - detections[cols, 1:3]
+    costs = np.sqrt((offsets ** 2).sum(axis=1))
+    within = costs <= max_cost
+    return rows[within], cols[within], costs[within]
+
+
+def gated_assignment(num_tracks: int, num_detections: int, rows: np.ndarray, cols: np.ndarray,
+                     costs: np.ndarray, max_cost: float) -> np.ndarray:
+    """
+    Solves the assignment problem using only the candidate pairs. Tracks and detections are
+    split into connected components of the graph of candidate pairs, and each component is
+    solved on its own with a small dense cost matrix.
+    Args:
+        num_tracks: Number of tracks.
+        num_detections: Number of detections.
+        rows: Track of each candidate pair.
+        cols: Detection of each candidate pair.
+        costs: Cost of each candidate pair, at most max_cost.
+        max_cost: The largest cost of a candidate pair.
+    Returns:
+        Indices of the candidate pairs that were matched.
+    """
+    graph = coo_matrix((np.ones(len(rows)), (rows, num_tracks + cols)),
+                       shape=(num_tracks + num_detections,) * 2)
+    num_components, labels = connected_components(graph, directed=False)
+    pair_labels = labels[rows]
+
+    # a component with a single pair doesn't need solving
+    pairs_per_component = np.bincount(pair_labels, minlength=num_components)
+    single = (pairs_per_component == 1) & (np.bincount(labels, minlength=num_components) == 2)
+    matched = [np.flatnonzero(single[pair_labels])]
+
+    order = np.argsort(pair_labels, kind="stable")
+    bounds = np.searchsorted(pair_labels[order], np.arange(num_components + 1))
+    for label in np.flatnonzero(~single & (pairs_per_component > 0)):
+        pairs = order[bounds[label]:bounds[label + 1]]
+        _, local_rows = np.unique(rows[pairs], return_inverse=True)
+        _, local_cols = np.unique(cols[pairs], return_inverse=True)
+        shape = (local_rows.max() + 1, local_cols.max() + 1)
+        # leaving a pair unmatched must always be worse than any matching of candidates
+        cost_matrix = np.full(shape, max_cost * (min(shape) + 1) + 1, dtype=float)
+        cost_matrix[local_rows, local_cols] = costs[pairs]
+        pair_index = np.full(shape, -1)
+        pair_index[local_rows, local_cols] = pairs
+        matched_pairs = pair_index[linear_sum_assignment(cost_matrix)]
+        matched.append(matched_pairs[matched_pairs >= 0])
+
+    matched = np.concatenate(matched)
+    return matched[np.argsort(rows[matched])]
+
+
+def hungarian_matching(tracks, detections, cost_function=euclidean_distance, max_cost=np.infty,
+                       batch_cost_function=euclidean_cost_matrix):
     """
     Finds the minimum cost matching between tracks and detections, based on
     some distance metric. Returns a permutation of detections that orders them
@@ -35,25 +123,54 @@ def hungarian_matching(tracks, detections, cost_function=euclidean_distance, max
     If there are more detections that tracks, the detections permuted to the end
     returns the scalar of the cost of all the matches, as well as two arrays of equal
     length. row_ind[x] is the track that matches with col_ind[x] detection.
+    With a finite max_cost, pairs that cost more are never considered: the matching
+    makes as many reasonable pairs as it can, and the fewest total cost among those.
+    The euclidean cost finds the reasonable pairs with a KD-tree instead of building
+    the whole cost matrix.
+    This isn't the same as matching every pair and then dropping the ones over max_cost,
+    which is what this used to do. There, the cost of a pair that's dropped anyway still
+    counts, so a detection could go to a farther track, because giving the nearer track a
+    far-off detection was cheaper overall, and then that far-off pair was dropped.
+    Args:
+        tracks: List of tracks, or a [T, S] array of their states.
+        detections: [D, 5] array of detections in (c, x, y, w, h) format.
+        cost_function: Cost of a single (track, detection) pair, called on every pair. The
+            default, euclidean_distance, isn't called: batch_cost_function gives the same costs
+            for every pair at once. None also uses batch_cost_function.
+        max_cost: Matches that cost more than this are left unpaired.
+        batch_cost_function: Takes a [T, S] array of track states and the [D, 5] detections,
+            and returns the [T, D] cost matrix.
     """
-    cost_matrix = np.zeros((len(tracks), len(detections)))
-    for i, track in enumerate(tracks):
-        for j, detection in enumerate(detections):
-            cost_matrix[i][j] = cost_function(track, detection)
-
-    row_ind, col_ind = linear_sum_assignment(cost_matrix)
-
-    # remove ridiculous matches; it's better to leave them unpaired
-    for i, j in zip(row_ind, col_ind):
-        if cost_matrix[i, j] > max_cost:
-            row_ind = np.delete(row_ind, np.where(row_ind == i))
-            col_ind = np.delete(col_ind, np.where(col_ind == j))
-    cost = cost_matrix[row_ind, col_ind].sum()
-    return cost, row_ind, col_ind
+    detections = np.asarray(detections)
+    if cost_function is euclidean_distance:
+        cost_function = None
+    states = None
+    if cost_function is None:
+        states = tracks if isinstance(tracks, np.ndarray) else track_states(tracks)
+
+    if np.isfinite(max_cost) and batch_cost_function is euclidean_cost_matrix and states is not None:
+        rows, cols, costs = candidate_pairs(states, detections, max_cost)
+    else:
+        if cost_function is not None:
+            cost_matrix = np.zeros((len(tracks), len(detections)))
+            for i, track in enumerate(tracks):
+                for j, detection in enumerate(detections):
+                    cost_matrix[i][j] = cost_function(track, detection)
+        else:
+            cost_matrix = batch_cost_function(states, detections)
+
+        if not np.isfinite(max_cost):
+            row_ind, col_ind = linear_sum_assignment(cost_matrix)
+            return cost_matrix[row_ind, col_ind].sum(), row_ind, col_ind
+        rows, cols = np.nonzero(cost_matrix <= max_cost)
+        costs = cost_matrix[rows, cols]
+
+    matched = gated_assignment(len(tracks), len(detections), rows, cols, costs, max_cost)
+    return costs[matched].sum(), rows[matched], cols[matched]
 
 
 def track(detections: List[np.ndarray], 
-          track_class, death_time: int = 5, max_cost: float = np.infty):
+          track_class, death_time: int = 5, max_cost: float = np.infty, batched: bool = True):
     """
     Tracks objects in a sequence of detections using a Kalman Filter.
     Args:
@@ -62,9 +179,14 @@ def track(detections: List[np.ndarray],
         track_class: The class of the track to be used (Track or AccelTrack).
         death_time: Number of frames without an observation before a track is deleted.
         max_cost: Maximum cost tolerated to match a track to a detection.
+        batched: Run the Kalman Filters of all tracks at once in a TrackBank, instead of
+            calling each track's own filter. Both give the same tracks.
     Returns:
         List of tracks that were generated throughout the sequence.
     """
+    if batched:
+        return track_batched(detections, track_class, death_time=death_time, max_cost=max_cost)
+
     next_track_id = 0  # counter for track IDs
     inactive_tracks = []
     tracks = []
@@ -117,29 +239,175 @@ def track(detections: List[np.ndarray],
     return inactive_tracks
 
 
-def filter_detections(detections: List[np.ndarray],
+class OnlineTracker:
+    """
+    Tracks objects one frame at a time, as the detections come in. Uses the same births, deaths
+    and matching as track, with the Kalman Filters of all active tracks stacked in a TrackBank.
+    Tracks are handed back as soon as they die and aren't kept afterwards, so memory only grows
+    with the number of active tracks.
+    """
+
+    def __init__(self, track_class, death_time: int = 5, max_cost: float = np.infty):
+        """
+        Args:
+            track_class: The class of the track to be used (Track or AccelTrack).
+            death_time: Number of frames without an observation before a track is deleted.
+            max_cost: Maximum cost tolerated to match a track to a detection.
+        """
+        self.track_class = track_class
+        self.death_time = death_time
+        self.max_cost = max_cost
+        self.frame_number = 0  # frame that the next step will track
+        self.next_track_id = 0  # counter for track IDs
+        self.tracks = []  # active tracks; row i of the bank belongs to tracks[i]
+        self.bank = TrackBank(track_class)
+
+    def step(self, frame_detections: np.ndarray) -> Tuple[List[Track], List[Track]]:
+        """
+        Tracks the detections of the next frame.
+        Args:
+            frame_detections: [N, 5] array of the detections in this frame, in (c, x, y, w, h) format.
+        Returns:
+            The tracks that are still active, and the tracks that died in this frame.
+            The history of the active tracks is up to date, but their Kalman Filters are only
+            written back from the bank once they finish.
+        """
+        frame_detections = np.asarray(frame_detections)
+        self.bank.predict()  # advance all the Kalman Filters, to get the priors for this timestep
+        priors = self.bank.x
+
+        row_ind = col_ind = np.zeros(0, dtype=int)
+        if len(frame_detections) > 0 and len(self.tracks) > 0:
+            _, row_ind, col_ind = hungarian_matching(priors, frame_detections, max_cost=self.max_cost)
+
+        measurements = [None] * len(self.tracks)
+        for i, j in zip(row_ind, col_ind):
+            measurements[i] = frame_detections[j]
+        for track, prior, measurement in zip(self.tracks, priors, measurements):
+            track.record(prior, measurement)
+        self.bank.update(row_ind, frame_detections[col_ind, 1:5] if len(col_ind) > 0 else None)
+
+        # handle deaths; if a track hasn't been seen in a few frames, deactivate it
+        active = np.array([track.active for track in self.tracks], dtype=bool)
+        finished = [track for track in self.tracks if not track.active]
+        self.bank.write_back(finished, np.flatnonzero(~active))
+        self.tracks = [track for track in self.tracks if track.active]
+        self.bank.keep(active)
+
+        # births, in the same order as the unbatched tracker
+        unmatched = np.ones(len(frame_detections), dtype=bool)
+        unmatched[col_ind] = False
+        for i in np.flatnonzero(unmatched):
+            new_track = self.track_class(self.next_track_id, frame_detections[i], self.frame_number,
+                                         death_time=self.death_time)
+            self.tracks.append(new_track)
+            self.bank.add(new_track)
+            self.next_track_id += 1
+
+        self.frame_number += 1
+        return self.tracks, finished
+
+    def finish(self) -> List[Track]:
+        """
+        Ends tracking, handing back the tracks that were still active.
+        """
+        self.bank.write_back(self.tracks, range(len(self.tracks)))
+        finished, self.tracks = self.tracks, []
+        self.bank.keep(np.zeros(len(self.bank), dtype=bool))
+        return finished
+
+
+def track_batched(detections: List[np.ndarray],
+                  track_class, death_time: int = 5, max_cost: float = np.infty):
+    """
+    Same as track, but runs an OnlineTracker over the detections, which predicts and updates
+    the Kalman Filters of all active tracks at once.
+    """
+    tracker = OnlineTracker(track_class, death_time=death_time, max_cost=max_cost)
+    inactive_tracks = []
+    for frame_detections in tqdm(detections):
+        _, finished = tracker.step(frame_detections)
+        inactive_tracks.extend(finished)
+    inactive_tracks.extend(tracker.finish())
+    return inactive_tracks
+
+
+def detection_rows(detections: Sequence[np.ndarray]) -> np.ndarray:
+    """
+    Gathers the detections of a whole video into one [N, 6] array of (frame, c, x, y, w, h) rows,
+    sorted by frame. A memory-mapped DetectionFile already stores them that way.
+    """
+    if isinstance(detections, DetectionFile):
+        return detections.rows
+    counts = [len(frame_detections) for frame_detections in detections]
+    rows = np.empty((sum(counts), 6), dtype=np.float32)
+    rows[:, 0] = np.repeat(np.arange(len(counts)), counts)
+    if len(rows) > 0:
+        rows[:, 1:] = np.concatenate([np.reshape(d, (-1, 5)) for d in detections])
+    return rows
+
+
+def frame_nms(frames: np.ndarray, xyxy: torch.Tensor, scores: torch.Tensor,
+              iou_threshold: float, boxes_per_call: int = 4096) -> np.ndarray:
+    """
+    Non-Max Suppression where boxes are only suppressed by boxes of the same frame.
+    To do that in one NMS call, each frame's boxes are shifted so they can't overlap any other
+    frame's, like torchvision's batched_nms. NMS takes quadratic time in the number of boxes, so
+    the frames are handed over in groups of about boxes_per_call boxes.
+    Args:
+        frames: [N] array of the frame of each box, sorted.
+        xyxy: [N, 4] float64 tensor of boxes in (x1, y1, x2, y2) format. float64, so the shifted
+            coordinates of far away frames keep their precision.
+        scores: [N] tensor of the confidence of each box.
+        iou_threshold: Boxes overlapping a more confident box of the same frame by more than
+            this IoU are suppressed.
+        boxes_per_call: Rough number of boxes in each NMS call.
+    Returns:
+        The indices of the boxes that were kept, by frame, and by decreasing confidence within a frame.
+    """
+    shift = (xyxy.max() - xyxy.min()).item() + 1 if len(frames) > 0 else 0
+
+    keep = []
+    group_starts = np.arange(0, len(frames), boxes_per_call)
+    # extend each group to the end of its last frame, so no frame is split between two calls
+    group_starts = np.unique(np.searchsorted(frames, frames[group_starts], side="left"))
+    for start, end in zip(group_starts, np.append(group_starts[1:], len(frames))):
+        group_frames = torch.from_numpy(frames[start:end] - frames[start])
+        shifted = xyxy[start:end] + (group_frames * shift)[:, None]
+        keep.append(nms(shifted, scores[start:end], iou_threshold=iou_threshold).numpy() + start)
+    keep = np.concatenate(keep) if len(keep) > 0 else np.zeros(0, dtype=np.int64)
+
+    # nms sorts by confidence; put the frames back in order, keeping that order within each frame
+    return keep[np.argsort(frames[keep], kind="stable")]
+
+
+def filter_detections(detections: Sequence[np.ndarray],
                       conf_threshold: float = 0.0,
-                      iou_threshold: float =0.5) -> List[np.ndarray]:
+                      iou_threshold: float = 0.5,
+                      boxes_per_call: int = 4096) -> List[np.ndarray]:
     """
-    Applies confidence filtering and Non-Max Suppression.
+    Applies confidence filtering and Non-Max Suppression to the detections of a whole video at once.
+    Boxes are only suppressed by boxes of the same frame, see frame_nms.
     Args:
-        detections: List of ndarray, where each ndarray is a [N, 5] array, a list of detections.
+        detections: Sequence of ndarray, where each ndarray is a [N, 5] array, a list of detections.
             Each detection is a tuple of 5 elements: (c, x, y, w, h).
         conf_threshold: Confidence threshold for removing uncertain predictions.
         iou_threshold: IoU threshold used in Non-Max Suppression filtering.
+        boxes_per_call: Rough number of boxes in each NMS call.
+    Returns:
+        List of [N, 5] arrays, one per frame, each sorted by decreasing confidence. They are
+        views into one array of all the detections that were kept.
     """
-    filtered_detections = []
-    for frame_detections in detections:
-        conf = frame_detections[:, 0]
-        frame_detections = torch.Tensor(
-            frame_detections[conf > conf_threshold])
+    rows = detection_rows(detections)
+    rows = rows[rows[:, 1] > conf_threshold]
+    frames = rows[:, 0].astype(np.int64)
 
-        xyxy = box_convert(
-            frame_detections[:, 1:], in_fmt="cxcywh", out_fmt="xyxy")
-        best_candidates = nms(
-            xyxy, frame_detections[:, 0], iou_threshold=iou_threshold)
-        filtered_detections.append(frame_detections[best_candidates].numpy())
-    return filtered_detections
+    xyxy = box_convert(torch.from_numpy(rows[:, 2:].astype(np.float64)), in_fmt="cxcywh", out_fmt="xyxy")
+    keep = frame_nms(frames, xyxy, torch.from_numpy(rows[:, 1].astype(np.float64)),
+                     iou_threshold, boxes_per_call)
+    kept = np.ascontiguousarray(rows[keep, 1:], dtype=np.float32)
+    offsets = np.searchsorted(frames[keep], np.arange(len(detections) + 1), side="left")
+    return [kept[offsets[i]:offsets[i + 1]] for i in range(len(detections))]
 
 
 track_type_dict = {
@@ -149,7 +417,8 @@ track_type_dict = {
 
 
 def run_track(name: str, track_type: str, death_time: int, 
-              iou_threshold: float, conf_threshold: float, max_cost: float) -> str:
+              iou_threshold: float, conf_threshold: float, max_cost: float,
+              yaml_export: bool = False) -> str:
     """
     Runs the tracking portion of the pipeline.
     Args:
@@ -159,15 +428,14 @@ def run_track(name: str, track_type: str, death_time: int,
         iou_threshold: IoU threshold used in Non-Max Suppression filtering.
         conf_threshold: Confidence threshold for removing uncertain predictions.
         max_cost: The maximum cost tolerated to match a track to a detection.
+        yaml_export: Also write the tracks to internal/{name}.yaml, for debugging.
     Returns:
         A message indicating the success of the operation and the number of tracks saved.
     """
 
     # load the raw detections
-    detections = np.load(f"internal/{name}.npz")
-    detections_list = []
-    for frame_name in detections:
-        detections_list.append(detections[frame_name])
+    detections_file = find_detections(name)
+    detections_list = load_detections(detections_file)
 
     # filter out the detections that won't be used
     detections_list = filter_detections(
@@ -177,16 +445,12 @@ def run_track(name: str, track_type: str, death_time: int,
     tracks = track(
         detections_list, track_type_dict[track_type], death_time=death_time, max_cost=max_cost)
 
-    # dump to yaml
-    track_lives = [track.encode_in_dictionary() for track in tracks]
-    dictionary = {
-        "detections_file": f"internal/{name}.npz",
-        "tracks": track_lives
-    }
-    with open(f"internal/{name}.yaml", 'w') as f:
-        yaml.safe_dump(dictionary, f)
-
-    return f"Successfully saved {len(track_lives)} tracks to internal/{name}.yaml"
+    save_tracks(tracks_path(name), tracks, detections_file=detections_file)
+    message = f"Successfully saved {len(tracks)} tracks to {tracks_path(name)}"
+    if yaml_export:
+        export_yaml(tracks_path(name), f"internal/{name}.yaml")
+        message += f" and internal/{name}.yaml"
+    return message
 
 
 if __name__ == "__main__":
@@ -203,11 +467,12 @@ if __name__ == "__main__":
         "--conf_threshold", help="confidence threshold for removing uncertain predictions, must be in the range [0, 1].", default=0.05)
     parser.add_argument(
         "--max_cost", help="the maximum cost tolerated to match a track to a detection.", default=200)
+    parser.add_argument(
+        "--yaml", help="also write the tracks to internal/{name}.yaml, for debugging", action="store_true")
     args = parser.parse_args()
     name = args.name
 
-    assert os.path.exists(
-        f"internal/{name}.npz"), f"Could not find internal/{name}.npz"
+    assert find_detections(name) is not None, f"Could not find detections for {name} in internal/"
     message = run_track(args.name, args.track_type, int(args.death_time), float(
-        args.iou_threshold), float(args.conf_threshold), float(args.max_cost))
+        args.iou_threshold), float(args.conf_threshold), float(args.max_cost), yaml_export=args.yaml)
     print(message)
@@ -0,0 +1,106 @@
+"""
+Binary storage for tracks, handed from the tracking stage to the drawing stage.
+The states and measurements of every track are stored back to back in two contiguous float
+arrays, with a table of per-track metadata saying where each track's rows are. All of them are
+.npy files in one directory, so they can be memory-mapped instead of parsed.
+"""
+import json
+import os
+from typing import List, Optional
+
+import numpy as np
+import yaml
+
+TRACK_TABLE_DTYPE = np.dtype([("id", np.int64), ("start_frame", np.int64),
+                              ("age", np.int64), ("offset", np.int64)])
+
+
+def tracks_path(name: str) -> str:
+    """
+    Where the tracks of a project are stored.
+    """
+    return f"internal/{name}.tracks"
+
+
+def find_tracks(name: str) -> Optional[str]:
+    """
+    Finds the tracks of a project, falling back to the YAML file of older versions.
+    Returns:
+        The path of the tracks, or None if the project has no tracks.
+    """
+    if os.path.exists(os.path.join(tracks_path(name), "tracks.npy")):
+        return tracks_path(name)
+    if os.path.exists(f"internal/{name}.yaml"):
+        return f"internal/{name}.yaml"
+    return None
+
+
+def save_tracks(path: str, tracks: list, detections_file: Optional[str] = None) -> None:
+    """
+    Saves tracks in the binary format.
+    Args:
+        path: Directory to save the tracks in.
+        tracks: The tracks made by the tracker, all of the same track class.
+        detections_file: The detections the tracks were made from.
+    """
+    os.makedirs(path, exist_ok=True)
+    table = np.zeros(len(tracks), dtype=TRACK_TABLE_DTYPE)
+    table["id"] = [track.id for track in tracks]
+    table["start_frame"] = [track.start_frame for track in tracks]
+    table["age"] = [track.age for track in tracks]
+    table["offset"] = np.concatenate(([0], np.cumsum(table["age"])[:-1])) if len(tracks) > 0 else []
+
+    state_dim = len(tracks[0].kf.x) if len(tracks) > 0 else 0
+    states = np.empty((table["age"].sum(), state_dim), dtype=np.float32)
+    # missed measurements are stored as rows of NaN
+    measurements = np.full((table["age"].sum(), 5), np.nan, dtype=np.float32)
+    for track, offset in zip(tracks, table["offset"]):
+        states[offset:offset + track.age] = track.prev_states
+        measurements[offset:offset + track.age] = track.prev_measurements
+
+    np.save(os.path.join(path, "tracks.npy"), table)
+    np.save(os.path.join(path, "states.npy"), states)
+    np.save(os.path.join(path, "measurements.npy"), measurements)
+    with open(os.path.join(path, "meta.json"), 'w') as f:
+        json.dump({"detections_file": detections_file}, f)
+
+
+def load_tracks(path: str) -> List[dict]:
+    """
+    Loads tracks, either from the binary format or from a YAML file.
+    Binary tracks are memory-mapped; the "states" and "measurements" of each track are views
+    into the shared arrays, and missed measurements are rows of NaN.
+    Returns:
+        A list of track dictionaries, with the same keys as Track.encode_in_dictionary.
+    """
+    if path.endswith(".yaml"):
+        with open(path, 'r') as f:
+            return yaml.safe_load(f)["tracks"]
+
+    table = np.load(os.path.join(path, "tracks.npy"))
+    states = np.load(os.path.join(path, "states.npy"), mmap_mode='r')
+    measurements = np.load(os.path.join(path, "measurements.npy"), mmap_mode='r')
+    return [{
+        "id": int(track_id),
+        "start_frame": int(start_frame),
+        "age": int(age),
+        "states": states[offset:offset + age],
+        "measurements": measurements[offset:offset + age]
+    } for track_id, start_frame, age, offset in table.tolist()]
+
+
+def export_yaml(path: str, yaml_path: str) -> None:
+    """
+    Writes binary tracks out as YAML, which is easier to read when debugging.
+    """
+    with open(os.path.join(path, "meta.json"), 'r') as f:
+        detections_file = json.load(f)["detections_file"]
+    tracks = [{
+        "id": track["id"],
+        "start_frame": track["start_frame"],
+        "states": track["states"].tolist(),
+        "measurements": [None if np.isnan(m[0]) else m for m in track["measurements"].tolist()],
+        "age": track["age"]
+    } for track in load_tracks(path)]
+    with open(yaml_path, 'w') as f:
+        yaml.safe_dump({"detections_file": detections_file, "tracks": tracks}, f)
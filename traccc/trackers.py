@@ -1,14 +1,48 @@
+from typing import List, Optional
+
 import numpy as np
 from filterpy.kalman import KalmanFilter
 
+
+class TrackHistory:
+    """
+    The states and measurements of a track, one row per frame, stored in contiguous arrays.
+    The arrays grow in chunks, so appending a frame doesn't allocate anything most of the time.
+    Missed measurements are rows of NaN.
+    """
+    __slots__ = ("states", "measurements", "length")
+
+    def __init__(self, state_dim: int, chunk_size: int = 32):
+        self.states = np.empty((chunk_size, state_dim))
+        self.measurements = np.empty((chunk_size, 5))
+        self.length = 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    def append(self, state: np.ndarray, measurement: Optional[np.ndarray]) -> None:
+        if self.length == len(self.states):
+            # grow by half again, so a long track is copied a logarithmic number of times
+            self.states = self._grow(self.states)
+            self.measurements = self._grow(self.measurements)
+        self.states[self.length] = state
+        self.measurements[self.length] = np.nan if measurement is None else measurement
+        self.length += 1
+
+    def _grow(self, array: np.ndarray) -> np.ndarray:
+        grown = np.empty((len(array) + len(array) // 2 + 1, array.shape[1]))
+        grown[:self.length] = array[:self.length]
+        return grown
+
+
 class Track:
     """
     This is a class representing a single track, ideally a single object and its movements
     """
+    __slots__ = ("id", "start_frame", "death_time", "kf", "age", "time_missing", "active", "history")
 
     def __init__(self, track_id: int, initial_pos: np.ndarray, start_frame: int, death_time: int = 5):
         self.id = track_id
-        self.prev_states = []  # tracks all previous estimates of position, and velocity
         self.start_frame = start_frame
         self.death_time = death_time
 
@@ -35,7 +69,8 @@ class Track:
         self.age = 0  # in the first frame, age is 0
         self.time_missing = 0
         self.active = True
-        self.prev_measurements = []
+        # tracks all previous estimates of position and velocity, and the measurements
+        self.history = TrackHistory(self.kf.dim_x)
 
     def predict(self) -> None:
         """
@@ -47,18 +82,38 @@ class Track:
         """
         Update our estimate of the state given the measurement. Calculate the posterior.
         """
-        self.prev_states.append(self.kf.x)
-        self.prev_measurements.append(measurement)
+        self.record(self.kf.x, measurement)
+        if measurement is not None:
+            # measurement comes in as cxywh
+            assert len(measurement) == 5
+            measurement_xywh = measurement[1:5]
+            self.kf.update(measurement_xywh)
+
+    def record(self, state: np.ndarray, measurement: Optional[np.ndarray]) -> None:
+        """
+        Records the predicted state and the measurement of this frame, and ages the track.
+        """
+        self.history.append(state, measurement)
         self.age += 1
         if measurement is None:  # on this iteration, didn't see this object
             self.time_missing += 1
             if self.time_missing > self.death_time:
                 self.active = False
-        else:
-            # measurement comes in as cxywh
-            assert len(measurement) == 5
-            measurement_xywh = measurement[1:5]
-            self.kf.update(measurement_xywh)
+
+    @property
+    def prev_states(self) -> np.ndarray:
+        """
+        [age, S] array of the predicted state in every frame of the track.
+        """
+        return self.history.states[:self.history.length]
+
+    @property
+    def prev_measurements(self) -> np.ndarray:
+        """
+        [age, 5] array of the (c, x, y, w, h) measurement in every frame of the track.
+        Frames where the track wasn't seen are rows of NaN.
+        """
+        return self.history.measurements[:self.history.length]
 
     def encode_in_dictionary(self) -> dict:
         """
@@ -68,18 +123,18 @@ class Track:
         life = {
             "id": self.id,
             "start_frame": self.start_frame,
-            "states": [a.tolist() for a in self.prev_states],
-            "measurements": [a.tolist() if a is not None else None
-                             for a in self.prev_measurements],
+            "states": self.prev_states.tolist(),
+            "measurements": [None if np.isnan(m[0]) else m for m in self.prev_measurements.tolist()],
             "age": self.age
         }
         return life
 
 
 class AccelTrack(Track):
+    __slots__ = ()
+
     def __init__(self, track_id: int, initial_pos: np.ndarray, start_frame: int, death_time: int = 5):
         self.id = track_id
-        self.prev_states = []  # tracks all previous estimates of position, and velocity
         self.start_frame = start_frame
         self.death_time = death_time
 
@@ -108,4 +163,75 @@ class AccelTrack(Track):
         self.age = 0  # in the first frame, age is 0
         self.time_missing = 0
         self.active = True
-        self.prev_measurements = []
+        # tracks all previous estimates of position and velocity, and the measurements
+        self.history = TrackHistory(self.kf.dim_x)
+
+
+class TrackBank:
+    """
+    Holds the Kalman Filter states and covariances of many tracks of the same class in stacked
+    arrays, so that predict and update run for every track at once instead of one filterpy
+    KalmanFilter at a time. The math is the same as filterpy's KalmanFilter.predict and update.
+    Row i of the bank belongs to the i-th track it was given.
+    """
+
+    def __init__(self, track_class):
+        # the matrices are the same for every track of a class, so borrow them from a throwaway track
+        template = track_class(-1, np.zeros(5), 0).kf
+        self.F = template.F.astype(float)
+        self.H = template.H.astype(float)
+        self.Q = template.Q.astype(float)
+        self.R = template.R.astype(float)
+        self.I = np.eye(template.dim_x)
+        self.x = np.zeros((0, template.dim_x))  # [T, S] states
+        self.P = np.zeros((0, template.dim_x, template.dim_x))  # [T, S, S] covariances
+
+    def __len__(self) -> int:
+        return len(self.x)
+
+    def add(self, track: Track) -> None:
+        """
+        Adds a new track, starting from the state of its own Kalman Filter.
+        """
+        self.x = np.concatenate((self.x, track.kf.x[np.newaxis]))
+        self.P = np.concatenate((self.P, track.kf.P[np.newaxis]))
+
+    def keep(self, mask: np.ndarray) -> None:
+        """
+        Drops the rows of the tracks where mask is False, keeping the rest in order.
+        """
+        self.x = self.x[mask]
+        self.P = self.P[mask]
+
+    def write_back(self, tracks: List[Track], indices) -> None:
+        """
+        Copies the states in the rows at indices back into the Kalman Filters of the tracks.
+        """
+        for track, i in zip(tracks, indices):
+            track.kf.x = self.x[i].copy()
+            track.kf.P = self.P[i].copy()
+
+    def predict(self) -> None:
+        """
+        Advances every track, predicting the current states based on the priors.
+        """
+        self.x = self.x @ self.F.T
+        self.P = self.F @ self.P @ self.F.T + self.Q
+
+    def update(self, indices: np.ndarray, measurements: np.ndarray) -> None:
+        """
+        Updates the states of the tracks at indices with their measurements, all at once.
+        Args:
+            indices: Rows of the tracks that have a measurement this frame.
+            measurements: [M, 4] array of (x, y, w, h) measurements, in the same order as indices.
+        """
+        if len(indices) == 0:
+            return
+        x, P = self.x[indices], self.P[indices]
+        y = measurements - x @ self.H.T  # residuals
+        PHT = P @ self.H.T
+        S = self.H @ PHT + self.R  # system uncertainty, in measurement space
+        K = PHT @ np.linalg.inv(S)  # kalman gains
+        I_KH = self.I - K @ self.H
+        self.x[indices] = x + (K @ y[..., np.newaxis])[..., 0]
+        self.P[indices] = I_KH @ P @ I_KH.transpose(0, 2, 1) + K @ self.R @ K.transpose(0, 2, 1)
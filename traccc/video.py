@@ -0,0 +1,226 @@
+"""
+Helpers for reading and writing videos, shared by the different stages of the pipeline.
+"""
+import os
+import subprocess
+import tempfile
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+import skvideo.io
+
+# the colour order of frames, from decoding to drawing to encoding, so they are never converted
+FRAME_FORMAT = "rgb24"
+
+
+def frame_rate(metadata: dict) -> float:
+    """
+    Reads the frame rate out of the metadata returned by skvideo.io.ffprobe.
+    """
+    numerator, denominator = map(int, metadata['video']['@r_frame_rate'].split('/'))
+    return numerator / denominator
+
+
+def display_size(metadata: dict) -> Tuple[int, int]:
+    """
+    Reads the (width, height) of the decoded frames out of the metadata returned by skvideo.io.ffprobe.
+    Phone videos are often stored sideways with a rotation, and ffmpeg rotates them upright
+    while decoding, so their width and height are swapped.
+    """
+    width = int(metadata['video']['@width'])
+    height = int(metadata['video']['@height'])
+    if _rotation(metadata['video']) % 180 == 90:
+        return height, width
+    return width, height
+
+
+def _rotation(stream: dict) -> int:
+    """
+    The rotation of a video stream in degrees. Older versions of ffprobe report it as a rotate
+    tag, and newer ones in the display matrix side data.
+    """
+    tags = stream.get('tag', [])
+    tags = tags if isinstance(tags, list) else [tags]
+    side_data = (stream.get('side_data_list') or {}).get('side_data', [])
+    side_data = side_data if isinstance(side_data, list) else [side_data]
+    rotations = [tag['@value'] for tag in tags if tag['@key'] == 'rotate'] + \
+                [entry['@rotation'] for entry in side_data if '@rotation' in entry]
+    return round(float(rotations[0])) if len(rotations) > 0 else 0
+
+
+def read_video(input_file: str, start_frame: int = 0, num_frames: Optional[int] = None,
+               reuse_buffer: bool = False) -> Iterator[np.ndarray]:
+    """
+    Returns a generator over the frames of a video, starting at start_frame. Frames are HWC uint8
+    in FRAME_FORMAT, decoded by an ffmpeg subprocess straight into numpy arrays.
+    Instead of decoding everything before start_frame, ffmpeg seeks to it, which
+    assumes a constant frame rate.
+    Args:
+        input_file: Path to the video file.
+        start_frame: Index of the first frame to read.
+        num_frames: Number of frames to read, or None to read to the end of the video.
+        reuse_buffer: Decode every frame into the same array, instead of allocating a new one
+            for each frame. A frame is then overwritten by the next one, so this is only for
+            consumers that are done with each frame before asking for the next.
+    """
+    metadata = skvideo.io.ffprobe(input_file)
+    width, height = display_size(metadata)
+    command = ["ffmpeg", "-nostdin", "-loglevel", "error"]
+    if start_frame > 0:
+        # aim between two frames, so rounding can't land us on the wrong side of start_frame
+        command += ["-ss", f"{(start_frame - 0.5) / frame_rate(metadata):.6f}"]
+    command += ["-i", input_file, "-map", "0:v:0"]
+    if num_frames is not None:
+        command += ["-frames:v", str(num_frames)]
+    command += ["-f", "rawvideo", "-pix_fmt", FRAME_FORMAT, "-"]
+    return _decode(command, (height, width, 3), reuse_buffer)
+
+
+def _decode(command: List[str], shape: Tuple[int, int, int], reuse_buffer: bool) -> Iterator[np.ndarray]:
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    frame = np.empty(shape, dtype=np.uint8)
+    try:
+        while True:
+            if not reuse_buffer:
+                frame = np.empty(shape, dtype=np.uint8)
+            if not _read_frame(process.stdout, frame):
+                break
+            yield frame
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg exited with code {process.returncode} while decoding")
+    finally:
+        # the consumer may stop early, don't leave ffmpeg blocked on a full pipe
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        process.wait()
+
+
+def _read_frame(stream, frame: np.ndarray) -> bool:
+    """
+    Fills frame with bytes from stream. Returns False if the stream ends before a whole frame.
+    """
+    view = memoryview(frame).cast('B')
+    filled = 0
+    while filled < len(view):
+        read = stream.readinto(view[filled:])
+        if not read:
+            return False
+        filled += read
+    return True
+
+
+def split_frames(frame_count: int, num_shards: int) -> List[Tuple[int, int]]:
+    """
+    Splits frame_count frames into num_shards contiguous ranges of nearly equal length.
+    Returns:
+        A list of (start_frame, num_frames) pairs, in order. Empty ranges are left out.
+    """
+    bounds = np.linspace(0, frame_count, num_shards + 1).round().astype(int)
+    return [(int(start), int(end - start)) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def concat_videos(input_files: List[str], output_file: str, audio_source: Optional[str] = None) -> None:
+    """
+    Joins videos end to end with ffmpeg's concat demuxer, copying the streams instead of
+    re-encoding them. The videos must have been encoded with the same codec and settings.
+    Args:
+        input_files: The videos to join, in order.
+        output_file: Path to the joined video.
+        audio_source: Video whose audio is copied into the output, without re-encoding it.
+    """
+    with tempfile.NamedTemporaryFile('w', suffix=".txt", delete=False) as file_list:
+        for input_file in input_files:
+            # the concat demuxer wants single quotes escaped as '\''
+            escaped = os.path.abspath(input_file).replace("'", "'\\''")
+            file_list.write(f"file '{escaped}'\n")
+    try:
+        command = ["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", file_list.name]
+        if audio_source is not None:
+            command += ["-i", audio_source, "-map", "0:v:0", "-map", "1:a:0?", "-shortest"]
+        subprocess.run(command + ["-c", "copy", output_file], check=True)
+    finally:
+        os.remove(file_list.name)
+
+
+def encoder_settings(codec: str, preset: Optional[str] = None,
+                     crf: Optional[int] = None) -> Tuple[Optional[str], Optional[int]]:
+    """
+    Fills in the preset and crf that weren't given. x264 and x265 get veryfast and 23, and
+    other encoders get None, since they may not have presets or a crf.
+    """
+    if codec in ("libx264", "libx265"):
+        return ("veryfast" if preset is None else preset), (23 if crf is None else crf)
+    return preset, crf
+
+
+def encoder_args(codec: str = "libx264", preset: Optional[str] = "veryfast", crf: Optional[int] = 23,
+                 threads: int = 0) -> List[str]:
+    """
+    The ffmpeg output arguments for encoding video with codec. See VideoWriter.
+    """
+    args = ["-c:v", codec]
+    if preset is not None:
+        args += ["-preset", preset]
+    if crf is not None:
+        args += ["-crf", str(crf)]
+    # yuv420p plays everywhere, x264 would otherwise keep the full chroma of rgb24
+    return args + ["-threads", str(threads), "-pix_fmt", "yuv420p"]
+
+
+class VideoWriter:
+    """
+    Encodes frames by piping them raw to an ffmpeg process, so encoding runs on ffmpeg's own
+    threads while the frames are still being drawn. Used as a context manager, leaving the block
+    waits for ffmpeg to finish the file.
+    """
+
+    def __init__(self, output_file: str, width: int, height: int, fps: float,
+                 codec: str = "libx264", preset: Optional[str] = "veryfast", crf: Optional[int] = 23,
+                 threads: int = 0, audio_source: Optional[str] = None, pix_fmt: str = FRAME_FORMAT):
+        """
+        Args:
+            output_file: Path to the video file to write.
+            width: Width of the frames.
+            height: Height of the frames.
+            fps: Frame rate of the video.
+            codec: ffmpeg video encoder, like libx264, libx265 or mpeg4.
+            preset: Encoder speed preset, trading encoding speed for file size.
+                None for encoders without presets.
+            crf: Constant rate factor, lower is better quality. None for encoders without it.
+            threads: Number of encoder threads, 0 lets ffmpeg choose.
+            audio_source: Video whose audio is copied into the output, without re-encoding it.
+            pix_fmt: Pixel format of the frames written, the same as read_video's by default.
+        """
+        self.frame_shape = (height, width, 3)
+        command = ["ffmpeg", "-y", "-loglevel", "error",
+                   "-f", "rawvideo", "-pix_fmt", pix_fmt, "-s", f"{width}x{height}", "-r", str(fps),
+                   "-i", "-"]
+        if audio_source is not None:
+            # the ? leaves the audio out if the source doesn't have any
+            command += ["-i", audio_source, "-map", "0:v:0", "-map", "1:a:0?", "-c:a", "copy", "-shortest"]
+        command += encoder_args(codec, preset, crf, threads)
+        command.append(output_file)
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, frame: np.ndarray) -> None:
+        if frame.shape != self.frame_shape:
+            raise ValueError(f"Expected a frame of shape {self.frame_shape}, got {frame.shape}")
+        self.process.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).data)
+
+    def close(self) -> None:
+        """
+        Waits for ffmpeg to finish writing the video.
+        """
+        if self.process.stdin.closed:
+            return
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError(f"ffmpeg exited with code {self.process.returncode} while encoding")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+